@@ -210,6 +210,20 @@ class Backend(object):
         @param name Name of file to delete.'''
         raise NotImplementedError
 
+    def has_async_interface(self):
+        '''Whether the backend implements the asynchronous interface;
+        put_async(name, data, done), get_async(name, done) and
+        delete_async(name, done). These have the semantics of their
+        synchronous counterparts, except that they return immediately
+        and arrange for done(value, error) to be called, in an
+        arbitrary thread, upon completion. error is None on success,
+        or else a human-readable description of the failure.
+
+        The asynchronous interface allows a large number of
+        operations to be in flight without dedicating a thread to
+        each. Backends without it return False (the default).'''
+        return False
+
     def close(self):
         '''Close the backend, releasing any resources it may
         occupy.'''
@@ -9,15 +9,68 @@ In-memory backend.
 from __future__ import absolute_import
 from __future__ import with_statement
 
+import heapq
 import random
 import threading
 import time
+import traceback
 
 import shastity.backend as backend
+import shastity.logging as logging
+
+log = logging.get_logger(__name__)
 
 _dict = dict()
 _lock = threading.Lock()
 
+class InjectedFailure(Exception):
+    '''Raised by operations failing due to the failure_rate option.'''
+    pass
+
+class _Timer(object):
+    '''Calls callables at given points in time, using a single thread
+    (started on demand) regardless of how many calls are pending.'''
+    def __init__(self):
+        self.__cond = threading.Condition()
+        self.__pending = [] # heap of (due time, sequence number, callable)
+        self.__seq = 0
+        self.__thread = None
+
+    def call_later(self, delay, fn):
+        with self.__cond:
+            self.__seq += 1
+            heapq.heappush(self.__pending, (time.time() + delay, self.__seq, fn))
+
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__main, name='memorybackend-timer')
+                self.__thread.setDaemon(True)
+                self.__thread.start()
+            self.__cond.notify()
+
+    def __main(self):
+        while True:
+            with self.__cond:
+                while True:
+                    if not self.__pending:
+                        self.__cond.wait()
+                        continue
+
+                    now = time.time()
+                    due, seq, fn = self.__pending[0]
+                    if due > now:
+                        self.__cond.wait(due - now)
+                        continue
+
+                    heapq.heappop(self.__pending)
+                    break
+
+            try:
+                fn()
+            except Exception, e:
+                log.error('unexpected error in timer callback: %s', traceback.format_exc())
+
+_timer = _Timer()
+
 class MemoryBackend(backend.Backend):
     '''Trivial in-memory backend that simply maps all operations to an
     internal dict. Obviously this does violate the supposed
@@ -30,6 +83,17 @@ class MemoryBackend(backend.Backend):
     in order to try to trigger various timing dependent cases in a
     non-deterministic fashion.
 
+    Similarly, it supports an option 'failure_rate' whose value is the
+    probability (between 0 and 1) of a put/get/delete operation
+    failing with InjectedFailure before it has had any effect. This
+    is intended for testing retry logic.
+
+    The asynchronous interface is supported. Its operations are
+    delayed in the same way as synchronous ones, but by means of a
+    single timer thread shared by all pending operations. This
+    simulates a backend with a large number of concurrent operations
+    in flight.
+
     In order to simulate external storage that is shared between
     instances, it keeps thread-safe access to an instance independent
     shared dict for storage.'''
@@ -37,11 +101,16 @@ class MemoryBackend(backend.Backend):
         backend.Backend.__init__(self, identifier, opts)
 
         self.__max_fake_delay = float(opts.get('max_fake_delay', 0.0))
+        self.__failure_rate = float(opts.get('failure_rate', 0.0))
 
     def __delay(self):
         if self.__max_fake_delay > 0.0:
             time.sleep(self.__max_fake_delay * random.random())
 
+    def __maybe_fail(self, opname, name):
+        if self.__failure_rate > 0.0 and random.random() < self.__failure_rate:
+            raise InjectedFailure('injected failure of %s %s' % (opname, name))
+
     def exists(self):
         return True
 
@@ -50,30 +119,68 @@ class MemoryBackend(backend.Backend):
 
     def put(self, name, data):
         self.__delay()
+        self.__put(name, data)
+
+    def get(self, name):
+        self.__delay()
+        return self.__get(name)
+
+    def list(self):
+        self.__delay()
 
         global _dict
         global _lock
         with _lock:
-            _dict[name] = data
+            return _dict.keys()
 
-    def get(self, name):
+    def delete(self, name):
         self.__delay()
+        self.__delete(name)
+
+    def has_async_interface(self):
+        return True
+
+    def put_async(self, name, data, done):
+        self.__async(lambda: self.__put(name, data), done)
+
+    def get_async(self, name, done):
+        self.__async(lambda: self.__get(name), done)
+
+    def delete_async(self, name, done):
+        self.__async(lambda: self.__delete(name), done)
+
+    def __async(self, fn, done):
+        def run():
+            try:
+                value = fn()
+            except Exception, e:
+                done(None, traceback.format_exc())
+            else:
+                done(value, None)
+
+        if self.__max_fake_delay > 0.0:
+            _timer.call_later(self.__max_fake_delay * random.random(), run)
+        else:
+            run()
+
+    def __put(self, name, data):
+        self.__maybe_fail('put', name)
 
         global _dict
         global _lock
         with _lock:
-            return _dict[name]
+            _dict[name] = data
 
-    def list(self):
-        self.__delay()
+    def __get(self, name):
+        self.__maybe_fail('get', name)
 
         global _dict
         global _lock
         with _lock:
-            return _dict.keys()
+            return _dict[name]
 
-    def delete(self, name):
-        self.__delay()
+    def __delete(self, name):
+        self.__maybe_fail('delete', name)
 
         global _dict
         global _lock
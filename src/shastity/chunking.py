@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 Peter Schuller <peter.schuller@infidyne.com>
+
+"""
+Splitting of file contents into blocks ("chunking").
+
+A chunker has a chunks() method which, given a file-like object,
+yields its contents as a sequence of non-empty byte strings, a
+pieces() method yielding the same blocks in pieces (such that data
+can be processed as it is read, rather than block by block), a split()
+method which, given a buffer (such as a memory mapped file), yields
+the (offset, length) of each block in it without copying any data, and
+a spec() method returning a string describing the chunker and its
+parameters (recorded in manifests). make_chunker() constructs a
+chunker from such a string.
+
+Two kinds of chunkers are supported:
+
+  - Fixed size ('fixed-SIZE'); blocks are cut at multiples of SIZE
+    bytes.
+  - Content-defined ('fastcdc-MIN-AVG-MAX'); blocks are cut where a
+    rolling (gear) hash of the preceding bytes matches a pattern, as
+    in FastCDC. Block sizes vary between MIN and MAX bytes, averaging
+    roughly AVG. Since cut points depend on content rather than
+    offsets, inserting or removing data only affects the blocks near
+    the change rather than all blocks following it, allowing the
+    unaffected blocks to be deduplicated.
+
+    If numpy is available (and MIN is at least 32), the rolling hash
+    is computed in a vectorized fashion, over all data read at once
+    rather than block by block. The pure python fallback yields
+    identical blocks, but is more than ten times slower.
+
+    Note that content-defined chunking is slower than hashing the
+    blocks: on the machine test/bench_chunking.py was last run on,
+    sha512 hashed about 250 MB/s, whereas the vectorized chunker cut
+    about 80 MB/s and the pure python fallback about 6 MB/s. Fixed
+    size chunking costs next to nothing in comparison.
+
+Example use::
+
+  chunker = make_chunker('fastcdc-262144-1048576-4194304')
+  for block in chunker.chunks(f):
+    ...
+"""
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import hashlib
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None # content-defined chunking falls back to pure python
+
+# Maximum size of the pieces yielded by pieces(); small enough to stay
+# in cache while being processed.
+DEFAULT_PIECE_SIZE = 256*1024
+
+class UnsupportedChunker(Exception):
+    pass
+
+def _next_block(f, blocksize):
+    '''@return The next blocksize bytes of f, or fewer at the end of the file.'''
+    # Normally a single read suffices, and the string it returns is
+    # then passed on as is (to the hasher and the storage queue)
+    # without further copying.
+    block = f.read(blocksize)
+    if len(block) == blocksize or len(block) == 0:
+        return block
+
+    parts = [ block ]
+    sofar = len(block)
+    while sofar < blocksize:
+        part = f.read(blocksize - sofar)
+        if len(part) == 0:
+            break # eof
+
+        parts.append(part)
+        sofar += len(part)
+
+    return ''.join(parts)
+
+class FixedSizeChunker(object):
+    # Whether cut points depend on content (rather than only on
+    # offsets, allowing a file to be chunked starting at any multiple
+    # of blocksize).
+    content_defined = False
+
+    def __init__(self, blocksize):
+        assert blocksize > 0, 'blocksize must be positive'
+
+        self.blocksize = blocksize
+
+    def spec(self):
+        return 'fixed-%d' % (self.blocksize,)
+
+    def chunks(self, f):
+        while True:
+            block = _next_block(f, self.blocksize)
+            if len(block) == 0:
+                break
+            yield block
+
+    def pieces(self, f, piece_size=DEFAULT_PIECE_SIZE):
+        '''Like chunks(), but yields (piece, last) tuples, where
+        piece is a non-empty string of at most piece_size bytes and
+        last is True for the last piece of each block.'''
+        piece = f.read(min(piece_size, self.blocksize))
+        remaining = self.blocksize
+        while piece:
+            remaining -= len(piece)
+            if remaining == 0:
+                remaining = self.blocksize
+                last = True
+            else:
+                last = False
+
+            following = f.read(min(piece_size, remaining))
+            yield (piece, last or not following)
+            piece = following
+
+    def split(self, data):
+        for offset in xrange(0, len(data), self.blocksize):
+            yield (offset, min(self.blocksize, len(data) - offset))
+
+# The gear table maps each byte value to a pseudo-random 32 bit
+# integer. It must never change, or cut points (and thus block
+# hashes) would change with it.
+_GEAR = [ int(hashlib.sha256('shastity gear %d' % (n,)).hexdigest()[:8], 16) for n in xrange(0, 256) ]
+
+_HASH_BITS = 32
+_HASH_MASK = (1 << _HASH_BITS) - 1
+
+# Number of positions hashed at a time when vectorized; small enough
+# for the intermediate arrays to stay in cache.
+_HASH_PIECE = 64*1024
+
+if numpy is not None:
+    _GEAR_ARRAY = numpy.array(_GEAR, dtype=numpy.uint32)
+    _NO_HITS = numpy.zeros(0, dtype=numpy.intp)
+
+def _mask(bits):
+    '''@return A mask of the given number of the *most* significant bits
+               of the hash; with the gear hash, these are the bits
+               depending on the largest number of preceding bytes.'''
+    return ((1 << bits) - 1) << (_HASH_BITS - bits)
+
+def _extend_hits(hits, pos, shift, more):
+    '''@return The hits (see FastCDCChunker.__hits()) at positions >= pos,
+               moved back by shift bytes, followed by more hits.'''
+    if hits is None:
+        return more
+    return tuple(numpy.concatenate((old[old.searchsorted(pos):] - shift, new)) for old, new in zip(hits, more))
+
+class FastCDCChunker(object):
+    '''Content-defined chunker using the FastCDC algorithm: a gear
+    hash, no hashing at all of the first min_size bytes of a block
+    (which cannot be cut anyway), and "normalized chunking" (a
+    stricter cut condition before avg_size and a looser one after)
+    in order to keep block sizes close to the average.'''
+    content_defined = True
+
+    def __init__(self, min_size, avg_size, max_size, vectorized=None):
+        '''
+        @param vectorized: Whether to use numpy to find cut points. Defaults to whether
+                           numpy is available. Only supported if min_size is at least
+                           _HASH_BITS (32); smaller blocks are always cut in pure python.
+        '''
+        assert 0 < min_size <= avg_size <= max_size, 'need 0 < min_size <= avg_size <= max_size'
+
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        self.vectorized = (numpy is not None) if vectorized is None else vectorized
+        assert numpy is not None or not self.vectorized, 'vectorized chunking requires numpy'
+        self.vectorized = self.vectorized and min_size >= _HASH_BITS
+
+        bits = max(1, int(round(math.log(avg_size, 2))))
+        self.__mask_strict = _mask(min(_HASH_BITS, bits + 1))
+        self.__mask_loose = _mask(max(1, bits - 1))
+
+    def spec(self):
+        return 'fastcdc-%d-%d-%d' % (self.min_size, self.avg_size, self.max_size)
+
+    def chunks(self, f):
+        # buf[pos:] is data read but not yet yielded. Blocks are
+        # sliced out of buf without moving the remainder, which is
+        # only done upon reading more data (at most once per
+        # max_size bytes read). When vectorized, hits are those of
+        # buf (see __hits()), computed as data is read.
+        buf = ''
+        pos = 0
+        eof = False
+        hits = None
+
+        while True:
+            # make sure we have a full max_size worth of data, unless
+            # at the end of the file
+            if not eof and len(buf) - pos < self.max_size:
+                data = f.read(self.max_size * 2 - (len(buf) - pos))
+                if len(data) == 0:
+                    eof = True
+                else:
+                    buf = buf[pos:] + data
+                    if self.vectorized:
+                        hits = _extend_hits(hits, pos, pos, self.__hits(buf, len(buf) - len(data), len(buf)))
+                    pos = 0
+                continue
+
+            if pos == len(buf):
+                break
+
+            if self.vectorized:
+                cut = self.__vectorized_cut_point(hits, pos, len(buf))
+            else:
+                cut = self.cut_point(buf, pos)
+            yield buf[pos:pos + cut]
+            pos += cut
+
+    def pieces(self, f, piece_size=DEFAULT_PIECE_SIZE):
+        '''Like chunks(), but yields (piece, last) tuples as
+        FixedSizeChunker.pieces(). Since cut points are only known
+        once a block has been read, each block is a single piece.'''
+        for block in self.chunks(f):
+            yield (block, True)
+
+    def split(self, data):
+        pos = 0
+        if not self.vectorized:
+            while pos < len(data):
+                cut = self.cut_point(data, pos)
+                yield (pos, cut)
+                pos += cut
+            return
+
+        # Hash data[:hashed] a window of (up to) twice max_size bytes
+        # at a time, as read by chunks().
+        hits = None
+        hashed = 0
+        while pos < len(data):
+            if hashed < len(data) and hashed - pos < self.max_size:
+                end = min(len(data), pos + self.max_size * 2)
+                hits = _extend_hits(hits, pos, 0, self.__hits(data, hashed, end))
+                hashed = end
+                continue
+
+            cut = self.__vectorized_cut_point(hits, pos, hashed)
+            yield (pos, cut)
+            pos += cut
+
+    def cut_point(self, data, start=0):
+        '''@return The length of the block at data[start:], which must
+                   contain max_size bytes unless at the end of the
+                   file.'''
+        length = len(data) - start
+        if length <= self.min_size:
+            return length
+
+        normal = start + min(length, self.avg_size)
+        limit = start + min(length, self.max_size)
+
+        # The hash depends only on the _HASH_BITS most recent bytes,
+        # so we skip the beginning of the block and merely prime the
+        # hash with the bytes preceding min_size.
+        prime = min(self.min_size, _HASH_BITS)
+        offset = start + self.min_size - prime
+
+        # view[i] is data[offset + i]. The loops below are the hot
+        # spot of chunking; keep them tight and use locals only.
+        view = bytearray(data[offset:limit])
+        gear = _GEAR
+        hmask = _HASH_MASK
+
+        h = 0
+        i = 0
+        while i < prime:
+            h = ((h << 1) + gear[view[i]]) & hmask
+            i += 1
+
+        mask = self.__mask_strict
+        end = normal - offset
+        while i < end:
+            h = ((h << 1) + gear[view[i]]) & hmask
+            i += 1
+            if not h & mask:
+                return i + offset - start
+
+        mask = self.__mask_loose
+        end = limit - offset
+        while i < end:
+            h = ((h << 1) + gear[view[i]]) & hmask
+            i += 1
+            if not h & mask:
+                return i + offset - start
+
+        return limit - start
+
+    def __hits(self, data, start, end):
+        '''Compute the hash at all positions of data[start:end] at
+        once, rather than block by block.
+
+        The hash at position p is the sum of gear[data[p - j]] << j
+        over j in [0, _HASH_BITS), modulo 2**_HASH_BITS, which is what
+        cut_point() computes once primed (bytes preceding data[start]
+        are taken into account). It is only correct for p >=
+        _HASH_BITS - 1; since blocks are never cut in their first
+        min_size >= _HASH_BITS bytes, other positions are never looked
+        at.
+
+        @return (strict, loose): Sorted arrays of the positions at
+                which the strict and loose cut conditions hold.'''
+        # The masks cover the most significant bits, so a cut
+        # condition holds iff the hash is below a limit. Strict hits
+        # are a subset of loose hits.
+        strict_limit = (~self.__mask_strict & _HASH_MASK) + 1
+        loose_limit = (~self.__mask_loose & _HASH_MASK) + 1
+
+        strict = [ _NO_HITS ]
+        loose = [ _NO_HITS ]
+        shifted = numpy.empty(_HASH_PIECE + _HASH_BITS - 1, dtype=numpy.uint32)
+        for piece_start in xrange(start, end, _HASH_PIECE):
+            # include the bytes preceding the piece that the hash
+            # depends on
+            lo = max(0, piece_start - (_HASH_BITS - 1))
+            piece_end = min(end, piece_start + _HASH_PIECE)
+            view = numpy.frombuffer(data, dtype=numpy.uint8, count=piece_end - lo, offset=lo)
+
+            # Sum windows of doubling width; after the step with
+            # width w, h[i] covers the 2w bytes ending at i.
+            h = _GEAR_ARRAY.take(view)
+            s = shifted[:len(h)]
+            width = 1
+            while width < _HASH_BITS:
+                numpy.left_shift(h[:-width], numpy.uint32(width), out=s[width:])
+                h[width:] += s[width:]
+                width *= 2
+            h = h[piece_start - lo:]
+
+            piece_loose = numpy.flatnonzero(h < loose_limit)
+            loose.append(piece_loose + piece_start)
+            strict.append(piece_loose[h[piece_loose] < strict_limit] + piece_start)
+
+        return (numpy.concatenate(strict), numpy.concatenate(loose))
+
+    def __vectorized_cut_point(self, hits, start, end):
+        '''Equivalent to cut_point(data[:end], start), given the hits
+        of data[start:end] as returned by __hits().'''
+        length = end - start
+        if length <= self.min_size:
+            return length
+
+        normal = start + min(length, self.avg_size)
+        limit = start + min(length, self.max_size)
+
+        strict, loose = hits
+        n = strict.searchsorted(start + self.min_size)
+        if n < len(strict) and strict[n] < normal:
+            return int(strict[n]) + 1 - start
+
+        n = loose.searchsorted(normal)
+        if n < len(loose) and loose[n] < limit:
+            return int(loose[n]) + 1 - start
+
+        return limit - start
+
+def make_chunker(spec):
+    """
+    @param spec: Chunker specification, as returned by the spec() method of a chunker.
+    @return A chunker.
+    """
+    comps = spec.split('-')
+    try:
+        params = [ int(comp) for comp in comps[1:] ]
+    except ValueError:
+        raise UnsupportedChunker(spec)
+
+    if comps[0] == 'fixed' and len(params) == 1:
+        return FixedSizeChunker(*params)
+    elif comps[0] == 'fastcdc' and len(params) == 3:
+        return FastCDCChunker(*params)
+    else:
+        raise UnsupportedChunker(spec)
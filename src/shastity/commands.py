@@ -40,15 +40,25 @@ library interface, while keeping the implementation identical.
 from __future__ import absolute_import
 from __future__ import with_statement
 
+import contextlib
+import multiprocessing
+
+import shastity.chunking as chunking
+import shastity.compression as compression
 import shastity.options as options
 import shastity.traversal as traversal
 import shastity.manifest as manifest
 import shastity.filesystem as filesystem
+import shastity.hash as hash
 import shastity.persistence as persistence
 import shastity.materialization as materialization
+import shastity.metrics as metrics
 import shastity.storagequeue as storagequeue
 import shastity.backends.s3backend as s3backend
 import shastity.backends.gpgcrypto as gpgcrypto
+import shastity.logging as logging
+
+log = logging.get_logger(__name__)
 
 # In the future we'll have groups of commands too, or else command
 # listings to the user become too verbose.
@@ -92,6 +102,10 @@ _all_commands = [ Command('persist',
                           ['uri'],
                           options.GlobalOptions(),
                           description='List names of manifests'),
+                  Command('benchmark-hash',
+                          [],
+                          options.GlobalOptions(),
+                          description='Measure the speed of each available hash algorithm on this machine.'),
                   ]
 
 def all_commands():
@@ -114,31 +128,187 @@ def get_command(name):
 
     return matching[0]
 
-CONCURRENCY = 10 # TODO: hard-coded
+def _retry_policy(config):
+    """
+    @return The RetryPolicy for backend operations, as configured.
+    """
+    return storagequeue.RetryPolicy(max_attempts=config.opts.max_attempts)
+
+def _storage_queue(uri, config, **kwargs):
+    """
+    Construct a StorageQueue (or AsyncStorageQueue) for the backend
+    at the given URI, with concurrency and memory limits (and size
+    classes) as configured. Keyword arguments are passed on to the
+    StorageQueue.
+    """
+    if config.opts.async_queue:
+        queue_class = storagequeue.AsyncStorageQueue
+    else:
+        queue_class = storagequeue.StorageQueue
+
+    if config.opts.adaptive_concurrency:
+        adaptive = storagequeue.AdaptiveConcurrency
+    else:
+        adaptive = None
+
+    if config.opts.large_threshold:
+        kwargs.update(large_threshold=config.opts.large_threshold,
+                      large_conc=config.opts.large_concurrency or None,
+                      large_queue_depth=config.opts.large_queue_depth or None,
+                      large_queue_bytes=config.opts.large_queue_bytes or None)
+
+    return queue_class(get_backend_factory(uri),
+                       config.opts.concurrency,
+                       max_bytes=config.opts.max_inflight_bytes or None,
+                       adaptive=adaptive,
+                       **kwargs)
+
+@contextlib.contextmanager
+def _metrics_sampling(sq, config):
+    """
+    Context manager which, if a metrics file is configured, samples
+    the metrics of the given StorageQueue to it periodically and once
+    more upon exit.
+    """
+    # (optional, so not through config.opts, which requires options to be set)
+    metrics_file = config.get_option('metrics-file').get()
+    if metrics_file is None:
+        yield
+    else:
+        with metrics.Sampler(sq.metrics, metrics_file, config.opts.metrics_interval):
+            yield
+
+def _chunker(config):
+    """
+    Construct the chunker selected by the block size options.
+    """
+    avg = config.opts.block_size
+    if config.opts.chunking == 'fixed':
+        return chunking.FixedSizeChunker(avg)
+    elif config.opts.chunking == 'fastcdc':
+        if chunking.numpy is None:
+            log.warning('numpy is not installed; content-defined chunking falls back to pure python, '
+                        'which is more than ten times slower')
+        return chunking.FastCDCChunker(config.opts.min_block_size or max(1, avg / 4),
+                                       avg,
+                                       config.opts.max_block_size or avg * 4)
+    else:
+        raise chunking.UnsupportedChunker(config.opts.chunking)
+
+def _compressor(config):
+    """
+    Construct the compressor selected by the compression options, or
+    None.
+    """
+    level = config.opts.compression_level
+    return compression.make_compressor(config.opts.compression, None if level < 0 else level)
+
+@contextlib.contextmanager
+def _hashing_pool(workers):
+    """
+    Context manager providing a pool of the given number of processes
+    in which to read and hash files during persistence, or None if
+    there is to be only one.
+    """
+    if workers <= 1:
+        yield None
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            yield pool
+        finally:
+            pool.terminate()
+            pool.join()
 
 def persist(src_path, dst_uri, config):
     mpath, label, dpath = dst_uri.split(',')
     fs = filesystem.LocalFileSystem()
     traverser = traversal.traverse(fs, src_path)
-    sq = storagequeue.StorageQueue(get_backend_factory(dpath),
-                                   CONCURRENCY)
-    mf = list(persistence.persist(fs,
-                                  traverser,
-                                  None,
-                                  src_path,
-                                  sq,
-                                  blocksize=2000))
-    manifest.write_manifest(get_backend_factory(mpath)(), label, mf)
+    chunker = _chunker(config)
+    incremental = None
+    incremental_from = config.get_option('incremental-from').get() # optional
+    if incremental_from is not None:
+        # The hashes of the previous backup are only valid in this one
+        # if cut by the same chunker, or blocks would be restored at
+        # the wrong offsets (see materialize()).
+        spec = manifest.read_manifest_properties(get_backend_factory(mpath)(),
+                                                 incremental_from).get('chunker')
+        if spec == chunker.spec():
+            incremental = manifest.read_manifest(get_backend_factory(mpath)(),
+                                                 incremental_from)
+        else:
+            log.warning('%s was not persisted with chunker %s (but %s); persisting all files',
+                        incremental_from, chunker.spec(), spec)
+    if config.opts.block_index:
+        index = persistence.BlockIndex.from_backend(get_backend_factory(dpath)())
+    else:
+        index = None
+    stats = persistence.PersistenceStats()
+    digests = dict() if config.opts.file_digests else None
+    workers = config.opts.hash_workers or multiprocessing.cpu_count()
+    if config.opts.mmap_threshold and workers > 1:
+        log.warning('--mmap-threshold only applies with --hash-workers=1; reading files')
+    with _storage_queue(dpath,
+                        config,
+                        retry_policy=_retry_policy(config)) as sq:
+        with contextlib.nested(_metrics_sampling(sq, config), _hashing_pool(workers)) as (_, pool):
+            mf = list(persistence.persist(fs,
+                                          traverser,
+                                          incremental,
+                                          src_path,
+                                          sq,
+                                          index=index,
+                                          stats=stats,
+                                          hasher=hash.make_hasher(config.opts.hash),
+                                          chunker=chunker,
+                                          pool=pool,
+                                          window=max(persistence.DEFAULT_WINDOW, 2 * workers),
+                                          mmap_threshold=(config.opts.mmap_threshold or None),
+                                          digests=digests,
+                                          compressor=_compressor(config)))
+    manifest.write_manifest(get_backend_factory(mpath)(), label, mf,
+                            properties=dict(chunker=chunker.spec()),
+                            digests=digests)
+    log.info('persisted %s: %s', label, stats)
 
 def materialize(src_uri, dst_path, config):
     mpath, label, dpath = src_uri.split(',')
     fs = filesystem.LocalFileSystem()
-    fs.mkdir(dst_path)
+    delta = config.opts.delta
+    if not (delta and fs.is_dir(dst_path)):
+        fs.mkdir(dst_path)
     mf = list(manifest.read_manifest(get_backend_factory(mpath)(),
                                      label))
-    sq = storagequeue.StorageQueue(get_backend_factory(dpath),
-                                   CONCURRENCY)
-    materialization.materialize(fs, dst_path, mf, sq)
+    blocksize = None
+    if config.opts.positional_writes or delta:
+        spec = manifest.read_manifest_properties(get_backend_factory(mpath)(), label).get('chunker')
+        chunker = chunking.make_chunker(spec) if spec is not None else None
+        if chunker is not None and not chunker.content_defined:
+            blocksize = chunker.blocksize
+        elif delta:
+            raise materialization.BlockOffsetsUnknown(label)
+        else:
+            log.warning('block offsets of %s not known; writing blocks in order', label)
+    reorder_budget = config.opts.reorder_buffer or None
+    # Unless writing positionally or through a reorder buffer, no
+    # retries here; materialization callbacks then block waiting for
+    # preceding blocks, which could deadlock with retries (see
+    # StorageQueue).
+    if blocksize is not None or reorder_budget is not None:
+        kwargs = dict(retry_policy=_retry_policy(config))
+    else:
+        kwargs = dict()
+    stats = materialization.MaterializationStats()
+    with _storage_queue(dpath, config, **kwargs) as sq:
+        with _metrics_sampling(sq, config):
+            materialization.materialize(fs, dst_path, mf, sq,
+                                        blocksize=blocksize,
+                                        reorder_budget=reorder_budget,
+                                        stats=stats,
+                                        max_open_files=config.opts.max_open_files,
+                                        cache_budget=config.opts.block_cache or None,
+                                        delta=delta)
+    log.info('materialized %s: %s', label, stats)
 
 
 
@@ -167,6 +337,11 @@ def list_manifest(uri, config):
                                  len(mf),
                                  len(flatten([x[2] for x in mf])))
 
+def benchmark_hash(config):
+    print "%-10s %10s" % ('Algorithm', 'MB/s')
+    for name in hash.available_algos():
+        print "%-10s %10.1f" % (name, hash.benchmark(name) / (1024*1024))
+
 def verify(src_path, dst_uri, config):
     raise NotImplementedError('very not implemented')
 
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 Peter Schuller <peter.schuller@infidyne.com>
+
+"""
+Compression of blocks prior to storing them.
+
+Blocks are named by the hash of their (uncompressed) contents. A
+compressed block is stored under that name followed by a dot and the
+name of the codec (e.g., '<hex>.zlib'), which is also the name by
+which manifests refer to it; a block named by its hash alone is
+stored as is. Thus the codec of every block is known upon restore,
+blocks compressed by different codecs never collide, and backups with
+and without compression may share backing storage.
+
+Supported codecs are 'zlib', 'zstd' (requiring the zstandard module)
+and 'lz4' (requiring the lz4 module).
+
+Example use::
+
+  compressor = make_compressor('zlib')
+  name = compressor.block_name(hex, block) # hex, or hex + '.zlib'
+  if name != hex:
+      block = compressor.compress(block)
+  ...
+  decompress(name, block) # the original block
+"""
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import zlib
+
+# optional codecs
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Blocks are only compressed if compressing a sample from their
+# beginning shrinks it to at most DEFAULT_THRESHOLD of its size, so
+# that already compressed data (media, archives) costs little more
+# than compressing the sample.
+DEFAULT_SAMPLE_SIZE = 4*1024
+DEFAULT_THRESHOLD = 0.9
+
+class UnsupportedCodec(Exception):
+    pass
+
+class _Codec(object):
+    def __init__(self, default_level, compress, decompress):
+        self.default_level = default_level
+        self.compress = compress     # (bytes, level) -> bytes
+        self.decompress = decompress # bytes -> bytes
+
+# name -> _Codec, of the available codecs
+_codecs = dict(zlib=_Codec(6, zlib.compress, zlib.decompress))
+if zstandard is not None:
+    _codecs['zstd'] = _Codec(3,
+                             lambda data, level: zstandard.ZstdCompressor(level=level).compress(data),
+                             lambda data: zstandard.ZstdDecompressor().decompress(data))
+if lz4 is not None:
+    _codecs['lz4'] = _Codec(0,
+                            lambda data, level: lz4.frame.compress(data, compression_level=level),
+                            lz4.frame.decompress)
+
+def _codec(name):
+    if name not in _codecs:
+        raise UnsupportedCodec(name)
+    return _codecs[name]
+
+class Compressor(object):
+    '''Decides which blocks to compress, and compresses them, using a
+    given codec. Compressors are picklable.'''
+    def __init__(self, codec, level=None, sample_size=DEFAULT_SAMPLE_SIZE, threshold=DEFAULT_THRESHOLD):
+        '''
+        @param codec: Name of the codec (e.g., 'zlib').
+        @param level: Compression level, or None for the default of the codec.
+        @param sample_size: Number of bytes from the beginning of a block used to
+                            determine whether it is worth compressing.
+        @param threshold: Maximum ratio of compressed to uncompressed size of the
+                          sample for the block to be compressed.
+        '''
+        self.codec = codec
+        self.level = _codec(codec).default_level if level is None else level
+        self.sample_size = sample_size
+        self.threshold = threshold
+
+    def compressible(self, block):
+        '''@return Whether the given block (a string, or buffer) is worth
+                   compressing, judging by a sample of it.'''
+        sample = block[:self.sample_size]
+        if not sample:
+            return False
+        return len(_codec(self.codec).compress(sample, self.level)) <= self.threshold * len(sample)
+
+    def block_name(self, hex, block):
+        '''@return The name under which to store the block of the given hash.'''
+        if self.compressible(block):
+            return '%s.%s' % (hex, self.codec)
+        return hex
+
+    def compress(self, block):
+        return _codec(self.codec).compress(block, self.level)
+
+def make_compressor(codec, level=None):
+    """
+    @param codec: Name of the codec (e.g., 'zlib'), or 'none'.
+    @param level: Compression level, or None for the default of the codec.
+    @return A Compressor, or None if codec is 'none'.
+    """
+    if codec == 'none':
+        return None
+    return Compressor(codec, level)
+
+def split_name(name):
+    '''@return (hex, codec) of the given block name, codec being None for
+               uncompressed blocks.'''
+    if '.' in name:
+        return tuple(name.split('.', 1))
+    return (name, None)
+
+def decompress(name, data):
+    '''@return The contents of the block of the given name, given the data
+               stored under that name.'''
+    hex, codec = split_name(name)
+    if codec is None:
+        return data
+    return _codec(codec).decompress(data)
+
+def available_codecs():
+    """
+    @return The names of the supported codecs for which the required modules
+            are available.
+    """
+    return sorted(_codecs.keys())
@@ -29,14 +29,25 @@ from __future__ import absolute_import
 from __future__ import with_statement
 
 import errno
+import mmap
 import os
 import os.path
 import shutil
 import stat
+import sys
 import tempfile
 
 import shastity.metadata as metadata
 
+# lseek() whence values locating data and holes in sparse files; not
+# exposed by the os module of python 2, so we provide those of Linux.
+if hasattr(os, 'SEEK_DATA'):
+    _SEEK_DATA, _SEEK_HOLE = os.SEEK_DATA, os.SEEK_HOLE
+elif sys.platform.startswith('linux'):
+    _SEEK_DATA, _SEEK_HOLE = 3, 4
+else:
+    _SEEK_DATA, _SEEK_HOLE = None, None
+
 class StaleTemporaryDirectory(Exception):
     '''Raised to indicate that an attempt to use a stale (cleaned up)
     temporary directory was detected.'''
@@ -105,6 +116,9 @@ class FileSystem(object):
     def symlink(self, src, dst):
         raise NotImplementedError
 
+    def rename(self, src, dst):
+        raise NotImplementedError
+
     def exists(self, path):
         return os.path.exists(path)
 
@@ -114,6 +128,34 @@ class FileSystem(object):
     def fsync(self, fileno):
         raise NotImplementedError
 
+    def mmap(self, path):
+        '''Map the (regular) file at the given path into memory,
+        read-only. The file must not be truncated while mapped; doing
+        so may crash the process upon access.
+
+        @note This method has a default implementation in the abstract
+              base class which does not support mapping.
+
+        @return A read-only mmap-like object (supporting len(), slicing,
+                close() and the buffer interface), or None if the file
+                cannot be mapped by this file system, in which case it
+                is to be read using open().'''
+        return None
+
+    def data_extents(self, path):
+        '''Locate the data of the (regular) file at the given path, as
+        opposed to its holes (which read as zeros, but occupy no
+        storage).
+
+        @note This method has a default implementation in the abstract
+              base class which does not support detecting holes.
+
+        @return A list of (offset, length) of the regions of the file
+                containing data, in order, or None if holes cannot be
+                detected by this file system (in which case the entire
+                file is to be considered data).'''
+        return None
+
     def is_symlink(self, path):
         '''@return Whether the given path is a symlink.'''
         raise NotImplementedError
@@ -179,12 +221,48 @@ class LocalFileSystem(FileSystem):
     def symlink(self, src, dst):
         os.symlink(src, dst)
 
+    def rename(self, src, dst):
+        os.rename(src, dst)
+
     def open(self, path, mode):
         return open(path, mode)
 
     def fsync(self, fileno):
         os.fsync(fileno)
 
+    def mmap(self, path):
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return None # empty files cannot be mapped
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def data_extents(self, path):
+        if _SEEK_DATA is None:
+            return None
+
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            extents = []
+            offset = 0
+            while offset < size:
+                try:
+                    start = os.lseek(fd, offset, _SEEK_DATA)
+                except OSError, e:
+                    if e.errno == errno.ENXIO:
+                        break # nothing but a hole remains
+                    elif e.errno == errno.EINVAL:
+                        return None # not supported by the underlying file system
+                    raise
+                if start >= size:
+                    break
+                end = min(size, os.lseek(fd, start, _SEEK_HOLE))
+                extents.append((start, end - start))
+                offset = end
+            return extents
+        finally:
+            os.close(fd)
+
     def is_symlink(self, path):
         return os.path.islink(path)
 
@@ -442,7 +520,8 @@ class MemoryFile:
         return False
 
     def lstat(self):
-        return self.metadata
+        return metadata.FileMetaData(props=dict(size=len(self.contents)),
+                                     other=self.metadata)
 
 class OpenMode:
     '''Trivial helper to interpret fopen() style modestrings.
@@ -586,16 +665,32 @@ class MemoryFileObject:
         raise NotImplementedError
 
     def seek(self, offset, whence=os.SEEK_SET):
-        raise NotImplementedError
+        if whence == os.SEEK_SET:
+            self.pos = offset
+        elif whence == os.SEEK_CUR:
+            self.pos += offset
+        elif whence == os.SEEK_END:
+            self.pos = len(self.memfile.contents) + offset
+        else:
+            raise IOError(errno.EINVAL, 'invalid whence')
 
     def tell(self):
-        raise NotImplementedError
+        return self.pos
 
-    def truncate(self, size=0):
-        self.memfile.contents = self.memfile.contents[0:size + 1]
+    def truncate(self, size=None):
+        if size is None:
+            size = self.pos
+        contents = self.memfile.contents
+        self.memfile.contents = contents[0:size] + '\0' * (size - len(contents))
 
     def write(self, str):
-        self.memfile.contents = self.memfile.contents[0:self.pos + 1] + str + self.memfile.contents[self.pos + 1:]
+        if self.mode.append_only:
+            self.pos = len(self.memfile.contents)
+        contents = self.memfile.contents
+        if self.pos > len(contents):
+            contents += '\0' * (self.pos - len(contents)) # no sparse file semantics
+        self.memfile.contents = contents[0:self.pos] + str + contents[self.pos + len(str):]
+        self.pos += len(str)
 
     def writelines(self, sequence):
         raise NotImplementedError
@@ -686,6 +781,20 @@ class MemoryFileSystem(FileSystem):
 
         d.symlink(self.__tokenize(src), fname)
 
+    def rename(self, src, dst):
+        sdname, sfname = self.__split_slash_agnostically(src)
+        ddname, dfname = self.__split_slash_agnostically(dst)
+        sd = self.__lookup(sdname)
+        dd = self.__lookup(ddname)
+
+        entry = sd[sfname]
+        if isinstance(entry, MemoryDirectory):
+            raise OSError(errno.EINVAL, 'renaming directories not supported by memory fs')
+        if dfname in dd:
+            dd.unlink(dfname)
+        del(sd.entries[sfname])
+        dd.link(entry, dfname)
+
     def exists(self, path):
         try:
             self.__lookup(path)
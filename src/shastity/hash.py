@@ -8,36 +8,240 @@ a bytestring, which returns a tuple (hash_algo_name,
 hexdigest). make_hasher() is used to construct such a hasher, taking
 the name of a supported hashing algorithm.
 
+Supported algorithms are 'sha512', 'blake2b' (from hashlib where
+available, otherwise requiring the pyblake2 module) and 'blake3'
+(requiring the blake3 module; large inputs are hashed using multiple
+threads). Since manifests record the algorithm of each
+hash, the algorithm may be changed between backups.
+
 Example use::
 
   hasher = make_hasher('sha512')
   hasher('byte string to be hashed')
+
+Data may also be hashed incrementally, using a stream hasher::
+
+  h = make_stream_hasher('sha512')
+  h.update('byte string ')
+  h.update('to be hashed')
+  h.digest() # same as hasher('byte string to be hashed')
 """
 
 from __future__ import absolute_import
 from __future__ import with_statement
 
 import hashlib
+import os
+import time
+
+# optional hash implementations
+if hasattr(hashlib, 'blake2b'):
+    _blake2b = hashlib.blake2b
+else:
+    try:
+        import pyblake2
+        _blake2b = pyblake2.blake2b
+    except ImportError:
+        _blake2b = None
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
 
 class UnsupportedHashAlgorithm(Exception):
     pass
 
 _all_supported_hashlib_algos = [ 'sha1', 'sha224', 'sha256', 'sha384', 'sha512', 'md5' ]
 _our_supported_hashlib_algos = [ 'sha512' ]
+_our_supported_algos = _our_supported_hashlib_algos + [ 'blake2b', 'blake3' ]
 
 def make_hasher(name):
     """
     @name name: Name of hashes (e.g., 'sha512').
     @return a hasher (= callable, byte string -> (hash_name, hash)).
     """
+    return _constructor_hasher(name, _constructor(name))
+
+class StreamHasher(object):
+    '''Hashes data fed to it incrementally.'''
+    def __init__(self, name, h):
+        self.name = name
+        self.__h = h
+
+    def update(self, bstring):
+        self.__h.update(bstring)
+
+    def digest(self):
+        '''@return (hash_name, hash) of all data fed so far, as returned by a hasher.'''
+        return (self.name, self.__h.hexdigest())
+
+def make_stream_hasher(name):
+    """
+    @name name: Name of hashes (e.g., 'sha512').
+    @return A new StreamHasher.
+    """
+    return StreamHasher(name, _constructor(name)())
+
+# Size of the pieces hashed by a PieceHasher.
+PIECE_SIZE = 64*1024
+
+class PieceHasher(object):
+    '''Hashes data fed to it incrementally, like a StreamHasher, except
+    that the result is the hash of the (binary) hashes of consecutive
+    pieces of PIECE_SIZE bytes (the last one possibly shorter), rather
+    than of the data itself. Unlike the latter, it can be computed
+    for separate parts of the data in parallel: a hasher created with
+    the offset of a part hashes the pieces lying entirely within it,
+    and add() combines the parts(), in order, into a hasher of the
+    whole.'''
+    def __init__(self, name, constructor, offset=None):
+        '''
+        @param offset: Offset of the data fed to the hasher within the whole, or
+                       None if it is the whole.
+        '''
+        self.name = name
+        self.__constructor = constructor
+        self.__top = constructor() if offset is None else None
+        self.__hashes = [] # hashes of completed pieces (if a part)
+        self.__head = [] # data preceding the first piece boundary (if a part)
+        self.__head_left = 0 if offset is None else -offset % PIECE_SIZE
+        self.__piece = [] # data of the current piece
+        self.__filled = 0 # bytes of data in __piece
+
+    def update(self, bstring):
+        pos = 0
+        if self.__head_left:
+            n = min(len(bstring), self.__head_left)
+            self.__head.append(str(buffer(bstring, 0, n)))
+            self.__head_left -= n
+            pos = n
+
+        while pos < len(bstring):
+            n = min(len(bstring) - pos, PIECE_SIZE - self.__filled)
+            if n == PIECE_SIZE:
+                # a whole piece; hash it in place
+                self.__add_hash(self.__hash(buffer(bstring, pos, n)))
+            else:
+                self.__piece.append(str(buffer(bstring, pos, n)))
+                self.__filled += n
+                if self.__filled == PIECE_SIZE:
+                    self.__end_piece()
+            pos += n
+
+    def update_zeros(self, length):
+        '''Equivalent to update('\\0' * length), but hashing at most a
+        single piece of zeros.'''
+        n = min(length, (PIECE_SIZE - self.__filled) % PIECE_SIZE + self.__head_left)
+        self.update('\0' * n)
+        length -= n
+
+        if length >= PIECE_SIZE:
+            zero_hash = self.__hash('\0' * PIECE_SIZE)
+            for n in xrange(0, length / PIECE_SIZE):
+                self.__add_hash(zero_hash)
+        self.update('\0' * (length % PIECE_SIZE))
+
+    def parts(self):
+        '''@return The state of a hasher of a part, for add(): a tuple of the data
+                   preceding its first piece boundary, the hashes of the pieces
+                   following it, and the data of the final incomplete piece.'''
+        assert self.__top is None, 'not a part'
+        return (''.join(self.__head), ''.join(self.__hashes), ''.join(self.__piece))
+
+    def add(self, parts):
+        '''Feed the data of a part (see parts()) immediately following the
+        data fed so far.'''
+        head, hashes, tail = parts
+        self.update(head)
+        if hashes:
+            assert self.__filled == 0, 'part not aligned with pieces'
+            self.__top.update(hashes)
+        self.update(tail)
+
+    def digest(self):
+        '''@return (hash_name, hash) of all data fed so far, as returned by a hasher.'''
+        assert self.__top is not None, 'a part has no digest'
+        if self.__filled:
+            top = self.__top.copy()
+            top.update(self.__hash(''.join(self.__piece)))
+        else:
+            top = self.__top
+        return (self.name, top.hexdigest())
+
+    def __hash(self, data):
+        h = self.__constructor()
+        h.update(data)
+        return h.digest()
+
+    def __add_hash(self, piece_hash):
+        if self.__top is None:
+            self.__hashes.append(piece_hash)
+        else:
+            self.__top.update(piece_hash)
+
+    def __end_piece(self):
+        self.__add_hash(self.__hash(''.join(self.__piece)))
+        self.__piece = []
+        self.__filled = 0
+
+def make_piece_hasher(name, offset=None):
+    """
+    @name name: Name of hashes (e.g., 'sha512').
+    @param offset: See PieceHasher.
+    @return A new PieceHasher.
+    """
+    return PieceHasher(name, _constructor(name), offset)
+
+def available_algos():
+    """
+    @return The names of the supported algorithms for which the required modules
+            are available.
+    """
+    available = []
+    for name in _our_supported_algos:
+        try:
+            make_hasher(name)
+            available.append(name)
+        except UnsupportedHashAlgorithm:
+            pass
+    return available
+
+def benchmark(name, size=64*1024*1024, blocksize=1024*1024):
+    """
+    Measure the speed of hashing blocks of data.
+
+    @param name: Name of the algorithm.
+    @param size: Total number of bytes to hash.
+    @param blocksize: Number of bytes per hash.
+    @return Throughput in bytes per second.
+    """
+    hasher = make_hasher(name)
+    block = os.urandom(blocksize)
+    count = max(1, size / blocksize)
+
+    start = time.time()
+    for n in xrange(0, count):
+        hasher(block)
+    elapsed = time.time() - start
+
+    return count * blocksize / max(elapsed, 1e-9)
+
+def _constructor(name):
+    '''@return A callable constructing hashlib style hash objects.'''
     if name in _our_supported_hashlib_algos:
-        return _hashlib_hasher(name)
+        return getattr(hashlib, name)
+    elif name == 'blake2b' and _blake2b is not None:
+        return _blake2b
+    elif name == 'blake3' and blake3 is not None:
+        # AUTO lets blake3 hash large inputs using several threads
+        return lambda: blake3.blake3(max_threads=blake3.blake3.AUTO)
     else:
         raise UnsupportedHashAlgorithm(name)
 
-def _hashlib_hasher(name):
+def _constructor_hasher(name, constructor):
     def hasher(bstring):
-        h = getattr(hashlib, name)()
+        h = constructor()
         h.update(bstring)
         return (name, h.hexdigest())
     return hasher
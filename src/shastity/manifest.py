@@ -18,6 +18,18 @@ ordering is a public interface, and other modules depend on it (e.g.,
 directory creation during materialization, merge comparison for change
 time optimization during persistence).
 
+A manifest may also carry properties (string key/value pairs)
+describing the backup as a whole, such as the chunker used to split
+files into blocks. They are stored as leading '# key: value' lines.
+
+The hashes of a file are (algo, hex) pairs naming its blocks, except
+for zero runs: pairs whose algo is ZERO_ALGO, which stand for a run of
+zero bytes (typically a hole in a sparse file) of the length given in
+place of the hash, and which have no block in backing storage.
+
+An entry may also carry a digest of the entire contents of the file
+(see hash.PieceHasher), as a trailing field.
+
 This module deals with creation/storage/retrieval/deletion of
 individual backup manifests as well as listing available manifests.
 
@@ -39,7 +51,18 @@ import shastity.spencode as spencode
 
 log = logging.get_logger(__name__)
 
-def write_manifest(backend, name, entry_generator):
+ZERO_ALGO = 'zero'
+
+def zero_run(length):
+    '''@return The (algo, hex) pair standing for length zero bytes.'''
+    return (ZERO_ALGO, str(length))
+
+def is_zero_run(algohash):
+    '''@return Whether the given (algo, hex) pair is a zero run rather than
+               the name of a block.'''
+    return algohash[0] == ZERO_ALGO
+
+def write_manifest(backend, name, entry_generator, properties=None, digests=None):
     """
     @param backend A storage backend (dedicated to manifests)
 
@@ -48,11 +71,22 @@ def write_manifest(backend, name, entry_generator):
     
     @param entry_generator Backup entry generator producting all entries, in order, for inclusion
                            in the manifest.
+
+    @param properties Dict of manifest properties (strings, keys must not contain
+                      colons or newlines, values must not contain newlines), if any.
+
+    @param digests Dict of path to the (algo, hex) digest of the contents of the file,
+                   for those entries having one, if any. Looked up as entries are
+                   generated.
     """
     assert '.' not in name, 'manifest names cannot contain dots'
 
     mf_lines = []
 
+    for key, value in sorted((properties or dict()).items()):
+        assert ':' not in key and '\n' not in key + value, 'invalid manifest property %s' % (key,)
+        mf_lines.append('# %s: %s' % (key, value))
+
     for (path, metadata, hashes) in entry_generator:
         md = metadata.to_string()
 
@@ -60,7 +94,10 @@ def write_manifest(backend, name, entry_generator):
 
         rest = ' '.join([ '%s,%s' % (algo, hex) for (algo, hex) in hashes ])
 
-        mf_lines.append('%s | %s | %s' % (md, pth, rest))
+        if digests is not None and path in digests:
+            mf_lines.append('%s | %s | %s | %s,%s' % ((md, pth, rest) + tuple(digests[path])))
+        else:
+            mf_lines.append('%s | %s | %s' % (md, pth, rest))
 
     backend.put(name, '\n'.join(mf_lines))
 
@@ -74,7 +111,10 @@ def read_manifest(backend, name):
     mf_lines = [ line.strip() for line in backend.get(name).split('\n') ]
 
     for line in mf_lines:
-        (md, path, rest) = [ s.strip() for s in line.split('|') ]
+        if line.startswith('#'):
+            continue
+
+        (md, path, rest) = [ s.strip() for s in line.split('|') ][0:3]
 
         md = metadata.FileMetaData.from_string(md)
         path = spencode.spdecode(path)
@@ -86,6 +126,39 @@ def read_manifest(backend, name):
 
         yield (path, md, rest)
 
+def read_manifest_properties(backend, name):
+    """
+    @return A dict of the properties of the manifest.
+    """
+    assert '.' not in name, 'manifest names cannot contain dots'
+
+    props = dict()
+    for line in backend.get(name).split('\n'):
+        if not line.startswith('#'):
+            break
+        key, value = line[1:].split(':', 1)
+        props[key.strip()] = value.strip()
+
+    return props
+
+def read_manifest_digests(backend, name):
+    """
+    @return A dict of path to the (algo, hex) digest of the contents of the file,
+            for those entries of the manifest having one.
+    """
+    assert '.' not in name, 'manifest names cannot contain dots'
+
+    digests = dict()
+    for line in backend.get(name).split('\n'):
+        if line.startswith('#'):
+            continue
+
+        fields = [ s.strip() for s in line.split('|') ]
+        if len(fields) > 3:
+            digests[spencode.spdecode(fields[1])] = tuple(fields[3].split(','))
+
+    return digests
+
 def delete_manifest(backend, name):
     """
     @param backend Storage backend from which to delete the manifest
@@ -10,20 +10,355 @@ system.
 from __future__ import absolute_import
 from __future__ import with_statement
 
+import collections
+import os
 import os.path
+import tempfile
 import threading
+import time
+import traceback
 
+import shastity.chunking as chunking
+import shastity.compression as compression
 import shastity.filesystem as filesystem
+import shastity.hash as hash
 import shastity.logging as logging
+import shastity.manifest as manifest
 import shastity.storagequeue as storagequeue
 import shastity.util as util
 
 log = logging.get_logger(__name__)
 
+DEFAULT_MAX_OPEN_FILES = 64
+
+# Seconds between checks for failure while waiting to open a file.
+_FAILURE_POLL_INTERVAL = 0.1
+
 class DestinationPathNotDirectory(Exception):
     pass
 
-def materialize(fs, destpath, entryiter, sq):
+class BlockOffsetsUnknown(Exception):
+    '''Raised when restoring in delta mode a backup made with content
+    defined chunking, whose blocks have no fixed offsets.'''
+    pass
+
+class WriteFailed(Exception):
+    '''Raised when writing restored blocks to a file failed.'''
+    pass
+
+class MaterializationStats(object):
+    '''Counters describing the buffering of blocks by materialize(),
+    for sizing its reorder buffer and block cache.
+
+    @ivar blocks_parked         Blocks which arrived before the blocks preceding them,
+                                and were parked until those had been written.
+    @ivar bytes_parked          Size of the parked blocks.
+    @ivar peak_parked_bytes     Maximum number of bytes parked in memory at any one time.
+    @ivar bytes_spilled         Size of the parked blocks spilled to a temporary file,
+                                the budget of the reorder buffer being exhausted.
+    @ivar stall_time            Seconds the writer spent idle waiting for the next block
+                                of a file while later blocks were parked.
+    @ivar gets_saved            References to blocks served without a GET of their own,
+                                the block being fetched, or cached, already.
+    @ivar peak_cached_bytes     Maximum number of bytes of blocks held by the block cache
+                                at any one time.
+    @ivar blocks_reused         Blocks (including zero runs) found intact in files being
+                                restored over, in delta mode, and so not fetched.
+    @ivar bytes_reused          Size of the reused blocks.
+    '''
+    def __init__(self):
+        self.blocks_parked = 0
+        self.bytes_parked = 0
+        self.peak_parked_bytes = 0
+        self.bytes_spilled = 0
+        self.stall_time = 0.0
+        self.gets_saved = 0
+        self.peak_cached_bytes = 0
+        self.blocks_reused = 0
+        self.bytes_reused = 0
+
+    def __str__(self):
+        return ('%d blocks parked (%d bytes, peak %d in memory, %d spilled); writer stalled %.1f seconds; '
+                '%d GETs saved (peak %d bytes cached); %d blocks reused (%d bytes)'
+                '' % (self.blocks_parked,
+                      self.bytes_parked,
+                      self.peak_parked_bytes,
+                      self.bytes_spilled,
+                      self.stall_time,
+                      self.gets_saved,
+                      self.peak_cached_bytes,
+                      self.blocks_reused,
+                      self.bytes_reused))
+
+class _ReorderBuffer(object):
+    '''Hands the blocks delivered to GET callbacks to a dedicated
+    writer thread, which writes the blocks of each file in order, so
+    that callbacks never wait for other blocks. Blocks arriving
+    before those preceding them are parked in memory, up to a budget,
+    beyond which they are spilled to a temporary file.'''
+    def __init__(self, budget, stats):
+        '''
+        @param budget: Maximum number of bytes of blocks parked in memory.
+        @param stats: MaterializationStats to update.
+        '''
+        self.__budget = budget
+        self.__stats = stats
+
+        # __cond protects everything but the spill file, which is
+        # protected by __spill_lock. It is signalled when a block is
+        # ready for writing, when a block has been written, and upon
+        # close().
+        self.__cond = threading.Condition()
+        self.__pending = dict() # file -> deque of the numbers of its blocks yet to be written
+        self.__parked = dict() # (file, block number) -> block, or (offset, length) in the spill file
+        self.__ready = collections.deque() # (file, block number) to be written, in order per file
+        self.__parked_bytes = 0 # in memory
+        self.__closed = False
+        self.__error = None
+
+        self.__spill = None # created when first needed
+        self.__spill_lock = threading.Lock()
+
+        self.__thread = threading.Thread(target=self.__main, name='materialization-writer')
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+
+    def add_file(self, m13n, blocknums):
+        '''Register a file, whose write_block(bytestr, block_num) is to be called
+        for the given block numbers, in order.'''
+        if blocknums:
+            with self.__cond:
+                self.__pending[m13n] = collections.deque(blocknums)
+
+    def put(self, m13n, block_num, bytestr):
+        '''Accept a block of a file for writing, without waiting for any
+        other block.'''
+        with self.__cond:
+            next_in_line = self.__pending[m13n][0] == block_num
+            spill = not next_in_line and self.__parked_bytes + len(bytestr) > self.__budget
+            if not spill:
+                self.__parked_bytes += len(bytestr)
+                self.__stats.peak_parked_bytes = max(self.__stats.peak_parked_bytes, self.__parked_bytes)
+
+        if spill:
+            entry = self.__spill_write(bytestr)
+        else:
+            entry = bytestr
+
+        with self.__cond:
+            self.__parked[(m13n, block_num)] = entry
+            if self.__pending[m13n][0] == block_num:
+                self.__ready.append((m13n, block_num))
+                self.__cond.notifyAll()
+            else:
+                self.__stats.blocks_parked += 1
+                self.__stats.bytes_parked += len(bytestr)
+                if spill:
+                    self.__stats.bytes_spilled += len(bytestr)
+
+    def has_failed(self):
+        '''@return Whether writing a block has failed.'''
+        with self.__cond:
+            return self.__error is not None
+
+    def close(self, wait=True):
+        '''Stop the writer, once all blocks of all files have been written
+        if wait is True.'''
+        with self.__cond:
+            while wait and self.__pending and self.__error is None:
+                self.__cond.wait()
+            self.__closed = True
+            self.__cond.notifyAll()
+        self.__thread.join()
+
+        if self.__spill is not None:
+            self.__spill.close()
+        if self.__error is not None:
+            raise WriteFailed(self.__error)
+
+    def __main(self):
+        while True:
+            with self.__cond:
+                while not self.__ready and not self.__closed:
+                    stalled = bool(self.__parked)
+                    before = time.time()
+                    self.__cond.wait()
+                    if stalled:
+                        self.__stats.stall_time += time.time() - before
+                if not self.__ready:
+                    break # closed
+
+                m13n, block_num = self.__ready.popleft()
+                entry = self.__parked.pop((m13n, block_num))
+
+            try:
+                if isinstance(entry, str):
+                    bytestr = entry
+                else:
+                    bytestr = self.__spill_read(*entry)
+                m13n.write_block(bytestr, block_num)
+            except Exception:
+                log.error('writing block %d failed: %s', block_num, traceback.format_exc())
+                with self.__cond:
+                    if self.__error is None:
+                        self.__error = traceback.format_exc()
+
+            with self.__cond:
+                if isinstance(entry, str):
+                    self.__parked_bytes -= len(entry)
+
+                blocknums = self.__pending[m13n]
+                blocknums.popleft()
+                if not blocknums:
+                    del self.__pending[m13n]
+                elif (m13n, blocknums[0]) in self.__parked:
+                    self.__ready.append((m13n, blocknums[0]))
+                self.__cond.notifyAll()
+
+    def __spill_write(self, bytestr):
+        '''@return (offset, length) of bytestr, appended to the spill file.'''
+        # Spilled blocks are not reclaimed before close(); spilling is
+        # meant to be the exception.
+        with self.__spill_lock:
+            if self.__spill is None:
+                self.__spill = tempfile.TemporaryFile(prefix='shastity-spill-')
+            self.__spill.seek(0, os.SEEK_END)
+            offset = self.__spill.tell()
+            self.__spill.write(bytestr)
+            return (offset, len(bytestr))
+
+    def __spill_read(self, offset, length):
+        with self.__spill_lock:
+            self.__spill.seek(offset)
+            return self.__spill.read(length)
+
+class _Slots(object):
+    '''A semaphore counting the files being restored at once. Unlike
+    threading.Semaphore, waiting for a slot gives up once the restore
+    has failed, since a file whose blocks were never delivered never
+    gives its slot back.'''
+    def __init__(self, count, failed):
+        '''
+        @param count: Number of slots.
+        @param failed: Callable returning whether the restore has failed.
+        '''
+        self.__free = count
+        self.__failed = failed
+        self.__cond = threading.Condition()
+
+    def acquire(self, blocking):
+        '''@return Whether a slot was acquired; False if none is free and
+                   blocking is False, or once the restore has failed.'''
+        with self.__cond:
+            while not self.__free:
+                if not blocking or self.__failed():
+                    return False
+                self.__cond.wait(_FAILURE_POLL_INTERVAL)
+            self.__free -= 1
+            return True
+
+    def release(self):
+        with self.__cond:
+            self.__free += 1
+            self.__cond.notify()
+
+class _BlockCache(object):
+    '''Fetches each block referenced by a restore once, however many
+    times it is referenced. References to a block being fetched wait
+    for the GET in flight, and the block is then kept in memory for
+    references yet to come, up to a budget. Blocks not fitting the
+    budget are fetched again when next referenced.
+
+    Blocks are handed to writers as soon as they are available, which
+    may be in the thread requesting them; writers must therefore never
+    wait for other blocks.'''
+    def __init__(self, budget, refs, stats):
+        '''
+        @param budget: Maximum number of bytes of blocks kept in memory.
+        @param refs: Dict mapping block names to the number of references to them.
+        @param stats: MaterializationStats to update.
+        '''
+        self.__budget = budget
+        self.__stats = stats
+
+        self.__lock = threading.Lock()
+        self.__refs = dict(refs) # block name -> references not yet requested
+        self.__waiting = dict() # block name -> writers waiting for the GET in flight
+        self.__cached = dict() # block name -> block
+        self.__cached_bytes = 0
+
+    def request(self, blockname, write, size_hint):
+        '''Arrange for write(block) to be called with the (decompressed)
+        block of the given name.
+
+        @return A GetOperation to enqueue, or None if the block is being
+                fetched, or is cached, already.'''
+        with self.__lock:
+            self.__refs[blockname] -= 1
+            if blockname in self.__waiting:
+                self.__waiting[blockname].append(write)
+                self.__stats.gets_saved += 1
+                return None
+            block = self.__cached.get(blockname)
+            if block is None:
+                self.__waiting[blockname] = [ write ]
+                return storagequeue.GetOperation(name=blockname,
+                                                 callback=util.bind(self.__arrived, blockname),
+                                                 size_hint=size_hint)
+            if not self.__refs[blockname]:
+                del self.__cached[blockname]
+                self.__cached_bytes -= len(block)
+            self.__stats.gets_saved += 1
+
+        write(block)
+        return None
+
+    def skip(self, blockname):
+        '''Drop a reference to the block of the given name, which is not
+        to be requested.'''
+        with self.__lock:
+            self.__refs[blockname] -= 1
+            if not self.__refs[blockname] and blockname in self.__cached:
+                self.__cached_bytes -= len(self.__cached.pop(blockname))
+
+    def __arrived(self, blockname, bstr):
+        block = compression.decompress(blockname, bstr)
+        with self.__lock:
+            writes = self.__waiting.pop(blockname)
+            if self.__refs[blockname] and self.__cached_bytes + len(block) <= self.__budget:
+                self.__cached[blockname] = block
+                self.__cached_bytes += len(block)
+                self.__stats.peak_cached_bytes = max(self.__stats.peak_cached_bytes, self.__cached_bytes)
+
+        for write in writes:
+            write(block)
+
+def _intact(f, offset, length, algohash):
+    '''@return Whether the length bytes of the file at offset are those
+               of the block of the given (algo, name) (or zero run).'''
+    f.seek(offset)
+    if manifest.is_zero_run(algohash):
+        while length > 0:
+            piece = f.read(min(length, chunking.DEFAULT_PIECE_SIZE))
+            if not piece or piece.lstrip('\0'):
+                return False
+            length -= len(piece)
+        return True
+
+    algo, blockname = algohash
+    data = f.read(length)
+    return (len(data) == length
+            and hash.make_hasher(algo)(data)[1] == compression.split_name(blockname)[0])
+
+def _write_zeros(f, offset, length):
+    f.seek(offset)
+    while length > 0:
+        n = min(length, chunking.DEFAULT_PIECE_SIZE)
+        f.write('\0' * n)
+        length -= n
+
+def materialize(fs, destpath, entryiter, sq, blocksize=None, reorder_budget=None, stats=None,
+                max_open_files=DEFAULT_MAX_OPEN_FILES, cache_budget=None, delta=False):
     '''
     @type fs FileSystem instance.
     @param fs File system into which to materialize the stream.
@@ -36,9 +371,33 @@ def materialize(fs, destpath, entryiter, sq):
     @type sq StorageQueue
     @param sq Storage queue via which to perform read operations necessary in
               order to populate the tree.
+
+    @param blocksize If given, the size of all blocks but the last of each file (as is
+                     the case with a FixedSizeChunker), meaning that the offset of each
+                     block is known up-front. Blocks are then written at their offsets
+                     as soon as they arrive, rather than in order (see below).
+
+    @param reorder_budget If given (and blocksize is not), blocks are written in order by
+                          a dedicated thread rather than by the callbacks of GET operations
+                          (see below), parking up to this many bytes of blocks arriving
+                          early in memory.
+
+    @type stats MaterializationStats
+    @param stats MaterializationStats to update, or None.
+
+    @param max_open_files The maximum number of files being restored at any one time.
+
+    @param cache_budget If given (and either blocksize or reorder_budget is), each block
+                        is fetched once however many times it is referenced, keeping up
+                        to this many bytes of blocks in memory for the references yet
+                        to be restored (see below).
+
+    @param delta If True (requiring blocksize), restore over the files already present,
+                 in place, fetching only the blocks which differ from their contents.
+                 Existing directories are kept, as are files not in the stream.
     '''
-    # We traverse the list in order, thus ensuring that directories
-    # are created prior to their contents. However, we also want to
+    # We create all directories first, in order, thus ensuring that
+    # they are created prior to their contents. However, we also want to
     # make sure that concurrency in the storage backend can be
     # utilized, so we submit multiple requests concurrently to
     # whatever extent possible, relying on the storage queue to block
@@ -67,23 +426,65 @@ def materialize(fs, destpath, entryiter, sq):
     # We accomplish this by creating a FileMaterialization instance
     # for each file that we are restoring, which is the
     # synchronization point for the callbacks.
+    #
+    # The cost of this is that a single slow block holds up all
+    # callbacks of blocks following it, and with them the workers of
+    # the storage queue, capping restore throughput. Where block
+    # offsets are known (see the blocksize parameter), a
+    # PositionalFileMaterialization is used instead, which writes
+    # each block at its offset as soon as it arrives, into a
+    # temporary file that is renamed into place once complete. Thus
+    # no file is ever seen with only parts of it restored.
+    #
+    # Otherwise, given a reorder budget, callbacks hand their blocks
+    # to a _ReorderBuffer, whose writer thread (rather than the
+    # callbacks) waits for blocks to arrive in order. Memory use is
+    # then bounded by the budget, rather than by callbacks holding
+    # on to their blocks.
+    #
+    # Zero runs (holes of sparse files, and blocks of zeros) are not
+    # fetched; they are skipped over in sequence, by seeking past
+    # them, so that they become holes again.
+    #
+    # Given a cache budget, blocks referenced more than once (copies
+    # of files, or of parts of them) are fetched by a _BlockCache,
+    # which serves all references from a single GET. As it may hand
+    # a block to a writer in the main thread, this requires writes
+    # that never wait for other blocks, i.e. positional writes or a
+    # reorder buffer. Otherwise only references to blocks with GETs
+    # outstanding are served by one GET (by the storage queue, see
+    # StorageOperation.coalesces_with()).
+    #
+    # In delta mode, files already present are read block by block
+    # (which requires known offsets), and only the blocks whose hashes
+    # differ from those of the manifest are fetched, and written in
+    # place. Unlike elsewhere, files are then seen partially restored
+    # until complete; a rollback is expected to differ in few blocks.
 
     class FileMaterialization:
         """
-        TODO: Handle I/O errors (propagate to callers of write_block).
+        Should writing fail, the file is closed (see on_close) and the
+        error raised to the caller of write_block, as it is to callers
+        writing later blocks.
         """
-        def __init__(self, fname, totblocks, fobj):
+        def __init__(self, fname, totblocks, fobj, zeros, on_close):
             """
             @param fname: File name being materialized.
-            @param totblocks: Total number of expected blocks.
+            @param totblocks: Total number of expected blocks (including zero runs).
             @param fobj: File object to which to write blocks.
+            @param zeros: Dict mapping the block numbers of zero runs to their lengths.
+            @param on_close: Called once the file is closed, complete or failed.
             """
             self.__fname = fname
             self.__totblocks = totblocks
             self.__fobj = fobj
+            self.__zeros = zeros
+            self.__on_close = on_close
 
             self.__cond = threading.Condition()
             self.__last_block = -1 # last block written, -1 if no block written
+            self.__failed = False
+            self.__closed = False
 
         def write_block(self, bytestr, block_num):
             """
@@ -94,60 +495,325 @@ def materialize(fs, destpath, entryiter, sq):
             @param block_num: The block number (first block is 0).
             """
             with self.__cond:
-                while self.__last_block != block_num - 1:
+                while self.__last_block != block_num - 1 and not self.__failed:
                     self.__cond.wait()
+                if self.__failed:
+                    raise WriteFailed('an earlier block of %s could not be written' % (self.__fname,))
 
             assert self.__last_block == block_num - 1
 
             log.info('materializing block %d of file %s', block_num, self.__fname)
-            self.__fobj.write(bytestr)
+            try:
+                self.__fobj.write(bytestr)
 
-            with self.__cond:
+                with self.__cond:
+                    self.__last_block += 1
+                    assert self.__last_block == block_num
+                    self.__skip_zeros()
+                    self.__cond.notifyAll() # not terribly efficient
+            except Exception:
+                self.__fail()
+                raise
+
+        def start(self):
+            """
+            Skips any leading zero runs, completing the file if there
+            is nothing else to it. Must be called before any block is
+            written.
+            """
+            try:
+                with self.__cond:
+                    self.__skip_zeros()
+            except Exception:
+                self.__fail()
+                raise
+
+        def __skip_zeros(self):
+            # called with __cond held
+            while self.__last_block + 1 in self.__zeros:
                 self.__last_block += 1
-                assert self.__last_block == block_num
-                self.__cond.notifyAll() # not terribly efficient
+                self.__fobj.seek(self.__zeros[self.__last_block], os.SEEK_CUR)
 
-                if block_num == self.__totblocks - 1:
-                    log.debug('fsync():ing after final block of %s', self.__fname)
-                    self.__fobj.flush()
-                    # todo: always, or optionally based on settings, delay fsync
-                    # in order to avoid overhead.
-                    fs.fsync(self.__fobj.fileno())
-                    self.__fobj.close()
+            if self.__last_block == self.__totblocks - 1:
+                # extends the file if it ends with a zero run
+                self.__fobj.truncate()
+
+                log.debug('fsync():ing after final block of %s', self.__fname)
+                self.__fobj.flush()
+                # todo: always, or optionally based on settings, delay fsync
+                # in order to avoid overhead.
+                fs.fsync(self.__fobj.fileno())
+                self.__close()
+
+        def __fail(self):
+            with self.__cond:
+                self.__failed = True
+                self.__cond.notifyAll()
+                if self.__closed:
+                    return
+            self.__close()
+
+        def __close(self):
+            # called once, upon completion or failure
+            self.__closed = True
+            try:
+                self.__fobj.close()
+            finally:
+                self.__on_close()
+
+    class PositionalFileMaterialization:
+        """
+        Should writing fail, the file is closed (see on_close) and the
+        error raised to the caller of write_block; later blocks are
+        not written.
+        """
+        def __init__(self, fname, tmpname, offsets, blocknums, end, fobj, on_close):
+            """
+            @param fname: File name being materialized.
+            @param tmpname: Temporary file name being written, to be renamed to fname,
+                            or None if fname is written in place.
+            @param offsets: The offset of each block (including zero runs).
+            @param blocknums: The numbers of the blocks to be written (excluding zero runs).
+            @param end: The size of the file, if known (because it ends with a zero run,
+                        or it is restored in place).
+            @param fobj: File object to which to write blocks.
+            @param on_close: Called once the file is closed, complete (and renamed)
+                             or failed.
+            """
+            self.__fname = fname
+            self.__tmpname = tmpname
+            self.__offsets = offsets
+            self.__end = end
+            self.__fobj = fobj
+            self.__on_close = on_close
+
+            # python 2 lacks pwrite(); the lock makes seek() and
+            # write() act as one
+            self.__lock = threading.Lock()
+            self.__pending = set(blocknums)
+            self.__closed = False
+
+        def write_block(self, bytestr, block_num):
+            """
+            Writes the block at its offset, without waiting for any other block.
+
+            @param bytestr: Byte string to write to file.
+            @param block_num: The block number (first block is 0).
+            """
+            log.info('materializing block %d of file %s', block_num, self.__fname)
+            try:
+                with self.__lock:
+                    if self.__closed:
+                        raise WriteFailed('another block of %s could not be written' % (self.__fname,))
+                    self.__fobj.seek(self.__offsets[block_num])
+                    self.__fobj.write(bytestr)
+                    self.__pending.remove(block_num)
+                    done = not self.__pending
+
+                if done:
+                    self.__finish()
+            except Exception:
+                self.__fail()
+                raise
+
+        def start(self):
+            """
+            Completes the file if there are no blocks to be written.
+            """
+            if not self.__pending:
+                try:
+                    self.__finish()
+                except Exception:
+                    self.__fail()
+                    raise
+
+        def __finish(self):
+            if self.__end is not None:
+                self.__fobj.truncate(self.__end)
+
+            log.debug('fsync():ing after final block of %s', self.__fname)
+            self.__fobj.flush()
+            fs.fsync(self.__fobj.fileno())
+            self.__close()
+            if self.__tmpname is not None:
+                fs.rename(self.__tmpname, self.__fname)
+
+        def __fail(self):
+            with self.__lock:
+                if self.__closed:
+                    return
+            self.__close()
+
+        def __close(self):
+            # called once, upon completion or failure
+            with self.__lock:
+                self.__closed = True
+            try:
+                self.__fobj.close()
+            finally:
+                self.__on_close()
 
     if not fs.is_dir(destpath):
         raise DestinationPathNotDirectory(destpath)
 
-    curdir = None
-    for path, metadata, hashes in entryiter:
-        local_path = os.path.join(destpath, path)
+    assert blocksize is not None or not delta, 'delta restore requires known block offsets'
+
+    if stats is None:
+        stats = MaterializationStats()
+    if blocksize is None and reorder_budget is not None:
+        reorder = _ReorderBuffer(reorder_budget, stats)
+    else:
+        reorder = None
 
-        log.info('materializing [%s]', path)
+    completed = False
+    try:
+        # Directories are created up-front, in order, prior to any of
+        # their contents. Files are restored by fewest blocks first
+        # (otherwise in order), keeping up to max_open_files open at
+        # once; the GETs of open files are enqueued round-robin, so
+        # that runs of small files keep the storage queue busy, and
+        # large files are streamed in parallel.
+        files = []
+        for path, metadata, hashes in entryiter:
+            local_path = os.path.join(destpath, path)
 
-        assert not path.startswith('/')
+            assert not path.startswith('/')
 
-        if metadata.is_directory:
-            fs.mkdir(local_path)
-            # TODO: fix perms
-            curdir = path
+            if metadata.is_directory:
+                log.info('materializing [%s]', path)
+                if not (delta and fs.is_dir(local_path)):
+                    fs.mkdir(local_path)
+                # TODO: fix perms
+            else:
+                files.append((path, local_path, metadata, hashes))
+        files.sort(key=lambda f: len(f[3]))
+
+        if cache_budget is not None and (blocksize is not None or reorder is not None):
+            refs = collections.defaultdict(int)
+            for path, local_path, metadata, hashes in files:
+                for algohash in hashes:
+                    if not manifest.is_zero_run(algohash):
+                        refs[algohash[1]] += 1
+            cache = _BlockCache(cache_budget, refs, stats)
         else:
-            # TODO: figure out why these needed to be commented out,
-            # and whether they should be removed or not.
-            #assert curdir is not None, 'no curdir - first entry not directory?'
-            #assert path.startswith(curdir), ('%s does not start with %s - out of order?'
-            #                                 '' % (path, curdir))
-            f = fs.open(local_path, 'w')
+            cache = None
+
+        def failed():
+            return sq.has_failed() or (reorder is not None and reorder.has_failed())
+
+        # released as files are closed
+        slots = _Slots(max_open_files, failed)
+
+        def begin(path, local_path, metadata, hashes):
+            '''Open the file and return the GETs restoring it.'''
+            log.info('materializing [%s]', path)
+
             # TODO: fix perms before any writing happens
             # TODO: and remember to optionally fsync to avoid security vuln in case
             #       of crash and out-of-order writes.
-            m13n = FileMaterialization(fname=local_path,
-                                       totblocks=len(hashes),
-                                       fobj=f)
-            blocknames = [ algohash[1] for algohash in hashes ]
-
-            ops = [ storagequeue.GetOperation(name=blockname,
-                                              callback=util.bind(lambda m13n, block_num, bstr: m13n.write_block(bstr, block_num), m13n, block_num))
-                    for block_num, blockname in enumerate(blocknames) ]
-            for op in ops:
-                sq.enqueue(op)
-    sq.wait()
+            zeros = dict([ (block_num, int(algohash[1]))
+                           for block_num, algohash in enumerate(hashes)
+                           if manifest.is_zero_run(algohash) ])
+            blocknames = [ (block_num, algohash[1])
+                           for block_num, algohash in enumerate(hashes)
+                           if block_num not in zeros ]
+            if blocksize is None:
+                m13n = FileMaterialization(fname=local_path,
+                                           totblocks=len(hashes),
+                                           fobj=fs.open(local_path, 'w'),
+                                           zeros=zeros,
+                                           on_close=slots.release)
+            else:
+                offsets = []
+                end = 0
+                for block_num in xrange(0, len(hashes)):
+                    offsets.append(end)
+                    end += zeros.get(block_num, blocksize)
+                if delta and fs.exists(local_path) and not (fs.is_dir(local_path) or fs.is_symlink(local_path)):
+                    tmpname = None
+                    fobj = fs.open(local_path, 'r+')
+                    end = metadata.size
+                    wanted = set([ block_num for block_num, blockname in blocknames ])
+                    for block_num, algohash in enumerate(hashes):
+                        length = min(offsets[block_num] + zeros.get(block_num, blocksize), end) - offsets[block_num]
+                        if _intact(fobj, offsets[block_num], length, algohash):
+                            stats.blocks_reused += 1
+                            stats.bytes_reused += length
+                            wanted.discard(block_num)
+                            if cache is not None and block_num not in zeros:
+                                cache.skip(algohash[1])
+                        elif block_num in zeros:
+                            _write_zeros(fobj, offsets[block_num], length)
+                    blocknames = [ (block_num, blockname) for block_num, blockname in blocknames
+                                   if block_num in wanted ]
+                else:
+                    tmpname = os.path.join(os.path.dirname(local_path),
+                                           '.shastity-partial.' + os.path.basename(local_path))
+                    fobj = fs.open(tmpname, 'w')
+                    if (len(hashes) - 1) not in zeros:
+                        end = None
+                m13n = PositionalFileMaterialization(fname=local_path,
+                                                     tmpname=tmpname,
+                                                     offsets=offsets,
+                                                     blocknums=[ block_num for block_num, blockname in blocknames ],
+                                                     end=end,
+                                                     fobj=fobj,
+                                                     on_close=slots.release)
+            m13n.start()
+            if reorder is not None:
+                reorder.add_file(m13n, [ block_num for block_num, blockname in blocknames ])
+                write_block = reorder.put
+            else:
+                write_block = lambda m13n, block_num, bstr: m13n.write_block(bstr, block_num)
+            # The manifest does not record block sizes, but the size
+            # of the data of the file divided over its blocks is a
+            # good enough hint for the storage queue to pick a size
+            # class.
+            datasize = max(0, metadata.size - sum(zeros.values()))
+            datablocks = len(hashes) - len(zeros)
+            size_hint = (datasize + datablocks - 1) // datablocks if datablocks else 0
+
+            if cache is not None:
+                # generated lazily, so that blocks are looked up in the
+                # cache when their turn comes
+                ops = ( cache.request(blockname, util.bind(write_block, m13n, block_num), size_hint)
+                        for block_num, blockname in blocknames )
+                return ( op for op in ops if op is not None )
+
+            def fetched(block_num, blockname, bstr):
+                write_block(m13n, block_num, compression.decompress(blockname, bstr))
+
+            return [ storagequeue.GetOperation(name=blockname,
+                                               callback=util.bind(fetched, block_num, blockname),
+                                               size_hint=size_hint)
+                     for block_num, blockname in blocknames ]
+
+        files = collections.deque(files)
+        active = collections.deque() # iterators over the GETs not yet enqueued, of open files
+        while (files or active) and not failed():
+            # Open files while there are slots to spare, waiting for
+            # one only if there is nothing else to do (as the files
+            # open may not be closed until their GETs are enqueued).
+            while files and slots.acquire(not active):
+                active.append(iter(begin(*files.popleft())))
+
+            if active:
+                ops = active.popleft()
+                for op in ops:
+                    sq.enqueue(op)
+                    active.append(ops)
+                    break
+
+        # Rather than wait() for operations which may never complete
+        # (e.g. callbacks waiting for blocks never to be written), we
+        # raise right away. A failure of the reorder buffer is raised
+        # by close() below.
+        if sq.has_failed():
+            raise storagequeue.OperationHasFailed('one or more operations failed')
+        if reorder is None or not reorder.has_failed():
+            sq.wait()
+            completed = True
+    finally:
+        if reorder is not None:
+            # must not wait for blocks which are never to arrive
+            reorder.close(wait=completed)
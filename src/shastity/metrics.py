@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 Peter Schuller <peter.schuller@infidyne.com>
+
+"""
+Light-weight metrics: latency histograms, and periodic sampling of
+metrics to a file.
+
+Metrics are plain dicts (of numbers, strings, lists and dicts) so
+that they can be dumped as JSON; see dump().
+"""
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import json
+import math
+import threading
+import time
+
+import shastity.logging as logging
+
+log = logging.get_logger(__name__)
+
+# Number of linear sub-buckets per power of two. The relative error
+# of a recorded value is at most 1/SUB_BUCKETS.
+SUB_BUCKETS = 16
+
+class Histogram(object):
+    '''A histogram of non-negative values with logarithmic bucketing
+    in the style of HdrHistogram: each power of two is divided into
+    SUB_BUCKETS linear buckets, giving a bounded relative error at a
+    memory cost that is independent of the number of values
+    recorded.
+
+    Values are recorded as integers in units of the given
+    resolution (e.g. microseconds for latencies in seconds).
+
+    Not thread-safe; callers must provide their own locking.'''
+    def __init__(self, resolution=1e-6):
+        '''
+        @param resolution: The smallest distinguishable value.
+        '''
+        self.resolution = resolution
+
+        self.__counts = dict() # bucket index -> count
+        self.__count = 0
+        self.__sum = 0.0
+        self.__min = None
+        self.__max = None
+
+    def record(self, value):
+        '''Record a value.'''
+        self.__count += 1
+        self.__sum += value
+        self.__min = value if self.__min is None else min(self.__min, value)
+        self.__max = value if self.__max is None else max(self.__max, value)
+
+        index = self.__index(int(value / self.resolution))
+        self.__counts[index] = self.__counts.get(index, 0) + 1
+
+    def count(self):
+        return self.__count
+
+    def mean(self):
+        return (self.__sum / self.__count) if self.__count else 0.0
+
+    def percentile(self, p):
+        '''@return The (upper bound of the bucket of the) value below
+                   which p percent of recorded values fall, or 0.0 if
+                   no values have been recorded.'''
+        if not self.__count:
+            return 0.0
+
+        rank = max(1, int(math.ceil(self.__count * p / 100.0)))
+        seen = 0
+        for index in sorted(self.__counts.iterkeys()):
+            seen += self.__counts[index]
+            if seen >= rank:
+                return min(self.__max, self.__upper(index) * self.resolution)
+
+        assert False, 'rank beyond count'
+
+    def to_dict(self):
+        '''@return A summary of the histogram suitable for dumping.'''
+        return dict(count=self.__count,
+                    min=self.__min or 0.0,
+                    max=self.__max or 0.0,
+                    mean=self.mean(),
+                    p50=self.percentile(50),
+                    p90=self.percentile(90),
+                    p99=self.percentile(99),
+                    p999=self.percentile(99.9))
+
+    def __index(self, n):
+        if n < SUB_BUCKETS:
+            return n
+        exp = int(math.log(n, 2)) - int(math.log(SUB_BUCKETS, 2))
+        while (n >> exp) >= 2 * SUB_BUCKETS: # guard against rounding in log()
+            exp += 1
+        while (n >> exp) < SUB_BUCKETS:
+            exp -= 1
+        return (exp + 1) * SUB_BUCKETS + ((n >> exp) - SUB_BUCKETS)
+
+    def __upper(self, index):
+        '''@return The largest integer value mapping to the given bucket index.'''
+        if index < SUB_BUCKETS:
+            return index
+        exp = index / SUB_BUCKETS - 1
+        sub = index % SUB_BUCKETS
+        return ((SUB_BUCKETS + sub + 1) << exp) - 1
+
+def dump(metrics, f):
+    '''Write metrics as a single line of JSON to the file-like object f.'''
+    f.write(json.dumps(metrics, sort_keys=True))
+    f.write('\n')
+    f.flush()
+
+class Sampler(object):
+    '''Periodically samples metrics (by calling a source callable) and
+    appends them to a file as lines of JSON, each with an added
+    'timestamp' (seconds since the epoch). Intended to be used as a
+    context manager; a final sample, marked with 'final': True, is
+    written upon exit.'''
+    def __init__(self, source, path, interval):
+        '''
+        @param source: Callable returning a dict of metrics.
+        @param path: Path of the file to append to.
+        @param interval: Seconds between samples.
+        '''
+        self.source = source
+        self.path = path
+        self.interval = interval
+
+        self.__closed = False
+        self.__cond = threading.Condition()
+        self.__thread = None
+        self.__file = None
+
+    def __enter__(self):
+        self.__file = open(self.path, 'a')
+        self.__thread = threading.Thread(target=self.__main, name='metrics-sampler')
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        with self.__cond:
+            self.__closed = True
+            self.__cond.notify()
+        self.__thread.join()
+
+        self.__sample(final=True)
+        self.__file.close()
+
+    def __main(self):
+        with self.__cond:
+            while not self.__closed:
+                self.__cond.wait(self.interval)
+                if not self.__closed:
+                    self.__sample()
+
+    def __sample(self, final=False):
+        try:
+            metrics = self.source()
+            metrics['timestamp'] = time.time()
+            if final:
+                metrics['final'] = True
+            dump(metrics, self.__file)
+        except Exception, e:
+            # never let metrics get in the way of the actual work
+            log.warning('failed to sample metrics to %s: %s', self.path, str(e))
@@ -16,6 +16,14 @@ import shastity.logging as logging
 import shastity.verbosity as verbosity
 
 DEFAULT_BLOCK_SIZE = 1*1024*1024
+DEFAULT_CONCURRENCY = 10
+DEFAULT_MAX_INFLIGHT_BYTES = 256*1024*1024
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_METRICS_INTERVAL = 10
+DEFAULT_HASH_WORKERS = 0 # one per cpu
+DEFAULT_REORDER_BUFFER = 64*1024*1024
+DEFAULT_MAX_OPEN_FILES = 64
+DEFAULT_BLOCK_CACHE = 64*1024*1024
 
 def _config(opts):
     """
@@ -31,7 +39,112 @@ def GlobalOptions():
     """
     return _config([ config.IntOption('verbosity', 'v', verbosity.to_verbosity(logging.DEBUG)),
                      config.IntOption('block-size', None, DEFAULT_BLOCK_SIZE,
-                                      short_help='The size in bytes of storage blocks.') ])
+                                      short_help='The size in bytes of storage blocks (the average '
+                                      'size, with content-defined chunking).'),
+                     config.StringOption('chunking', None, 'fixed',
+                                         short_help='How to split files into blocks: "fixed" (at '
+                                         'multiples of --block-size) or "fastcdc" (content-defined, '
+                                         'which keeps deduplication working when data is inserted '
+                                         'into or removed from files, but is about three times slower '
+                                         'than hashing with numpy installed, and some forty times slower '
+                                         'without).'),
+                     config.IntOption('min-block-size', None, 0,
+                                      short_help='Minimum block size for content-defined chunking '
+                                      '(default: a quarter of --block-size).'),
+                     config.IntOption('max-block-size', None, 0,
+                                      short_help='Maximum block size for content-defined chunking '
+                                      '(default: four times --block-size).'),
+                     config.StringOption('hash', None, 'sha512',
+                                         short_help='Hash algorithm identifying blocks: sha512, blake2b '
+                                         'or blake3 (the latter two requiring optional modules; see '
+                                         'the benchmark-hash command).'),
+                     config.IntOption('concurrency', None, DEFAULT_CONCURRENCY,
+                                      short_help='The (maximum) number of concurrent backend operations.'),
+                     config.IntOption('max-inflight-bytes', None, DEFAULT_MAX_INFLIGHT_BYTES,
+                                      short_help='The maximum number of bytes of block data held by '
+                                      'queued or executing backend operations (0 for no limit).'),
+                     config.IntOption('max-attempts', None, DEFAULT_MAX_ATTEMPTS,
+                                      short_help='The number of times to attempt a failing backend '
+                                      'operation, with exponential backoff between attempts, before '
+                                      'giving up (1 to not retry).'),
+                     config.IntOption('large-threshold', None, 0,
+                                      short_help='Execute backend operations of at least this many bytes '
+                                      '(such as PUTs of large blocks) separately from smaller ones, with '
+                                      'the limits given by the --large-* options rather than '
+                                      '--concurrency (0 to not separate them).'),
+                     config.IntOption('large-concurrency', None, 0,
+                                      short_help='The (maximum) number of concurrent large backend '
+                                      'operations (0 for --concurrency).'),
+                     config.IntOption('large-queue-depth', None, 0,
+                                      short_help='The number of large backend operations to queue '
+                                      'ahead of those executing (0 for --large-concurrency).'),
+                     config.IntOption('large-queue-bytes', None, 0,
+                                      short_help='The maximum number of bytes of large backend operations '
+                                      'to queue ahead of those executing (0 for no limit).'),
+                     config.BoolOption('async-queue', None, False,
+                                       short_help='Drive backends through their asynchronous interface, '
+                                       'so that --concurrency may be in the hundreds without as many '
+                                       'threads. Backends without one (currently all but the in-memory '
+                                       'test backend, including s3) are instead executed by a handful '
+                                       'of threads, which then limit concurrency.'),
+                     config.BoolOption('adaptive-concurrency', None, True,
+                                       short_help='Automatically tune concurrency to the backend, starting '
+                                       'at --concurrency and lowering it on failures or growing latency.'),
+                     config.StringOption('metrics-file', None, None,
+                                         short_help='Append storage metrics, as lines of JSON, to this file '
+                                         'periodically and upon completion.'),
+                     config.IntOption('metrics-interval', None, DEFAULT_METRICS_INTERVAL,
+                                      short_help='Seconds between samples written to --metrics-file.'),
+                     config.StringOption('incremental-from', None, None,
+                                         short_help='Label of a previous backup (in the same manifest '
+                                         'location) relative to which to persist incrementally, '
+                                         'skipping files whose size, times and ownership are '
+                                         'unchanged. Ignored unless the previous backup was made '
+                                         'with the same chunking and block sizes.'),
+                     config.BoolOption('block-index', None, True,
+                                       short_help='List the blocks already stored in the backend, '
+                                       'and do not upload them again.'),
+                     config.BoolOption('file-digests', None, False,
+                                       short_help='Record a digest of the contents of each file read in '
+                                       'the manifest, computed while reading it (at the cost of hashing '
+                                       'it twice).'),
+                     config.IntOption('hash-workers', None, DEFAULT_HASH_WORKERS,
+                                      short_help='Number of processes reading and hashing files (0 '
+                                      'for one per CPU; 1 to do so in the main process).'),
+                     config.IntOption('mmap-threshold', None, 0,
+                                      short_help='Memory map files of at least this many bytes rather '
+                                      'than reading them, avoiding copying blocks that need not be '
+                                      'uploaded (0 to never). Only applies with --hash-workers=1; with '
+                                      'several (such as the default of one per CPU), files are always '
+                                      'read. Files must not be modified or truncated while being persisted.'),
+                     config.StringOption('compression', None, 'none',
+                                         short_help='Codec with which to compress blocks before storing '
+                                         'them: none, zlib, zstd or lz4 (the latter two requiring optional '
+                                         'modules). Blocks that do not compress well are stored as is.'),
+                     config.IntOption('compression-level', None, -1,
+                                      short_help='Compression level (-1 for the default of the codec).'),
+                     config.BoolOption('positional-writes', None, False,
+                                       short_help='When restoring backups made with fixed size blocks, '
+                                       'write blocks as soon as they arrive rather than in order, into '
+                                       'temporary files renamed into place once complete.'),
+                     config.IntOption('reorder-buffer', None, DEFAULT_REORDER_BUFFER,
+                                      short_help='When restoring with blocks written in order, the number '
+                                      'of bytes of blocks arriving early to hold in memory, beyond which '
+                                      'they are spilled to a temporary file (0 to instead have backend '
+                                      'operations wait for the blocks preceding them).'),
+                     config.IntOption('max-open-files', None, DEFAULT_MAX_OPEN_FILES,
+                                      short_help='The maximum number of files to restore at once. Files '
+                                      'are restored smallest first.'),
+                     config.IntOption('block-cache', None, DEFAULT_BLOCK_CACHE,
+                                      short_help='When restoring positionally or through a reorder buffer, '
+                                      'fetch blocks referenced more than once only once, holding up to '
+                                      'this many bytes of them in memory for later references (0 to '
+                                      'fetch blocks once per reference).'),
+                     config.BoolOption('delta', None, False,
+                                       short_help='Restore over an existing directory in place, '
+                                       'fetching only the blocks which differ from the files present '
+                                       '(backups made with fixed size blocks only). Files not in the '
+                                       'backup are left alone.') ])
 
 
 
@@ -9,41 +9,185 @@ Takes stream(s) of (path, metadata) and persists to backends.
 from __future__ import absolute_import
 from __future__ import with_statement
 
+import  collections
+import  heapq
 import  os.path
+import  Queue
+import  traceback
 
+import shastity.chunking as chunking
 import shastity.filesystem as filesystem
 import shastity.hash as hash
 import shastity.logging as logging
+import shastity.manifest as manifest
 import shastity.storagequeue as storagequeue
 
 DEFAULT_BLOCKSIZE = 1024*1024
 DEFAULT_HASHER = hash.make_hasher('sha512')
 
+# Parallel hashing: the amount of file data read and hashed by a
+# worker process per task, and the maximum number of such tasks
+# outstanding (issued but not yet consumed) at any one time. Memory
+# use is bounded by roughly their product.
+DEFAULT_SEGMENT_SIZE = 8*1024*1024
+DEFAULT_WINDOW = 16
+
+# Parallel hashing: the maximum number of entries (files being read,
+# and others such as directories and unchanged files) held back
+# waiting for the files preceding them to be read.
+MAX_BUFFERED_ENTRIES = 1024
+
 log = logging.get_logger(__name__)
 
-def _next_block(f, blocksize):
-    parts = []
-    sofar = 0
+# Metadata which, if unchanged since a previous backup, is taken to
+# mean that the contents of a file are unchanged. (Our metadata does
+# not include inode numbers, so a file replaced by another one with
+# identical size, times and ownership would go unnoticed; given that
+# ctime is included, this requires deliberate effort.)
+INCREMENTAL_PROPS = [ 'size', 'mtime', 'ctime', 'uid', 'gid' ]
+
+def _strip_path(path, basepath):
+    '''@return path relative to basepath (the path used in manifests).'''
+    assert len(basepath) > 0, 'basepath cannot be empty'
+    if not basepath.endswith('/'):
+        basepath += '/'
+
+    assert path.startswith(basepath), 'path %s not in basepath %s' % (path, basepath)
+    assert len(path) > len(basepath), ('basepath %s must be parent to path %s'
+                                       '' % (basepath, path))
+
+    return path[len(basepath):]
+
+def _path_key(stripped_path):
+    '''@return A key for stripped_path whose ordering matches the order
+               in which traversal (and thus manifests) produce paths.'''
+    return tuple(stripped_path.split('/'))
+
+class _PreviousManifest(object):
+    '''Merge-join of the sorted entries of a previous manifest
+    against the (equally sorted) traversal stream: lookup() must be
+    called with paths in traversal order, and reads the previous
+    entries only as far as necessary.'''
+    def __init__(self, entries, algo):
+        '''
+        @param entries: Iterable of (path, metadata, hashes) entries of the previous manifest.
+        @param algo: Name of the hash algorithm in use; hashes produced by another
+                     algorithm are never reused.
+        '''
+        self.algo = algo
+
+        self.__entries = iter(entries)
+        self.__current = None # (key, metadata, hashes), or None at the end
+        self.__advance()
+
+    def unchanged_hashes(self, stripped_path, meta):
+        '''@return The hashes of the file at stripped_path in the
+                   previous manifest, if it is a regular file whose
+                   metadata is unchanged; otherwise None.'''
+        key = _path_key(stripped_path)
+        while self.__current is not None and self.__current[0] < key:
+            self.__advance()
+
+        if self.__current is None or self.__current[0] != key:
+            return None
+
+        dummy, old_meta, hashes = self.__current
+        if not (meta.is_regular and not meta.is_symlink and old_meta.is_regular and not old_meta.is_symlink):
+            return None
+        if [ prop for prop in INCREMENTAL_PROPS if getattr(meta, prop) != getattr(old_meta, prop) ]:
+            return None
+        if [ algo for (algo, hex) in hashes if algo not in (self.algo, manifest.ZERO_ALGO) ]:
+            return None
+
+        return hashes
+
+    def __advance(self):
+        try:
+            path, meta, hashes = self.__entries.next()
+            self.__current = (_path_key(path), meta, hashes)
+        except StopIteration:
+            self.__current = None
+
+class BlockIndex(object):
+    '''The set of names of blocks known to exist in backing storage.
+
+    Since blocks are named by the hash of their contents, a block
+    whose name is in the index need not be PUT again. The index is
+    meant to be built once per run (see from_backend()); it is
+    deliberately not kept across runs, since blocks may have been
+    removed (e.g. by garbage collection) in the mean time, and
+    trusting a stale index would mean losing data.'''
+    def __init__(self, names=()):
+        self.__names = set(names)
+
+    @classmethod
+    def from_backend(cls, backend):
+        '''@return An index of all files listed by the given (data) backend.'''
+        return cls(backend.list())
 
-    while sofar < blocksize:
-        part = f.read(blocksize - sofar)
-        if len(part) == 0:
-            break # eof
-        
-        parts += part
-        sofar += len(part)
+    def __contains__(self, name):
+        return name in self.__names
 
-    return ''.join(parts)
+    def __len__(self):
+        return len(self.__names)
+
+    def add(self, name):
+        self.__names.add(name)
+
+class PersistenceStats(object):
+    '''Counters describing the work done (and avoided) by persist().
+
+    @ivar files_persisted       Regular files read and hashed.
+    @ivar files_unchanged       Regular files skipped by incremental persistence.
+    @ivar bytes_unchanged       Size of the files skipped by incremental persistence.
+    @ivar blocks_uploaded       Blocks PUT to backing storage.
+    @ivar bytes_uploaded        Size of the blocks PUT to backing storage.
+    @ivar bytes_stored          Size of the blocks PUT to backing storage, as stored
+                                (i.e., after compression).
+    @ivar blocks_deduplicated   Blocks not PUT because they were already stored (or
+                                queued for storage) according to the block index.
+    @ivar bytes_deduplicated    Size of the blocks not PUT due to deduplication.
+    @ivar bytes_sparse          Bytes of holes and zero blocks, recorded as zero runs
+                                rather than stored.
+    '''
+    def __init__(self):
+        self.files_persisted = 0
+        self.files_unchanged = 0
+        self.bytes_unchanged = 0
+        self.blocks_uploaded = 0
+        self.bytes_uploaded = 0
+        self.bytes_stored = 0
+        self.blocks_deduplicated = 0
+        self.bytes_deduplicated = 0
+        self.bytes_sparse = 0
+
+    def __str__(self):
+        return ('%d files persisted, %d unchanged (%d bytes); %d blocks uploaded (%d bytes, '
+                '%d stored), %d deduplicated (%d bytes); %d bytes sparse' % (self.files_persisted,
+                                                                             self.files_unchanged,
+                                                                             self.bytes_unchanged,
+                                                                             self.blocks_uploaded,
+                                                                             self.bytes_uploaded,
+                                                                             self.bytes_stored,
+                                                                             self.blocks_deduplicated,
+                                                                             self.bytes_deduplicated,
+                                                                             self.bytes_sparse))
 
 def _persist_file(fs,
                   path,
                   basepath,
                   meta,
                   sq,
-                  blocksize,
-                  hasher):
+                  chunker,
+                  algo,
+                  index,
+                  stats,
+                  mmap_threshold=None,
+                  digests=None,
+                  compressor=None):
     '''Persist a single file and return its entry to be yielded back
-    to the parent caller. Parameters match those of persist().'''
+    to the parent caller. Parameters match those of persist(), except
+    for algo, which is the name of the hash algorithm.'''
     # TODO: fstat() after open to make sure we are not subject to
     # races. This particular case is important because regardless of
     # races in directory traversal, we definitely do not want to store
@@ -51,15 +195,7 @@ def _persist_file(fs,
 
     # TODO #2: Block devices and major/minor preservation. Bah.
 
-    assert len(basepath) > 0, 'basepath cannot be empty'
-    if not basepath.endswith('/'):
-        basepath += '/'
-
-    assert path.startswith(basepath), 'path %s not in basepath %s' % (path, basepath)
-    assert len(path) > len(basepath), ('basepath %s must be parent to path %s'
-                                       '' % (basepath, path))
-
-    stripped_path = path[len(basepath):]
+    stripped_path = _strip_path(path, basepath)
 
     if meta.is_symlink:
         return (stripped_path, meta, [])
@@ -67,19 +203,432 @@ def _persist_file(fs,
         return (stripped_path, meta, [])
     else:
         hashes = []
+        stats.files_persisted += 1
+
+        # hashing the whole file doubles the cost of hashing; only do
+        # it if asked to
+        file_hasher = hash.make_piece_hasher(algo) if digests is not None else None
+
+        mapping = None
+        if mmap_threshold is not None and meta.size >= mmap_threshold:
+            mapping = fs.mmap(path)
+
+        if mapping is not None:
+            try:
+                _persist_mapping(mapping, sq, chunker, algo, index, stats, hashes, file_hasher, compressor)
+            finally:
+                mapping.close()
+        else:
+            with fs.open(path, "r") as f:
+                for offset, length, hole in _runs(fs, path, chunker, meta.size):
+                    if hole:
+                        _add_zeros(hashes, length, stats)
+                        if file_hasher is not None:
+                            file_hasher.update_zeros(length)
+                    else:
+                        if offset != 0:
+                            f.seek(offset)
+                        _persist_stream(f if length is None else _LimitedReader(f, length),
+                                        sq, chunker, algo, index, stats, hashes, file_hasher,
+                                        compressor)
+
+        if digests is not None:
+            digests[stripped_path] = file_hasher.digest()
+        return (stripped_path, meta, hashes)
+
+def _runs(fs, path, chunker, size):
+    '''Split a file into runs of blocks which are to be read, and
+    runs of blocks lying entirely within holes, which need not be.
+
+    @return A list of (offset, length, hole) covering the file, in order. The
+            length of a final run to be read is None, meaning that it extends
+            to the end of the file (which may have grown).'''
+    # The blocks of content-defined chunkers cannot be known without
+    # reading the data; zero blocks are still detected while reading.
+    extents = None if chunker.content_defined else fs.data_extents(path)
+    if extents is None:
+        return [ (0, None, False) ]
+
+    blocksize = chunker.blocksize
+    runs = []
+    pos = 0 # end of the runs so far; always at a block boundary (or the end)
+    for start, length in extents:
+        first = max(pos, start - start % blocksize)
+        end = min(size, (start + length + blocksize - 1) / blocksize * blocksize)
+        if end <= first:
+            continue
+        if first > pos:
+            runs.append((pos, first - pos, True))
+        if runs and not runs[-1][2]:
+            first = runs.pop()[0]
+        runs.append((first, end - first, False))
+        pos = end
+    if pos < size:
+        runs.append((pos, size - pos, True))
+
+    if not runs or runs[-1][2]:
+        # nothing to read but anything the file has grown by
+        runs.append((size, None, False))
+    else:
+        runs[-1] = (runs[-1][0], None, False)
 
+    return runs
+
+class _LimitedReader(object):
+    '''Reads at most a given number of bytes from a file object.'''
+    def __init__(self, f, length):
+        self.__f = f
+        self.__remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.__remaining:
+            size = self.__remaining
+        data = self.__f.read(size) if size > 0 else ''
+        self.__remaining -= len(data)
+        return data
+
+_ZEROS = '\0' * chunking.DEFAULT_PIECE_SIZE
+
+def _is_zero(data):
+    '''@return Whether the given byte string (or buffer) consists of zeros only.'''
+    if isinstance(data, buffer):
+        # compare it with zeros piece by piece, without copying it
+        for pos in xrange(0, len(data), len(_ZEROS)):
+            n = min(len(_ZEROS), len(data) - pos)
+            if buffer(data, pos, n) != buffer(_ZEROS, 0, n):
+                return False
+        return True
+
+    # lstrip() returns the string itself, without copying, if it does
+    # not begin with a zero
+    return not data.lstrip('\0')
+
+def _add_zeros(hashes, length, stats):
+    '''Append a run of length zero bytes to hashes, merging it with a
+    preceding zero run, if any.'''
+    stats.bytes_sparse += length
+    if hashes and manifest.is_zero_run(hashes[-1]):
+        length += int(hashes.pop()[1])
+    hashes.append(manifest.zero_run(length))
+
+def _persist_stream(f, sq, chunker, algo, index, stats, hashes, file_hasher, compressor):
+    '''Persist the blocks read from f, appending their (algo, hash)
+    to hashes and feeding them to file_hasher (unless None). Blocks
+    are hashed piece by piece as they are read,
+    rather than once read in their entirety; blocks of zeros are not
+    hashed at all, but recorded as zero runs.'''
+    block_hasher = None # None while the block read so far is all zeros
+    parts = []
+    for piece, last in chunker.pieces(f):
+        if file_hasher is not None:
+            file_hasher.update(piece)
+        if block_hasher is None and not _is_zero(piece):
+            block_hasher = hash.make_stream_hasher(algo)
+            for part in parts:
+                block_hasher.update(part)
+        if block_hasher is not None:
+            block_hasher.update(piece)
+        parts.append(piece)
+
+        if last:
+            if block_hasher is None:
+                _add_zeros(hashes, sum([ len(part) for part in parts ]), stats)
+            else:
+                algo, hex = block_hasher.digest()
+                hashes.append((algo, _store_block(sq, ''.join(parts), hex, index, stats, compressor)))
+            block_hasher = None
+            parts = []
+
+def _persist_mapping(mapping, sq, chunker, algo, index, stats, hashes, file_hasher, compressor):
+    '''Persist the blocks of a memory mapped file, appending their
+    (algo, hash) to hashes and feeding them to file_hasher (unless
+    None). Blocks are hashed directly out of the mapping; only blocks
+    to be uploaded are copied.'''
+    hasher = hash.make_hasher(algo)
+    for offset, length in chunker.split(mapping):
+        view = buffer(mapping, offset, length)
+
+        # only blocks beginning and ending with zeros are compared
+        # with zeros in their entirety
+        if mapping[offset] == '\0' and mapping[offset + length - 1] == '\0' and _is_zero(view):
+            _add_zeros(hashes, length, stats)
+            if file_hasher is not None:
+                file_hasher.update_zeros(length)
+            continue
+
+        if file_hasher is not None:
+            file_hasher.update(view)
+        algo, hex = hasher(view)
+        name = hex if compressor is None else compressor.block_name(hex, view)
+        if index is not None and name in index:
+            hashes.append((algo, name))
+            stats.blocks_deduplicated += 1
+            stats.bytes_deduplicated += length
+            continue
+
+        # The file may change while we copy the block; make sure it is
+        # named by what we actually store, re-hashing it if so. (The
+        # view reflects the file as it is now, so a change in between
+        # hashing and copying goes unnoticed; files must not be
+        # modified while being persisted.)
+        block = mapping[offset:offset + length]
+        if buffer(block) != view:
+            algo, hex = hasher(block)
+        hashes.append((algo, _store_block(sq, block, hex, index, stats, compressor)))
+
+def _store_block(sq, block, hex, index, stats, compressor):
+    '''PUT a block, compressed if the compressor (unless None) finds
+    it worthwhile, unless the index says it is already stored.
+
+    @return The name of the block (see the compression module).'''
+    name = hex if compressor is None else compressor.block_name(hex, block)
+    data = block
+    if name != hex and (index is None or name not in index):
+        data = compressor.compress(block)
+
+    _put_block(sq, name, data, len(block), index, stats)
+    return name
+
+def _put_block(sq, name, data, length, index, stats):
+    '''PUT the data of a block (of length bytes, uncompressed) under the
+    given name unless the index says it is already stored.'''
+    if index is not None and name in index:
+        stats.blocks_deduplicated += 1
+        stats.bytes_deduplicated += length
+        return
+
+    sq.enqueue(storagequeue.PutOperation(name=name,
+                                         data=data))
+    stats.blocks_uploaded += 1
+    stats.bytes_uploaded += length
+    stats.bytes_stored += len(data)
+    if index is not None:
+        index.add(name)
+
+class HashingFailed(Exception):
+    '''Raised when reading or hashing a file in a worker process
+    fails; carries the formatted traceback from the worker.'''
+    pass
+
+def _hash_segment(fs, path, chunker, algo, offset, length, digest, compressor):
+    '''Worker process task: read, chunk, hash and compress (if
+    compressor is not None) a segment of a file. Blocks are compressed
+    regardless of whether they turn out to be stored already, keeping
+    the costly part of the work off the calling process.
+
+    A segment begins at a block boundary and extends until at least
+    length bytes have been consumed (or to the end of the file if
+    length is None), ending at a block boundary. Chunking a file
+    segment by segment thus yields the same blocks as chunking it as
+    a whole.
+
+    @return (True, (blocks, end, parts)) where blocks is a list of (algo, name, data, length),
+            data being None for zero runs, end is the offset following the segment, or None if the end
+            of the file was reached, and parts is what to add() to the PieceHasher of the whole
+            file if digest is true (else None). (False, traceback) on failure.'''
+    try:
+        hasher = hash.make_hasher(algo)
+        file_hasher = hash.make_piece_hasher(algo, offset) if digest else None
+        blocks = []
+        consumed = 0
         with fs.open(path, "r") as f:
-            while True:
-                block = _next_block(f, blocksize)
-                if len(block) == 0:
+            f.seek(offset)
+            for block in chunker.chunks(f):
+                if _is_zero(block):
+                    blocks.append((manifest.ZERO_ALGO, None, None, len(block)))
+                    if file_hasher is not None:
+                        file_hasher.update_zeros(len(block))
+                else:
+                    if file_hasher is not None:
+                        file_hasher.update(block)
+                    algo, hex = hasher(block)
+                    name = hex if compressor is None else compressor.block_name(hex, block)
+                    data = block if name == hex else compressor.compress(block)
+                    blocks.append((algo, name, data, len(block)))
+                consumed += len(block)
+                if length is not None and consumed >= length:
                     break
-                
-                algo, hash = hasher(block)
-                hashes.append((algo, hash))
-                # todo: don't put if file exists
-                sq.enqueue(storagequeue.PutOperation(name=hash,
-                                                     data=block))
-            return (stripped_path, meta, hashes)
+            else:
+                consumed = None
+        parts = file_hasher.parts() if file_hasher is not None else None
+        return (True, (blocks, None if consumed is None else offset + consumed, parts))
+    except Exception:
+        return (False, traceback.format_exc())
+
+class _Segment(object):
+    def __init__(self):
+        self.outcome = None # set upon completion
+
+class _FileJob(object):
+    '''A regular file being read and hashed by worker processes, one
+    segment at a time.'''
+    def __init__(self, fs, number, path, stripped_path, meta, chunker, segment_size, algo, digest):
+        '''
+        @param number: Position of the file in the traversal, giving the order in which
+                       the segments of jobs are issued.
+        '''
+        self.number = number
+        self.path = path
+        self.stripped_path = stripped_path
+        self.meta = meta
+        self.chunker = chunker
+        self.segment_size = segment_size
+
+        self.hashes = []
+        self.file_hasher = hash.make_piece_hasher(algo) if digest else None
+        self.segments = collections.deque() # issued, in file order
+
+        # (offset, length, hole) of segments known but not yet
+        # issued. The segment boundaries of a content-defined chunker
+        # are only known once the preceding segment has been chunked,
+        # while those of fixed size chunkers are known up-front, as
+        # are the runs of blocks lying within holes (see _runs()),
+        # which are not read at all.
+        self.pending = collections.deque()
+        if chunker.content_defined:
+            self.pending.append((0, segment_size, False))
+        else:
+            seglen = max(1, segment_size / chunker.blocksize) * chunker.blocksize
+            try:
+                runs = _runs(fs, path, chunker, meta.size)
+            except EnvironmentError:
+                runs = [ (0, None, False) ] # leave reporting the error to the workers
+            for offset, length, hole in runs:
+                if hole:
+                    self.pending.append((offset, length, True))
+                    continue
+
+                end = meta.size if length is None else offset + length
+                count = max(1, (end - offset + seglen - 1) / seglen)
+                for n in xrange(0, count - 1):
+                    self.pending.append((offset + n * seglen, seglen, False))
+                last = offset + (count - 1) * seglen
+                self.pending.append((last, None if length is None else end - last, False))
+
+    def completed(self, segment):
+        '''Called upon completion of one of our segments.
+
+        @return Whether segments have become pending as a result.'''
+        ok, value = segment.outcome
+        if ok and self.chunker.content_defined:
+            blocks, end, parts = value
+            if end is not None:
+                self.pending.append((end, self.segment_size, False))
+                return True
+        return False
+
+    def done(self):
+        return not self.segments and not self.pending
+
+def _persist_parallel(fs, traversal, basepath, sq, chunker, algo, index, stats, previous, pool, window, segment_size,
+                      digests, compressor):
+    '''Like the sequential loop of persist(), but having the files
+    read and hashed by a pool of worker processes. Entries are
+    yielded in traversal order as soon as all preceding entries have
+    been.'''
+    entries = collections.deque() # entries or _FileJobs, in traversal order
+    issuable = [] # heap of (traversal number, _FileJob) of the jobs with pending segments
+    completions = Queue.Queue()
+    outstanding = [0] # segments issued but not yet consumed
+    exhausted = False
+    count = 0 # of entries pulled from the traversal
+
+    def issue():
+        # issue work for files in traversal order
+        while issuable and outstanding[0] < window:
+            number, job = issuable[0]
+            offset, length, hole = job.pending.popleft()
+            if not job.pending:
+                heapq.heappop(issuable)
+            segment = _Segment()
+            job.segments.append(segment)
+            outstanding[0] += 1
+            if hole:
+                # complete already; nothing to read
+                segment.outcome = (True, ([ (manifest.ZERO_ALGO, None, None, length) ], offset + length, None))
+                continue
+            pool.apply_async(_hash_segment,
+                             (fs, job.path, chunker, algo, offset, length, digests is not None, compressor),
+                             callback=lambda outcome, job=job, segment=segment: completions.put((job, segment, outcome)))
+
+    traversal = iter(traversal)
+    while True:
+        # issue work, pulling in more of the traversal while there is
+        # room
+        issue()
+        while not exhausted and outstanding[0] < window and len(entries) < MAX_BUFFERED_ENTRIES:
+            try:
+                path, meta = traversal.next()
+            except StopIteration:
+                exhausted = True
+                break
+            count += 1
+
+            stripped_path = _strip_path(path, basepath)
+            if previous is not None:
+                hashes = previous.unchanged_hashes(stripped_path, meta)
+                if hashes is not None:
+                    log.debug('unchanged since previous backup [%s]', path)
+                    stats.files_unchanged += 1
+                    stats.bytes_unchanged += meta.size
+                    entries.append((stripped_path, meta, hashes))
+                    continue
+
+            if meta.is_symlink or meta.is_directory:
+                entries.append((stripped_path, meta, []))
+            else:
+                log.info('persisting [%s]', path)
+                stats.files_persisted += 1
+                job = _FileJob(fs, count, path, stripped_path, meta, chunker, segment_size, algo, digests is not None)
+                entries.append(job)
+                heapq.heappush(issuable, (job.number, job))
+                issue()
+
+        # consume the blocks of the first file, and yield whatever
+        # entries are complete
+        progressed = False
+        while entries:
+            job = entries[0]
+            if isinstance(job, _FileJob):
+                while job.segments and job.segments[0].outcome is not None:
+                    ok, value = job.segments.popleft().outcome
+                    outstanding[0] -= 1
+                    progressed = True
+                    if not ok:
+                        raise HashingFailed('hashing %s failed in worker: %s' % (job.path, value))
+                    blocks, end, parts = value
+                    for block_algo, name, data, length in blocks:
+                        if data is None:
+                            _add_zeros(job.hashes, length, stats)
+                        else:
+                            job.hashes.append((block_algo, name))
+                            _put_block(sq, name, data, length, index, stats)
+                    if job.file_hasher is not None:
+                        if parts is None: # a hole
+                            job.file_hasher.update_zeros(blocks[0][3])
+                        else:
+                            job.file_hasher.add(parts)
+                if not job.done():
+                    break
+                entries.popleft()
+                if digests is not None:
+                    digests[job.stripped_path] = job.file_hasher.digest()
+                yield (job.stripped_path, job.meta, job.hashes)
+            else:
+                yield entries.popleft()
+            progressed = True
+
+        if exhausted and not entries:
+            break
+
+        # Consuming made room for more segments, and yielding for more
+        # entries, which must be issued before waiting; in particular,
+        # the first file may be unable to make progress otherwise.
+        if not progressed:
+            job, segment, outcome = completions.get()
+            segment.outcome = outcome
+            if job.completed(segment):
+                heapq.heappush(issuable, (job.number, job))
 
 def persist(fs,
             traversal,
@@ -87,25 +636,114 @@ def persist(fs,
             basepath,
             sq,
             blocksize=DEFAULT_BLOCKSIZE,
-            hasher=DEFAULT_HASHER):
+            hasher=DEFAULT_HASHER,
+            index=None,
+            stats=None,
+            chunker=None,
+            pool=None,
+            window=DEFAULT_WINDOW,
+            segment_size=DEFAULT_SEGMENT_SIZE,
+            mmap_threshold=None,
+            digests=None,
+            compressor=None):
     '''Take an incoming traversal stream and persist in backing
     storage, while yielding appropriate (path, metadata, blocks)
     tuples. The third entry in that tuple is a list of (algo, hash)
-    tuples.
+    tuples. Holes in sparse files (as reported by FileSystem.data_extents())
+    and blocks consisting of zeros are not stored, but recorded as zero runs
+    (see manifest.zero_run()).
 
     @param fs: File system from which to read file contents.
     @param traversal: Generator producting (path, metadata) entries.
-    @param incremental: Incremental entry produced for a previous backup relative
-                        to which we are to optimize away file reading/hashing/encryption.
+    @param incremental: Entries (in order) of the manifest of a previous backup relative
+                        to which we are to optimize away file reading/hashing/encryption,
+                        or None. Regular files whose metadata (see INCREMENTAL_PROPS)
+                        is unchanged are assumed to have unchanged contents, and the
+                        hashes of the previous backup are re-used without reading them.
+                        The blocks are assumed to remain in backing storage, and to have
+                        been cut by the same chunker (see Chunker.spec()); the offsets of
+                        blocks would be wrong otherwise.
     @param basepath: Base path (prefix) of backup.
     @param sq: Storage queue to which to write files contents.
+    @param hasher: Hasher, as returned by hash.make_hasher(), determining the hash algorithm.
+    @param index: BlockIndex of blocks already in backing storage, which are then not
+                  PUT again, or None. Blocks PUT are added to the index.
+    @param stats: PersistenceStats to update, or None.
+    @param chunker: Chunker (see the chunking module) splitting files into blocks. Defaults
+                    to fixed size blocks of blocksize bytes.
+    @param pool: A multiprocessing.Pool in which to read and hash files, or None to do
+                 so in the calling thread. The file system and chunker must be
+                 picklable.
+    @param window: Maximum number of segments of files being read and hashed by the pool
+                   at any one time.
+    @param segment_size: Number of bytes of a file read and hashed by a single task in
+                         the pool.
+    @param mmap_threshold: Regular files of at least this many bytes are memory mapped (see
+                           FileSystem.mmap()) and hashed without copying them, or None to
+                           always read files. Ignored when hashing in a pool, where files
+                           are always read. Files must not be modified while being persisted.
+    @param digests: Dict to which the (algo, hash) of the entire contents of each regular
+                    file read is added (keyed by path, as in the manifest) before its entry
+                    is yielded, or None. The hash is that of a hash.PieceHasher, computed
+                    while reading the file (doubling the cost of hashing).
+    @param compressor: compression.Compressor with which to compress blocks before storing
+                       them, or None. The names of compressed blocks in the manifest
+                       identify their codec (see the compression module).
     '''
-    assert incremental is None, 'incremental optimization not yet implemented'
-    
+    algo = hasher('')[0]
+    if stats is None:
+        stats = PersistenceStats()
+    if chunker is None:
+        chunker = chunking.FixedSizeChunker(blocksize)
+
+    if incremental is not None:
+        previous = _PreviousManifest(incremental, algo)
+    else:
+        previous = None
+
+    if pool is not None:
+        for entry in _persist_parallel(fs,
+                                       traversal,
+                                       basepath,
+                                       sq,
+                                       chunker=chunker,
+                                       algo=algo,
+                                       index=index,
+                                       stats=stats,
+                                       previous=previous,
+                                       pool=pool,
+                                       window=window,
+                                       segment_size=segment_size,
+                                       digests=digests,
+                                       compressor=compressor):
+            yield entry
+        sq.wait()
+        return
+
     for path, meta in traversal:
-        # Future: Do traversal/incremental optimization logic here.
+        if previous is not None:
+            stripped_path = _strip_path(path, basepath)
+            hashes = previous.unchanged_hashes(stripped_path, meta)
+            if hashes is not None:
+                log.debug('unchanged since previous backup [%s]', path)
+                stats.files_unchanged += 1
+                stats.bytes_unchanged += meta.size
+                yield (stripped_path, meta, hashes)
+                continue
+
         log.info('persisting [%s]', path)
-        yield _persist_file(fs, path, basepath, meta, sq, blocksize=blocksize, hasher=hasher)
+        yield _persist_file(fs,
+                            path,
+                            basepath,
+                            meta,
+                            sq,
+                            chunker=chunker,
+                            algo=algo,
+                            index=index,
+                            stats=stats,
+                            mmap_threshold=mmap_threshold,
+                            digests=digests,
+                            compressor=compressor)
 
     sq.wait()
 
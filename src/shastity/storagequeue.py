@@ -27,15 +27,21 @@ The storage queue is also the place where retry logic is implemented
 from __future__ import absolute_import
 from __future__ import with_statement
 
-import thread
+import collections
+import heapq
+import random
 import threading
+import time
 import traceback
 
 import shastity.logging as logging
+import shastity.metrics as metrics
 import shastity.util as util
 
 log = logging.get_logger(__name__)
 
+DEFAULT_EXECUTOR_THREADS = 8 # see AsyncStorageQueue
+
 class StorageOperation(object):
     '''Abstract base class for all operations.
 
@@ -49,15 +55,22 @@ class StorageOperation(object):
                         if and when if the operation is successful. The callback
                         will block the I/O worker until done; thus worker
                         invocation is subject to the concurrency limits of a
-                        storage queue.
+                        storage queue. The operation is outstanding until
+                        the callback has returned, and fails if it raises.
         '''
         self.mnemonic = mnemonic
         self.description = description
         self.callback = callback
+        self.attempts = 0 # number of times execution has been attempted
+        self.elapsed = None # seconds spent in the most recent execution
+        self.primary = None # operation whose outcome we share, if coalesced
 
+        self.__started = None # time at which the most recent execution started
         self.__sq = None
         self.__result = None
-        self.__cond = threading.Condition() # protects __result only
+        self.__finished = False # set once the result and callback have been delivered
+        self.__listeners = []
+        self.__cond = threading.Condition() # protects __result, __finished and __listeners
 
     def wait(self):
         '''Wait for the operation to complete. The operation is
@@ -98,6 +111,65 @@ class StorageOperation(object):
     def execute(self, backend):
         raise NotImplementedError
 
+    def execute_async(self, backend, done):
+        '''Start execution using the asynchronous interface of the
+        backend (see backend.Backend), arranging for done(value,
+        error) to be called upon completion. Only called if the
+        backend has an asynchronous interface, and execute() is not
+        overridden by a subclass of the class implementing this
+        method (so that such a subclass keeps working as expected).
+
+        @return Whether execution was started; if False, the operation
+                will be executed synchronously using execute().'''
+        return False
+
+    def size(self):
+        '''Number of bytes of payload held in memory by this operation
+        prior to its execution (used for look-ahead accounting).'''
+        return 0
+
+    def bytes_transferred(self):
+        '''@return Number of payload bytes transferred to or from the
+                   backend by this (successful) operation.'''
+        return 0
+
+    def object_name(self):
+        '''@return The name of the backend object operated on, or None
+                   if not applicable.'''
+        return None
+
+    def coalesces_with(self, other):
+        '''@return Whether this operation, enqueued while other is
+                   still outstanding (and no other operation on the
+                   same object has been enqueued since), may share the
+                   outcome of other rather than being executed. The
+                   default is False.'''
+        return False
+
+    def coalesce(self, primary):
+        '''Have this operation share the outcome of primary instead of
+        being executed against the backend. Called by the storage
+        queue prior to execution.'''
+        self.primary = primary
+
+    def add_listener(self, listener):
+        '''Arrange for listener(value, error) to be called once the
+        operation is finished (i.e., its result has been set and its
+        callback, if any, has completed), with error being None if
+        the operation succeeded. If already finished, listener is
+        called immediately.'''
+        with self.__cond:
+            if not self.__finished:
+                self.__listeners.append(listener)
+                return
+        listener(*self.__outcome())
+
+    def payload_size(self):
+        '''Expected number of payload bytes transferred by this
+        operation (used for routing it to a size class). Defaults to
+        size().'''
+        return self.size()
+
     def set_storage_queue(self, sq):
         '''Associate this operation with the given queue, meaning that
         the operation will notify the queue when done. Must only be
@@ -111,23 +183,124 @@ class StorageOperation(object):
         appropriate scaffolding to handling errors and result
         signalling. This will be called by the StorageQueue in some
         worker thread. Errors should not leak from this method (they
-        are not well handled).'''
+        are not well handled).
+
+        If execution fails, the storage queue gets the chance to
+        reschedule the operation for another attempt, in which case
+        the operation is not done and perform() will be called again
+        later.'''
+        self.__begin()
+        if self.primary is not None:
+            def shared(value, error):
+                self.__end()
+                self.complete(value, error)
+
+            log.debug('coalescing operation: %s', str(self))
+            self.primary.add_listener(shared)
+            return
+
         try:
-            log.info('performing operation: %s', str(self))
-            self.__set_result(True, self.execute(backend))
-            log.debug('operation done: %s', str(self))
+            log.debug('performing operation: %s', str(self))
+            value = self.execute(backend)
+        except Exception, e:
+            self.__end()
+            self.complete(None, traceback.format_exc())
+        else:
+            self.__end()
+            self.complete(value, None)
+
+    def perform_async(self, backend, done):
+        '''Like perform(), except that the backend's asynchronous
+        interface is used if available (see execute_async()), and
+        that rather than completing the operation, done(value, error)
+        is called (in an arbitrary thread) once execution has
+        finished. The caller is then responsible for calling
+        complete() with the same arguments.
+
+        If the backend has no asynchronous interface, the operation
+        is executed synchronously prior to returning.'''
+        self.__begin()
+
+        def executed(value, error):
+            self.__end()
+            done(value, error)
 
-            self.__sq.notify_operation_complete(self)
+        if self.primary is not None:
+            log.debug('coalescing operation: %s', str(self))
+            self.primary.add_listener(executed)
+            return
+
+        try:
+            log.debug('performing operation: %s', str(self))
+            if self.__can_execute_async(backend) and self.execute_async(backend, executed):
+                return
+            value = self.execute(backend)
         except Exception, e:
-            self.__set_result(False, traceback.format_exc())
+            executed(None, traceback.format_exc())
+        else:
+            executed(value, None)
+
+    def __can_execute_async(self, backend):
+        if not backend.has_async_interface():
+            return False
+
+        def implementor(name):
+            return [ cls for cls in type(self).__mro__ if name in cls.__dict__ ][0]
+
+        return issubclass(implementor('execute_async'), implementor('execute'))
+
+    def complete(self, value, error):
+        '''Complete the operation given the outcome of its execution,
+        delivering the result (and invoking the callback) or giving
+        the storage queue the chance to retry it.
+
+        @param value: The value produced by execution, if successful.
+        @param error: None if execution was successful, else a human-readable
+                      description of the failure.'''
+        if error is not None:
+            if self.__sq.notify_operation_retry(self, error):
+                return
+
+            self.__set_result(False, error)
 
             log.error('operation failed: %s', str(self))
-            log.error('traceback: %s', self.__result[1])
+            log.error('traceback: %s', error)
 
             self.__sq.notify_operation_failed(self)
+        else:
+            self.__set_result(True, value)
+            log.debug('operation done: %s', str(self))
+
+            # The operation remains outstanding until its callback has
+            # returned, and fails if the callback raises.
+            try:
+                if self.callback:
+                    self.callback(value)
+            except Exception, e:
+                log.error('callback of operation failed: %s', str(self))
+                log.error('traceback: %s', traceback.format_exc())
 
-        if self.__result[0] and self.callback:
-            self.callback(self.__result[1])
+                self.__sq.notify_operation_failed(self)
+            else:
+                self.__sq.notify_operation_complete(self)
+
+        with self.__cond:
+            self.__finished = True
+            listeners, self.__listeners = self.__listeners, []
+        for listener in listeners:
+            listener(*self.__outcome())
+
+    def __outcome(self):
+        '''@return (value, error) of a finished operation.'''
+        success, data = self.__result
+        return (data, None) if success else (None, data)
+
+    def __begin(self):
+        self.attempts += 1
+        self.__started = time.time()
+
+    def __end(self):
+        self.elapsed = time.time() - self.__started
 
     def __str__(self):
         return '%s %s' % (self.mnemonic, self.description)
@@ -145,15 +318,55 @@ class PutOperation(StorageOperation):
     def execute(self, backend):
         return backend.put(self.name, self.data)
 
+    def execute_async(self, backend, done):
+        backend.put_async(self.name, self.data, done)
+        return True
+
+    def size(self):
+        return len(self.data)
+
+    def bytes_transferred(self):
+        return len(self.data)
+
+    def object_name(self):
+        return self.name
+
+    def coalesces_with(self, other):
+        # A PUT of the same data is a no-op. Blocks are named by the
+        # hash of their contents, so the data need not be compared
+        # (which would be costly, and done with the queue locked);
+        # only its length is, as a sanity check.
+        return type(other) is type(self) and other.name == self.name and len(other.data) == len(self.data)
+
 class GetOperation(StorageOperation):
-    def __init__(self, name, callback=None):
+    def __init__(self, name, callback=None, size_hint=None):
+        '''
+        @param size_hint: Expected size of the file, if known.
+        '''
         StorageOperation.__init__(self, 'GET', name, callback)
 
         self.name = name
+        self.size_hint = size_hint
 
     def execute(self, backend):
         return backend.get(self.name)
 
+    def execute_async(self, backend, done):
+        backend.get_async(self.name, done)
+        return True
+
+    def payload_size(self):
+        return self.size_hint or 0
+
+    def bytes_transferred(self):
+        return len(self.value())
+
+    def object_name(self):
+        return self.name
+
+    def coalesces_with(self, other):
+        return type(other) is type(self) and other.name == self.name
+
 class DeleteOperation(StorageOperation):
     def __init__(self, name, callback=None):
         StorageOperation.__init__(self, 'DEL', name, callback)
@@ -163,43 +376,388 @@ class DeleteOperation(StorageOperation):
     def execute(self, backend):
         return backend.delete(self.name)
 
+    def execute_async(self, backend, done):
+        backend.delete_async(self.name, done)
+        return True
+
+    def object_name(self):
+        return self.name
+
 class OperationHasFailed(Exception):
     pass
 
+class RetryPolicy(object):
+    '''Decides whether, and after what delay, a failed operation is
+    to be retried. Delays grow exponentially with each attempt (up to
+    a cap), and are randomized (jittered) in order to avoid many
+    operations failing at the same time (e.g. due to a backend
+    hiccup) being retried in lock step.'''
+    def __init__(self, max_attempts=1, base_delay=0.5, max_delay=30.0, jitter=0.5):
+        '''
+        @param max_attempts: Maximum number of times to attempt an operation (1 means
+                             no retries).
+        @param base_delay: Delay in seconds before the first retry (prior to jitter).
+        @param max_delay: Cap on the delay in seconds (prior to jitter).
+        @param jitter: Fraction (0 to 1) of the delay that is randomized; the actual
+                       delay is uniformly distributed in [delay * (1 - jitter), delay].
+        '''
+        assert max_attempts >= 1, 'max_attempts must be at least 1'
+        assert 0.0 <= jitter <= 1.0, 'jitter must be between 0 and 1'
+
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def should_retry(self, attempts):
+        '''@return Whether to retry an operation that has failed after the
+                   given number of attempts.'''
+        return attempts < self.max_attempts
+
+    def delay(self, attempts):
+        '''@return Seconds to wait before retrying an operation that has
+                   failed after the given number of attempts.'''
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempts - 1)))
+        return delay * (1.0 - self.jitter * random.random())
+
+class AdaptiveConcurrency(object):
+    '''Controller which adjusts the number of concurrently executing
+    operations in order to find the knee of the throughput curve of a
+    backend; the point beyond which more concurrency only adds latency.
+
+    Completed operations are observed in windows of time. At the end
+    of each window the limit is adjusted AIMD-style:
+
+      - On failures, or if latency grew without a corresponding gain
+        in throughput, it is decreased multiplicatively.
+      - If operations were waiting for a slot, and throughput grew or
+        nothing has been learned yet, it is increased by one.
+      - Otherwise it is left alone (the backend is not the
+        bottleneck).
+
+    By default the limit starts out at max_conc, so that a queue is
+    not throttled until there is evidence that the backend suffers
+    from it; start lower (initial_conc) in order to probe upwards.
+
+    @ivar limit The current concurrency limit.
+    @ivar history List of (time, limit) tuples, one for each change of the limit.'''
+    def __init__(self, max_conc, min_conc=1, initial_conc=None, window=1.0,
+                 decrease_factor=0.75, tolerance=0.05):
+        '''
+        @param max_conc: Upper bound on the limit.
+        @param min_conc: Lower bound on the limit.
+        @param initial_conc: Initial limit. Defaults to max_conc.
+        @param window: Length of an observation window in seconds.
+        @param decrease_factor: Factor by which to multiply the limit when decreasing it.
+        @param tolerance: Relative change in throughput or latency considered significant.
+        '''
+        assert 1 <= min_conc <= max_conc, 'need 1 <= min_conc <= max_conc'
+        assert 0.0 < decrease_factor < 1.0, 'decrease_factor must be between 0 and 1'
+
+        self.max_conc = max_conc
+        self.min_conc = min_conc
+        self.window = window
+        self.decrease_factor = decrease_factor
+        self.tolerance = tolerance
+
+        self.limit = min(max_conc, max(min_conc, max_conc if initial_conc is None else initial_conc))
+        self.history = [ (time.time(), self.limit) ]
+
+        self.__prev = None # (throughput, latency) of the previous window
+        self.__reset(None)
+
+    def __reset(self, now):
+        self.__window_start = now
+        self.__ops = 0
+        self.__latency = 0.0
+        self.__failures = 0
+        self.__backlogged = False
+
+    def observe(self, latency, backlogged, now=None):
+        '''Observe a successfully completed operation.
+
+        @param latency: Seconds spent executing the operation.
+        @param backlogged: Whether operations were waiting for a slot.
+        @param now: Current time (defaults to time.time()).
+
+        @return Whether the limit changed.'''
+        now = time.time() if now is None else now
+        if self.__window_start is None:
+            self.__window_start = now
+
+        self.__ops += 1
+        self.__latency += latency
+        self.__backlogged = self.__backlogged or backlogged
+
+        return self.__update(now)
+
+    def failure(self, now=None):
+        '''Observe a failed operation.
+
+        @return Whether the limit changed.'''
+        now = time.time() if now is None else now
+        if self.__window_start is None:
+            self.__window_start = now
+
+        self.__failures += 1
+
+        return self.__update(now)
+
+    def __update(self, now):
+        elapsed = now - self.__window_start
+        if elapsed < self.window:
+            return False
+
+        old_limit = self.limit
+
+        if self.__failures:
+            self.__decrease()
+        elif self.__ops:
+            throughput = self.__ops / elapsed
+            latency = self.__latency / self.__ops
+
+            if self.__prev is None:
+                gained, slowed = True, False
+            else:
+                prev_throughput, prev_latency = self.__prev
+                gained = throughput > prev_throughput * (1.0 + self.tolerance)
+                slowed = latency > prev_latency * (1.0 + self.tolerance)
+
+            if slowed and not gained:
+                self.__decrease()
+            elif gained and self.__backlogged:
+                self.limit = min(self.max_conc, self.limit + 1)
+                self.__prev = (throughput, latency)
+            else:
+                self.__prev = (throughput, latency)
+
+        self.__reset(now)
+
+        if self.limit != old_limit:
+            self.history.append((now, self.limit))
+            return True
+        return False
+
+    def __decrease(self):
+        self.limit = max(self.min_conc, int(self.limit * self.decrease_factor))
+        self.__prev = None # start probing anew
+
+class _Lane(object):
+    '''A size class of a StorageQueue; an independent FIFO queue of
+    operations with its own pool of workers, concurrency and
+    look-ahead limits. All state is protected by the lock of the
+    storage queue to which the lane belongs.'''
+    def __init__(self, name, lock, max_conc, max_threads, queue_depth, queue_bytes, controller=None):
+        assert max_conc > 0, 'max_conc must be positive'
+        assert max_threads > 0, 'max_threads must be positive'
+        assert queue_depth > 0, 'queue_depth must be positive'
+
+        self.name = name
+        self.max_conc = max_conc
+        self.max_threads = max_threads
+        self.queue_depth = queue_depth
+        self.queue_bytes = queue_bytes
+        self.controller = controller # AdaptiveConcurrency, or None
+
+        self.queue = collections.deque()
+        self.queued_bytes = 0
+        self.workers = []
+        self.idle = 0 # number of workers waiting for work
+        self.inflight = 0 # number of operations picked up but not yet released
+        self.work = threading.Condition(lock) # signalled when an operation is queued
+        self.ops_started = 0
+
+    def active_limit(self):
+        '''@return Maximum number of operations to run concurrently right now.'''
+        return self.controller.limit if self.controller else self.max_conc
+
+    def runnable(self):
+        '''@return Whether a worker may pick up an operation right now.
+                   Operations being retried are exempt from the
+                   concurrency limit, since operations occupying
+                   the slots may be waiting for them.'''
+        return self.queue and (self.inflight < self.active_limit() or self.queue[0].attempts > 0)
+
+    def is_full(self, op):
+        '''@return Whether queueing op would exceed the look-ahead
+                   limits. An empty queue always accepts an operation,
+                   regardless of its size.'''
+        if not self.queue:
+            return False
+        if len(self.queue) >= self.queue_depth:
+            return True
+        if self.queue_bytes is not None and self.queued_bytes + op.size() > self.queue_bytes:
+            return True
+        return False
+
 class StorageQueue(object):
-    def __init__(self, backend_factory, max_conc):
+    def __init__(self,
+                 backend_factory,
+                 max_conc,
+                 queue_depth=None,
+                 queue_bytes=None,
+                 large_threshold=None,
+                 large_conc=None,
+                 large_queue_depth=None,
+                 large_queue_bytes=None,
+                 max_bytes=None,
+                 retry_policy=None,
+                 adaptive=None):
         '''
         @param backend_factory: Callable which will yield a newly constructed backend when called.
         @param max_conc: Maximum worker concurrency.
+        @param queue_depth: Maximum number of operations queued (look-ahead) but not yet
+                            picked up by a worker. Defaults to max_conc.
+        @param queue_bytes: Maximum number of payload bytes (see StorageOperation.size())
+                            of queued operations, or None for no limit.
+        @param large_threshold: If given, operations whose payload_size() is at least this
+                                many bytes are executed in a separate size class with its own
+                                workers and limits (given by the large_* parameters), while
+                                max_conc, queue_depth and queue_bytes apply to the remaining
+                                (small) operations.
+        @param large_conc: Maximum worker concurrency of large operations. Defaults to max_conc.
+        @param large_queue_depth: Look-ahead depth of large operations. Defaults to large_conc.
+        @param large_queue_bytes: Look-ahead bytes of large operations, or None for no limit.
+        @param max_bytes: Maximum number of payload bytes (see StorageOperation.size())
+                          of all outstanding (queued or executing) operations, or None
+                          for no limit.
+        @param retry_policy: RetryPolicy deciding whether and when to retry failed
+                             operations. Defaults to not retrying.
+        @param adaptive: If given, a callable which is called with the maximum concurrency
+                         of each lane and returns an AdaptiveConcurrency (or similar)
+                         controller for that lane (AdaptiveConcurrency itself will do).
+                         The concurrency limits then become upper bounds on the actual
+                         concurrency chosen by the controller.
         '''
         self.backend_factory = backend_factory
         self.max_conc = max_conc
+        self.queue_depth = max_conc if queue_depth is None else queue_depth
+        self.queue_bytes = queue_bytes
+        self.large_threshold = large_threshold
+        self.max_bytes = max_bytes
+        self.retry_policy = RetryPolicy() if retry_policy is None else retry_policy
 
-        # We maintain a set of currently oustanding operations. We
-        # never keep more here than the number of workers that we
-        # have; so in effect the current implementation is not really
-        # a queue, but rather a manager of a number of slots. A future
-        # improvement is to actually support a small queue in order to
-        # allow optimal use of available workers (without it workers
-        # will be idle as the front-end struggles to generate more
-        # work for us when we have a slot free).
+        # Operations are executed by pools of long-lived worker
+        # threads, each of which owns a backend instance for its
+        # entire life time. Workers are started lazily (never more
+        # than the concurrency limit) and pick operations off of a
+        # bounded FIFO queue.
+        #
+        # Operations are routed to a lane depending on their size. As
+        # small operations are limited by latency and large ones by
+        # bandwidth, this allows keeping concurrency high for small
+        # operations (which is cheap in terms of memory) while
+        # limiting concurrency, and thus memory use, for large ones.
+        # Without large_threshold there is just the one lane.
+        #
+        # We maintain a set of currently oustanding operations
+        # (queued or executing), and per lane the queue of operations
+        # not yet picked up by a worker. The latter is the look-ahead,
+        # whose depth (in operations and bytes) is bounded separately
+        # from worker concurrency. enqueue() only blocks when the
+        # look-ahead is full, which means that workers can keep going
+        # while the front-end is busy producing more work (e.g.
+        # reading and hashing the next block).
+        #
+        # Independently of lanes, max_bytes bounds the payload bytes
+        # (i.e., block data of PUTs) held by outstanding operations,
+        # as the look-ahead and concurrency limits alone would allow
+        # memory use to grow with the block size.
         #
-        # The associated condition is signalled whenever an item is
-        # removed from the dict. Its lock also protects access to the
-        # backend cache.
+        # Failed operations that are to be retried remain
+        # outstanding, but are kept aside (rather than occupying a
+        # sleeping worker) until their retry is due, at which point
+        # the retry thread puts them at the head of their lane's
+        # queue. Note that an operation which is waiting to be
+        # retried cannot run while all workers of its lane are busy;
+        # in particular, callbacks that block waiting for *other*
+        # operations to complete may deadlock when retries are
+        # enabled.
         #
-        # For the moment, we keep it simple.
+        # barrier() does not drain the queue. Instead, every operation
+        # belongs to the epoch current at the time it was enqueued,
+        # and barrier() starts a new epoch. Workers only pick up an
+        # operation if no operation of an earlier epoch is still
+        # outstanding; thus operations after a barrier are queued
+        # (subject to the look-ahead limits) while those before it
+        # finish, and start as soon as they have.
+        #
+        # An operation enqueued while the most recently enqueued
+        # operation on the same object is still outstanding may be
+        # coalesced with it (see StorageOperation.coalesces_with()):
+        # a repeated PUT of the same block, or a repeated GET. It
+        # still passes through the queue in order, but rather than
+        # being executed it waits (without occupying a worker) for
+        # the outcome of the operation it was coalesced with, and
+        # is never retried on its own.
+        #
+        # __cond is signalled whenever an item is removed from the
+        # set of outstanding operations. __room is signalled whenever
+        # an operation leaves a queue or the set of outstanding
+        # operations. The lanes' work conditions are signalled
+        # whenever an operation is queued, when an epoch has been
+        # completed, or when the workers are asked to terminate.
+        # __retry is signalled when an operation is set aside for
+        # retry. They all share the same lock, which protects all
+        # mutable state below.
         self.__ops = set()
-        self.__backends = set() # backend cache
+        self.__bytes = 0 # sum of size() of self.__ops
+        self.__closed = False
         self.__cond = threading.Condition()
+        self.__room = threading.Condition(self.__cond)
+        self.__retry = threading.Condition(self.__cond)
+        self.__retries = [] # heap of (due time, sequence number, operation)
+        self.__retry_seq = 0
+        self.__retry_thread = None
+        self.__epoch = 0 # epoch of operations enqueued from now on
+        self.__op_epochs = dict() # operation -> epoch
+        self.__epoch_ops = dict() # epoch -> number of outstanding operations (if non-zero)
+        self.__latest = dict() # object name -> most recently enqueued outstanding operation
+        self.__threads = 0 # number of live threads (workers and others, see _thread_started())
+
+        self.__small = _Lane('small',
+                             self.__cond,
+                             max_conc,
+                             self._max_threads(max_conc),
+                             self.queue_depth,
+                             queue_bytes,
+                             adaptive(max_conc) if adaptive else None)
+        if large_threshold is None:
+            self.__large = None
+            self.__lanes = [ self.__small ]
+        else:
+            large_conc = max_conc if large_conc is None else large_conc
+            self.__large = _Lane('large',
+                                 self.__cond,
+                                 large_conc,
+                                 self._max_threads(large_conc),
+                                 large_conc if large_queue_depth is None else large_queue_depth,
+                                 large_queue_bytes,
+                                 adaptive(large_conc) if adaptive else None)
+            self.__lanes = [ self.__small, self.__large ]
 
         self.__failed = False # set to true when an operation fails
 
+        # statistics; see stats()
+        self.__ops_completed = 0
+        self.__ops_failed = 0
+        self.__first_enqueue = None
+        self.__last_completion = None
+        self.__enqueue_wait = 0.0 # seconds spent blocking in enqueue()
+        self.__worker_idle = 0.0  # seconds spent by workers waiting for work
+        self.__peak_bytes = 0     # peak value of self.__bytes
+        self.__retry_count = 0    # number of retries scheduled
+        self.__barrier_count = 0  # number of barriers that started a new epoch
+        self.__coalesced = collections.defaultdict(int) # mnemonic -> operations coalesced
+        self.__worker_busy = 0.0  # seconds spent by workers dispatching operations
+        self.__latency = dict()   # mnemonic -> metrics.Histogram of execution times
+        self.__transferred = collections.defaultdict(int) # mnemonic -> payload bytes
+
     def __enter__(self):
         return self
 
     def __exit__(self, *args, **kwargs):
-        pass #self.wait()
+        self.close()
 
     def enqueue(self, op):
         '''Enqueue an operation for execution as soon as possible.
@@ -208,37 +766,299 @@ class StorageQueue(object):
         if self.__failed:
             raise OperationHasFailed('a previous operation has failed; refusing further work')
 
+        lane = self.__lane_for(op)
+
         with self.__cond:
-            while len(self.__ops) >= self.max_conc:
-                self.__cond.wait()
+            assert not self.__closed, 'enqueue() on closed storage queue'
+
+            if lane.is_full(op) or self.__over_budget(op):
+                before = time.time()
+                while lane.is_full(op) or self.__over_budget(op):
+                    self.__room.wait()
+                self.__enqueue_wait += time.time() - before
+
+            if self.__first_enqueue is None:
+                self.__first_enqueue = time.time()
+            lane.ops_started += 1
+
+            op.set_storage_queue(self)
+            self.__coalesce(op)
+            self._accept(op, lane.name)
             self.__ops.add(op)
-            self.__start_op(op)
+            self.__op_epochs[op] = self.__epoch
+            self.__epoch_ops[self.__epoch] = self.__epoch_ops.get(self.__epoch, 0) + 1
+            self.__bytes += op.size()
+            self.__peak_bytes = max(self.__peak_bytes, self.__bytes)
+            lane.queue.append(op)
+            lane.queued_bytes += op.size()
+
+            self.__wake_worker(lane)
+
+    def __coalesce(self, op):
+        '''Coalesce op with the latest outstanding operation on the
+        same object, if possible.
+
+        @pre self.__cond locked'''
+        name = op.object_name()
+        if name is None:
+            return
+
+        latest = self.__latest.get(name)
+        if latest is not None and op.coalesces_with(latest):
+            op.coalesce(latest.primary or latest)
+            self.__coalesced[op.mnemonic] += 1
+        self.__latest[name] = op
+
+    def _max_threads(self, max_conc):
+        '''@return The maximum number of worker threads of a lane with
+                   the given concurrency limit.'''
+        return max_conc
+
+    def _accept(self, op, lane_name):
+        '''Called, with the queue locked, when op has been accepted by
+        enqueue() into the named lane. The default implementation does
+        nothing.'''
+        pass
+
+    def _dispatch(self, op, backend, release):
+        '''Execute op using backend. Called by a worker thread, which
+        will pick up the next operation when this method returns.
+        release() must be called once op is no longer to be counted
+        towards the concurrency limit.
+
+        The default implementation performs the operation
+        synchronously (i.e., the worker thread is occupied for the
+        entire duration of the operation, including its
+        callback).'''
+        try:
+            op.perform(backend)
+        finally:
+            release()
+
+    def __over_budget(self, op):
+        '''@pre self.__cond locked
+
+        @return Whether adding op to the outstanding operations would
+                exceed max_bytes. An operation is always accepted if no
+                other operation is outstanding, regardless of its
+                size.'''
+        return (self.max_bytes is not None
+                and self.__ops
+                and self.__bytes + op.size() > self.max_bytes)
+
+    def __lane_for(self, op):
+        if self.__large is not None and op.payload_size() >= self.large_threshold:
+            return self.__large
+        else:
+            return self.__small
+
+    def __wake_worker(self, lane):
+        '''Make sure a worker will pick up the operation just queued
+        to the given lane, starting one if necessary and allowed.
 
-    def __start_op(self, op):
+        @pre self.__cond locked'''
+        if lane.idle == 0 and len(lane.workers) < min(lane.max_threads, lane.active_limit()):
+            self.__start_worker(lane)
+        lane.work.notify()
+
+    def __start_worker(self, lane):
         '''@pre self.__cond locked'''
-        # We should maintain a thread pool, but for simplicity in the
-        # initial implementation we just launch a dedicated thread.
-        if self.__backends:
-            backend = self.__backends.pop()
+        log.debug('instantiating new backend')
+        backend = self.backend_factory()
+        self.__threads += 1
+
+        worker = threading.Thread(target=self.__worker_main,
+                                  args=(lane, backend),
+                                  name='storagequeue-%s-worker-%d' % (lane.name, len(lane.workers)))
+        worker.setDaemon(True)
+        lane.workers.append(worker)
+        worker.start()
+
+    def __worker_main(self, lane, backend):
+        release = util.bind(self.__release, lane)
+        try:
+            while True:
+                with self.__cond:
+                    if not self.__runnable(lane) and not self.__done_for(lane):
+                        before = time.time()
+                        while not self.__runnable(lane) and not self.__done_for(lane):
+                            lane.idle += 1
+                            lane.work.wait()
+                            lane.idle -= 1
+                        if self.__runnable(lane): # else woken up by close()
+                            self.__worker_idle += time.time() - before
+
+                    if not self.__runnable(lane):
+                        break # closed, and nothing left for us to do
+
+                    op = lane.queue.popleft()
+                    lane.queued_bytes -= op.size()
+                    lane.inflight += 1
+                    self.__room.notifyAll()
+
+                before = time.time()
+                try:
+                    self._dispatch(op, backend, release)
+                except Exception, e:
+                    # operations are not supposed to leak errors, but
+                    # we must not lose the worker if they do.
+                    log.error('unexpected error in storage queue worker: %s',
+                              traceback.format_exc())
+                with self.__cond:
+                    self.__worker_busy += time.time() - before
+        finally:
+            backend.close()
+            self._thread_exited()
+
+    def _thread_started(self):
+        '''Register a thread which close() is to wait for; the thread
+        must call _thread_exited() when done.'''
+        with self.__cond:
+            self.__threads += 1
+
+    def _thread_exited(self):
+        with self.__cond:
+            self.__threads -= 1
+            self.__cond.notifyAll()
+
+    def __runnable(self, lane):
+        '''@pre self.__cond locked
+
+        @return Whether a worker of the given lane may pick up the
+                operation at the head of its queue right now.'''
+        return (lane.runnable()
+                and self.__op_epochs[lane.queue[0]] == min(self.__epoch_ops.iterkeys()))
+
+    def __release(self, lane):
+        with self.__cond:
+            lane.inflight -= 1
+            if self.__closed:
+                lane.work.notifyAll() # see __done_for()
+            elif lane.queue:
+                lane.work.notify()
+
+    def __done_for(self, lane):
+        '''@pre self.__cond locked
+
+        @return Whether workers of the given lane may terminate.
+                Operations still in flight may yet be retried, so we
+                wait for them.'''
+        return (self.__closed
+                and not lane.queue
+                and lane.inflight == 0
+                and not [ op for (due, seq, op) in self.__retries if self.__lane_for(op) is lane ])
+
+    def __adapt(self, lane, op, success):
+        '''Feed the outcome of an operation to the lane's concurrency
+        controller, if any.
+
+        @pre self.__cond locked'''
+        if not lane.controller or op.primary is not None:
+            return
+
+        old_limit = lane.controller.limit
+        if success:
+            changed = lane.controller.observe(op.elapsed, bool(lane.queue))
         else:
-            log.debug('instantiating new backend')
-            backend = self.backend_factory()
+            changed = lane.controller.failure()
 
-        def op_runner():
-            op.set_storage_queue(self)
-            op.perform(backend)
+        if changed:
+            log.info('%s lane concurrency: %d -> %d', lane.name, old_limit, lane.controller.limit)
+            lane.work.notifyAll()
+
+    def __retry_main(self):
+        with self.__cond:
+            try:
+                while self.__retries or not self.__closed:
+                    if not self.__retries:
+                        self.__retry.wait()
+                        continue
+
+                    now = time.time()
+                    due, seq, op = self.__retries[0]
+                    if due > now:
+                        self.__retry.wait(due - now)
+                        continue
 
-        thread.start_new_thread(op_runner, ())
+                    heapq.heappop(self.__retries)
+                    lane = self.__lane_for(op)
+                    lane.queue.appendleft(op)
+                    lane.queued_bytes += op.size()
+                    self.__wake_worker(lane)
+            finally:
+                # allow notify_operation_retry() to start a new thread
+                # should an operation fail after we are done
+                self.__retry_thread = None
+                self.__threads -= 1
+                self.__cond.notifyAll()
+
+    def notify_operation_retry(self, op, error):
+        '''Called by a failed operation to give the queue a chance to
+        retry it.
+
+        @param error: Human-readable description of the failure.
+
+        @return Whether the operation has been rescheduled. If not, it
+                must proceed to fail.'''
+        if op.primary is not None or not self.retry_policy.should_retry(op.attempts):
+            return False
+
+        delay = self.retry_policy.delay(op.attempts)
+
+        log.warning('operation failed (attempt %d of %d), retrying in %.2f seconds: %s',
+                    op.attempts, self.retry_policy.max_attempts, delay, str(op))
+        log.debug('traceback: %s', error)
+
+        with self.__cond:
+            assert op in self.__ops, 'got retry notify from unknown operation %s' % (str(op,))
+
+            self.__adapt(self.__lane_for(op), op, False)
+            self.__retry_count += 1
+            self.__retry_seq += 1
+            heapq.heappush(self.__retries, (time.time() + delay, self.__retry_seq, op))
+
+            if self.__retry_thread is None:
+                self.__retry_thread = threading.Thread(target=self.__retry_main,
+                                                       name='storagequeue-retry')
+                self.__retry_thread.setDaemon(True)
+                self.__threads += 1
+                self.__retry_thread.start()
+            self.__retry.notify()
+
+        return True
 
     def __remove_op(self, op, success):
         with self.__cond:
             assert op in self.__ops, 'got notify from unknown operation %s' % (str(op,))
 
-            if not success:
+            if success:
+                self.__ops_completed += 1
+            else:
+                self.__ops_failed += 1
                 self.__failed = True
+            self.__last_completion = time.time()
+            self.__adapt(self.__lane_for(op), op, success)
+
+            if op.primary is None and op.elapsed is not None:
+                if op.mnemonic not in self.__latency:
+                    self.__latency[op.mnemonic] = metrics.Histogram()
+                self.__latency[op.mnemonic].record(op.elapsed)
+                if success:
+                    self.__transferred[op.mnemonic] += op.bytes_transferred()
 
             self.__ops.remove(op)
-            self.__cond.notify()
+            self.__bytes -= op.size()
+            if self.__latest.get(op.object_name()) is op:
+                del self.__latest[op.object_name()]
+            self.__cond.notifyAll()
+            self.__room.notifyAll()
+
+            epoch = self.__op_epochs.pop(op)
+            self.__epoch_ops[epoch] -= 1
+            if not self.__epoch_ops[epoch]:
+                del self.__epoch_ops[epoch]
+                for lane in self.__lanes:
+                    lane.work.notifyAll()
 
     def notify_operation_complete(self, op):
         self.__remove_op(op, True)
@@ -250,16 +1070,286 @@ class StorageQueue(object):
         '''Guarantee that all operations queued before this call
         execute prior to any operations queued after this call.
 
-        @note The current implementation simply blocks, but that may
-              change in the future. If you *want* blocking, sue
-              wait().'''
-        self.wait()
+        This does not block; operations queued after the barrier are
+        held back until those before it have completed (including
+        their callbacks). If you *want* blocking, use wait().'''
+        with self.__cond:
+            if self.__ops:
+                self.__epoch += 1
+                self.__barrier_count += 1
 
     def wait(self):
-        '''Wait for all outstanding operations to complete.'''
+        '''Wait for all outstanding operations to complete, or for one
+        to fail; operations still outstanding then may never complete
+        (see close()).'''
         with self.__cond:
-            while self.__ops:
+            while self.__ops and not self.__failed:
                 self.__cond.wait()
 
         if self.__failed:
             raise OperationHasFailed('one or more operations failed')
+
+    def has_failed(self):
+        '''@return Whether an operation has failed.'''
+        with self.__cond:
+            return self.__failed
+
+    def close(self):
+        '''Terminate the worker threads (closing their backends) once
+        all queued operations have been picked up, and wait for them
+        to finish. The queue may not be used after having been
+        closed.
+
+        Once an operation has failed, threads still busy are abandoned
+        (they are daemon threads) rather than waited for, as their
+        operations may never finish; e.g. callbacks waiting for the
+        outcome of the failed operation.'''
+        with self.__cond:
+            self.__closed = True
+            self.__retry.notify()
+            for lane in self.__lanes:
+                lane.work.notifyAll()
+        self._closing()
+
+        with self.__cond:
+            while self.__threads and not self.__failed:
+                self.__cond.wait()
+            if self.__threads:
+                log.warning('an operation has failed; abandoning %d storage queue threads', self.__threads)
+
+    def _closing(self):
+        '''Called by close() before waiting for threads to finish. The
+        default implementation does nothing.'''
+        pass
+
+    def stats(self):
+        '''Return a dict of statistics about the operations executed
+        so far:
+
+          - ops_started: Operations accepted by enqueue().
+          - ops_completed: Operations that completed successfully.
+          - ops_failed: Operations that failed.
+          - threads_started: Worker threads started.
+          - thread_starts_saved: Thread creations avoided relative to
+            starting a dedicated thread for each operation.
+          - elapsed: Seconds between the first enqueue() and the most
+            recent completion of an operation.
+          - ops_per_second: Completed (successful or not) operations
+            per second over the elapsed time.
+          - enqueue_wait: Seconds spent blocking in enqueue() because
+            the look-ahead was full.
+          - worker_idle: Seconds spent by workers waiting for work
+            (summed over workers).
+          - retries: Number of times a failed operation was
+            rescheduled for another attempt.
+          - bytes_peak: Peak payload bytes held by outstanding
+            operations (the quantity bounded by max_bytes).
+          - barriers: Number of calls to barrier() which had to hold
+            back subsequent operations.
+          - coalesced: Dict of mnemonic ('PUT', 'GET') to the number
+            of operations which were coalesced with an outstanding
+            operation rather than executed.
+          - lanes: Dict of lane name ('small', and 'large' if
+            large_threshold was given) to a dict with the
+            ops_started and threads_started of that lane, along with
+            its current concurrency limit (concurrency) and, if
+            adaptive, concurrency_history as a list of (seconds since
+            the first enqueue(), limit) tuples.'''
+        with self.__cond:
+            ops_started = sum([ lane.ops_started for lane in self.__lanes ])
+            threads_started = sum([ len(lane.workers) for lane in self.__lanes ])
+            done = self.__ops_completed + self.__ops_failed
+            if self.__first_enqueue is not None and self.__last_completion is not None:
+                elapsed = self.__last_completion - self.__first_enqueue
+            else:
+                elapsed = 0.0
+
+            return dict(ops_started=ops_started,
+                        ops_completed=self.__ops_completed,
+                        ops_failed=self.__ops_failed,
+                        threads_started=threads_started,
+                        thread_starts_saved=ops_started - threads_started,
+                        elapsed=elapsed,
+                        ops_per_second=(done / elapsed) if elapsed > 0 else 0.0,
+                        enqueue_wait=self.__enqueue_wait,
+                        worker_idle=self.__worker_idle,
+                        retries=self.__retry_count,
+                        bytes_peak=self.__peak_bytes,
+                        barriers=self.__barrier_count,
+                        coalesced=dict(self.__coalesced),
+                        lanes=dict([ (lane.name, self.__lane_stats(lane))
+                                     for lane in self.__lanes ]))
+
+    def metrics(self):
+        '''Return a dict of the statistics returned by stats(), along
+        with more detailed metrics:
+
+          - latency: Dict of mnemonic to a summary (see
+            metrics.Histogram.to_dict()) of the execution times, in
+            seconds, of the final attempts of operations (excluding
+            coalesced operations).
+          - bytes: Dict of mnemonic to the number of payload bytes
+            transferred by successful operations.
+          - bytes_per_second: Payload bytes transferred per second
+            over the elapsed time.
+          - queued: Operations currently queued (look-ahead).
+          - inflight: Operations currently picked up by workers.
+          - outstanding: Operations currently enqueued but not done.
+          - worker_busy: Seconds spent by workers dispatching
+            operations (summed over workers).
+          - worker_utilization: Fraction of the time workers spent
+            busy rather than waiting for work.
+
+        The result can be dumped as JSON (see metrics.dump()).'''
+        result = self.stats()
+        with self.__cond:
+            busy_and_idle = self.__worker_busy + self.__worker_idle
+            total_bytes = sum(self.__transferred.itervalues())
+
+            result.update(latency=dict([ (mnemonic, histogram.to_dict())
+                                         for mnemonic, histogram in self.__latency.iteritems() ]),
+                          bytes=dict(self.__transferred),
+                          bytes_per_second=(total_bytes / result['elapsed']) if result['elapsed'] > 0 else 0.0,
+                          queued=sum([ len(lane.queue) for lane in self.__lanes ]),
+                          inflight=sum([ lane.inflight for lane in self.__lanes ]),
+                          outstanding=len(self.__ops),
+                          worker_busy=self.__worker_busy,
+                          worker_utilization=(self.__worker_busy / busy_and_idle) if busy_and_idle > 0 else 0.0)
+        return result
+
+    def __lane_stats(self, lane):
+        '''@pre self.__cond locked'''
+        stats = dict(ops_started=lane.ops_started,
+                     threads_started=len(lane.workers),
+                     concurrency=lane.active_limit())
+        if lane.controller:
+            start = self.__first_enqueue or 0.0
+            stats['concurrency_history'] = [ (max(0.0, when - start), limit)
+                                             for when, limit in lane.controller.history ]
+        return stats
+
+class AsyncStorageQueue(StorageQueue):
+    '''A StorageQueue for high concurrency, where operations in flight
+    need not each occupy a thread.
+
+    Backends with an asynchronous interface (see backend.Backend) are
+    driven through it, and a worker thread goes on to pick up the next
+    operation as soon as it has started one; thus the concurrency
+    limits (max_conc, large_conc) may be in the hundreds or thousands
+    while only a handful of threads exist. For other backends the
+    worker threads act as an executor of synchronous operations,
+    meaning that concurrency is effectively limited to the number of
+    executor threads.
+
+    Results are delivered (and callbacks invoked) by a single delivery
+    thread, strictly in the order in which operations were enqueued
+    into their lane (large operations, if configured, never hold up
+    the delivery of small ones). Callbacks may therefore rely on the
+    callbacks of all operations enqueued before them into the same
+    lane having completed, but must never wait for operations enqueued
+    after them. An operation whose result has not yet been delivered
+    counts towards the concurrency limit, so a slow operation holds up
+    at most max_conc operations worth of results.
+
+    Apart from the above, the interface and semantics are those of a
+    StorageQueue.'''
+    def __init__(self, backend_factory, max_conc, executor_threads=DEFAULT_EXECUTOR_THREADS, **kwargs):
+        '''
+        @param executor_threads: Maximum number of worker threads per lane.
+
+        Remaining parameters are those of StorageQueue.
+        '''
+        self.executor_threads = executor_threads
+
+        # Completed operations waiting to be delivered, keyed by (lane
+        # name, sequence number), along with the keys of all accepted
+        # operations and, per lane, the next sequence number to be
+        # assigned and to be delivered. The associated condition is
+        # signalled when an operation is handed to us for delivery, or
+        # when we are closed. The delivery thread terminates once
+        # closed and every accepted operation has been delivered.
+        self.__seqs = dict()
+        self.__next_seq = collections.defaultdict(int)
+        self.__completed = dict()
+        self.__next_delivery = collections.defaultdict(int)
+        self.__delivery_closed = False
+        self.__delivery_cond = threading.Condition()
+
+        StorageQueue.__init__(self, backend_factory, max_conc, **kwargs)
+
+        self.__delivery_thread = threading.Thread(target=self.__delivery_main,
+                                                  name='storagequeue-delivery')
+        self.__delivery_thread.setDaemon(True)
+        self._thread_started()
+        self.__delivery_thread.start()
+
+    def _max_threads(self, max_conc):
+        return min(max_conc, self.executor_threads)
+
+    def _accept(self, op, lane_name):
+        with self.__delivery_cond:
+            if op not in self.__seqs:
+                self.__seqs[op] = (lane_name, self.__next_seq[lane_name])
+                self.__next_seq[lane_name] += 1
+
+    def _dispatch(self, op, backend, release):
+        def executed(value, error):
+            if error is not None and op.primary is None and self.retry_policy.should_retry(op.attempts):
+                # Nothing is delivered for attempts that are to be
+                # retried, so there is no reason to wait for our turn.
+                try:
+                    op.complete(value, error)
+                finally:
+                    release()
+            else:
+                with self.__delivery_cond:
+                    self.__completed[self.__seqs.pop(op)] = (op, value, error, release)
+                    self.__delivery_cond.notify()
+
+        op.perform_async(backend, executed)
+
+    def __delivery_main(self):
+        try:
+            self.__deliver()
+        finally:
+            self._thread_exited()
+
+    def __deliver(self):
+        while True:
+            with self.__delivery_cond:
+                while (self.__deliverable() is None
+                       and not (self.__delivery_closed and not self.__completed and not self.__seqs)):
+                    self.__delivery_cond.wait()
+
+                key = self.__deliverable()
+                if key is None:
+                    break # closed, and nothing left to deliver
+
+                op, value, error, release = self.__completed.pop(key)
+                self.__next_delivery[key[0]] += 1
+
+            try:
+                op.complete(value, error)
+            except Exception, e:
+                # operations are not supposed to leak errors, but we
+                # must not lose the delivery thread if they do.
+                log.error('unexpected error in storage queue delivery: %s',
+                          traceback.format_exc())
+            finally:
+                release()
+
+    def __deliverable(self):
+        '''@return The key of a completed operation whose turn it is to
+                   be delivered, or None.
+
+        @pre self.__delivery_cond locked'''
+        for lane_name in self.__next_seq.iterkeys():
+            key = (lane_name, self.__next_delivery[lane_name])
+            if key in self.__completed:
+                return key
+        return None
+
+    def _closing(self):
+        with self.__delivery_cond:
+            self.__delivery_closed = True
+            self.__delivery_cond.notify()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 Peter Schuller <peter.schuller@infidyne.com>
+
+'''
+Micro-benchmark of chunking (reading files into blocks), not part of
+the unit tests. Reads a temporary file of random data with each
+chunker and prints the throughput in MB/s, along with that of hashing
+(with sha512) for comparison.
+
+Usage: PYTHONPATH=../src python bench_chunking.py [size-in-mb]
+'''
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+import shastity.chunking as chunking
+
+BLOCKSIZE = 1024*1024
+
+class ListExtendingChunker(object):
+    '''The fixed size chunker as it used to be, extending a list by
+    each *character* of every read, for comparison.'''
+    def chunks(self, f):
+        while True:
+            parts = []
+            sofar = 0
+            while sofar < BLOCKSIZE:
+                part = f.read(BLOCKSIZE - sofar)
+                if len(part) == 0:
+                    break
+                parts += part
+                sofar += len(part)
+            block = ''.join(parts)
+            if len(block) == 0:
+                break
+            yield block
+
+class HashingChunker(chunking.FixedSizeChunker):
+    '''The fixed size chunker, also hashing each block with sha512
+    (as persisting does), for comparison.'''
+    def chunks(self, f):
+        for block in chunking.FixedSizeChunker.chunks(self, f):
+            hashlib.sha512(block).digest()
+            yield block
+
+def bench(name, chunker, path, size):
+    start = time.time()
+    with open(path, 'rb') as f:
+        for block in chunker.chunks(f):
+            pass
+    elapsed = time.time() - start
+    print '%-40s %10.1f MB/s' % (name, size / elapsed / (1024*1024))
+
+def main(argv):
+    size = int(argv[1] if len(argv) > 1 else 64) * 1024 * 1024
+
+    fd, path = tempfile.mkstemp(suffix='-shastity-bench')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for n in xrange(0, size / BLOCKSIZE):
+                f.write(os.urandom(BLOCKSIZE))
+
+        bench('fixed (list extending, before)', ListExtendingChunker(), path, size)
+        bench('fixed', chunking.FixedSizeChunker(BLOCKSIZE), path, size)
+        bench('fixed, hashing with sha512', HashingChunker(BLOCKSIZE), path, size)
+        if chunking.numpy is not None:
+            bench('fastcdc (numpy)', chunking.FastCDCChunker(BLOCKSIZE / 4, BLOCKSIZE, BLOCKSIZE * 4), path, size)
+        bench('fastcdc (pure python)',
+              chunking.FastCDCChunker(BLOCKSIZE / 4, BLOCKSIZE, BLOCKSIZE * 4, vectorized=False),
+              path,
+              size)
+    finally:
+        os.unlink(path)
+
+if __name__ == "__main__":
+    main(sys.argv)
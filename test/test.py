@@ -14,10 +14,13 @@ import unittest
 # the bug is.
 test_names = [ 'logging',
                'hash',
+               'compression',
                'util',
+               'metrics',
                'spencode',
                'metadata',
                'filesystem',
+               'chunking',
                'backends',
                'storagequeue',
                'traversal',
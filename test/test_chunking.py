@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 Peter Schuller <peter.schuller@infidyne.com>
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import random
+import StringIO
+import unittest
+
+import shastity.chunking as chunking
+
+def random_data(size, seed=0):
+    rnd = random.Random(seed)
+    return ''.join([ chr(rnd.randint(0, 255)) for n in xrange(0, size) ])
+
+class FixedSizeChunkerTests(unittest.TestCase):
+    def test_chunks(self):
+        chunker = chunking.FixedSizeChunker(4)
+        self.assertEqual(list(chunker.chunks(StringIO.StringIO('abcdefghij'))), [ 'abcd', 'efgh', 'ij' ])
+        self.assertEqual(list(chunker.chunks(StringIO.StringIO(''))), [])
+
+    def test_pieces(self):
+        chunker = chunking.FixedSizeChunker(4)
+        self.assertEqual(list(chunker.pieces(StringIO.StringIO('abcdefghij'), 3)),
+                         [ ('abc', False), ('d', True), ('efg', False), ('h', True), ('ij', True) ])
+        self.assertEqual(list(chunker.pieces(StringIO.StringIO('abcdefgh'), 4)),
+                         [ ('abcd', True), ('efgh', True) ])
+        self.assertEqual(list(chunker.pieces(StringIO.StringIO(''))), [])
+
+    def test_split(self):
+        chunker = chunking.FixedSizeChunker(4)
+        self.assertEqual(list(chunker.split('abcdefghij')), [ (0, 4), (4, 4), (8, 2) ])
+
+class FastCDCChunkerTests(unittest.TestCase):
+    def setUp(self):
+        self.chunker = chunking.FastCDCChunker(256, 1024, 4096)
+        self.data = random_data(64 * 1024)
+
+    def test_sizes(self):
+        blocks = list(self.chunker.chunks(StringIO.StringIO(self.data)))
+
+        self.assertEqual(''.join(blocks), self.data)
+        for block in blocks[:-1]:
+            self.assertTrue(256 <= len(block) <= 4096, len(block))
+
+        # roughly the average (normalized chunking keeps it close)
+        avg = len(self.data) / len(blocks)
+        self.assertTrue(512 <= avg <= 2048, avg)
+
+    def test_deterministic(self):
+        self.assertEqual(list(self.chunker.chunks(StringIO.StringIO(self.data))),
+                         list(self.chunker.chunks(StringIO.StringIO(self.data))))
+
+    def test_short(self):
+        self.assertEqual(list(self.chunker.chunks(StringIO.StringIO('short'))), [ 'short' ])
+        self.assertEqual(list(self.chunker.chunks(StringIO.StringIO(''))), [])
+
+    def test_insertion(self):
+        before = list(self.chunker.chunks(StringIO.StringIO(self.data)))
+        after = list(self.chunker.chunks(StringIO.StringIO(self.data[:100] + 'x' + self.data[100:])))
+
+        # only the blocks around the insertion should differ
+        self.assertTrue(len(set(before) - set(after)) <= 2)
+
+    def test_zeroes(self):
+        # no cut points in uniform data; blocks of max_size
+        blocks = list(self.chunker.chunks(StringIO.StringIO('\0' * 10000)))
+        self.assertEqual([ len(b) for b in blocks ], [ 4096, 4096, 1808 ])
+
+    def test_split(self):
+        self.assertEqual([ self.data[offset:offset + length] for (offset, length) in self.chunker.split(self.data) ],
+                         list(self.chunker.chunks(StringIO.StringIO(self.data))))
+
+    def test_vectorized(self):
+        if chunking.numpy is None:
+            return # nothing to compare against
+
+        # the last parameters hash several pieces (see _HASH_PIECE) per read
+        for params, data in [ ((256, 1024, 4096), self.data),
+                              ((1, 2, 3), self.data),
+                              ((20, 64, 200), self.data),
+                              ((32, 64, 128), self.data),
+                              ((40, 64, 100), self.data),
+                              ((1024, 8192, 100000), random_data(400 * 1024)) ]:
+            pure = chunking.FastCDCChunker(vectorized=False, *params)
+            vectorized = chunking.FastCDCChunker(vectorized=True, *params)
+            self.assertEqual(list(pure.chunks(StringIO.StringIO(data))),
+                             list(vectorized.chunks(StringIO.StringIO(data))))
+            self.assertEqual(list(pure.split(data)), list(vectorized.split(data)))
+
+class MakeChunkerTests(unittest.TestCase):
+    def test_spec_round_trip(self):
+        for spec in [ 'fixed-1024', 'fastcdc-256-1024-4096' ]:
+            self.assertEqual(chunking.make_chunker(spec).spec(), spec)
+
+    def test_unsupported(self):
+        for spec in [ 'fixed', 'fixed-x', 'fastcdc-1-2', 'rabin-1-2-3' ]:
+            self.assertRaises(chunking.UnsupportedChunker, lambda: chunking.make_chunker(spec))
+
+if __name__ == "__main__":
+    unittest.main()
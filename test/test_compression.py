@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 Peter Schuller <peter.schuller@infidyne.com>
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import os
+import pickle
+import unittest
+
+import shastity.compression as compression
+
+class CompressionTests(unittest.TestCase):
+    def test_roundtrip(self):
+        block = 'compressible text ' * 1000
+        for codec in compression.available_codecs():
+            compressor = compression.make_compressor(codec)
+            name = compressor.block_name('abcd', block)
+            self.assertEqual(name, 'abcd.%s' % (codec,))
+            data = compressor.compress(block)
+            self.assertTrue(len(data) < len(block))
+            self.assertEqual(compression.decompress(name, data), block)
+
+    def test_incompressible(self):
+        compressor = compression.make_compressor('zlib', 9)
+        block = os.urandom(64*1024)
+        self.assertEqual(compressor.block_name('abcd', block), 'abcd')
+        self.assertEqual(compressor.block_name('abcd', ''), 'abcd')
+        # only the beginning of a block is sampled
+        self.assertEqual(compressor.block_name('abcd', '\0' * 4096 + block), 'abcd.zlib')
+        self.assertEqual(compressor.block_name('abcd', buffer('\0' * 4096 + block)), 'abcd.zlib')
+
+    def test_names(self):
+        self.assertEqual(compression.split_name('abcd'), ('abcd', None))
+        self.assertEqual(compression.split_name('abcd.zlib'), ('abcd', 'zlib'))
+        self.assertEqual(compression.decompress('abcd', 'raw data'), 'raw data')
+
+    def test_misc(self):
+        self.assertTrue('zlib' in compression.available_codecs())
+        self.assertEqual(compression.make_compressor('none'), None)
+        compressor = pickle.loads(pickle.dumps(compression.make_compressor('zlib')))
+        self.assertEqual((compressor.codec, compressor.level), ('zlib', 6))
+
+    def test_badcodec(self):
+        self.assertRaises(compression.UnsupportedCodec, lambda: compression.make_compressor('random codec'))
+        self.assertRaises(compression.UnsupportedCodec, lambda: compression.decompress('abcd.random', ''))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -80,6 +80,15 @@ class FileSystemBaseCase(object):
             f = self.fs.open(subsym, 'r')
             self.assertEqual(f.read(), 'hello world')
             f.close()
+
+            # successful rename(), replacing the destination?
+            renamed = os.path.join(subdir, 'renamed')
+            self.fs.open(renamed, 'w').close()
+            self.fs.rename(subfile, renamed)
+            self.assertFalse(self.fs.exists(subfile))
+            f = self.fs.open(renamed, 'r')
+            self.assertEqual(f.read(), 'hello world')
+            f.close()
             self.fs.rmtree(subdir)
 
         self.assertFalse(self.fs.exists(tpath), 'tempdir should be removed')
@@ -88,10 +97,65 @@ class LocalFileSystemTests(FileSystemBaseCase, unittest.TestCase):
     def make_file_system(self):
         return fs.LocalFileSystem()
 
+    def test_mmap(self):
+        with self.fs.tempdir() as tdir:
+            path = os.path.join(tdir.path, 'file')
+            with self.fs.open(path, 'w') as f:
+                f.write('mapped contents')
+            mapping = self.fs.mmap(path)
+            try:
+                self.assertEqual(len(mapping), 15)
+                self.assertEqual(mapping[7:], 'contents')
+            finally:
+                mapping.close()
+
+            empty = os.path.join(tdir.path, 'empty')
+            self.fs.open(empty, 'w').close()
+            self.assertEqual(self.fs.mmap(empty), None)
+
+    def test_data_extents(self):
+        with self.fs.tempdir() as tdir:
+            path = os.path.join(tdir.path, 'sparse')
+            with self.fs.open(path, 'w') as f:
+                f.write('data')
+                f.seek(4*1024*1024)
+                f.write('more data')
+                f.truncate(8*1024*1024)
+            extents = self.fs.data_extents(path)
+            if extents is not None:
+                # how much surrounds the data depends on the file system
+                self.assertTrue(extents)
+                self.assertEqual(extents[0][0], 0)
+                self.assertTrue(extents[-1][0] + extents[-1][1] <= 8*1024*1024)
+                self.assertTrue(sum([ length for (offset, length) in extents ]) < 8*1024*1024)
+
 class MemoryFileSystemTests(FileSystemBaseCase, unittest.TestCase):
     def make_file_system(self):
         return fs.MemoryFileSystem()
 
+    def test_mmap(self):
+        with self.fs.tempdir() as tdir:
+            path = os.path.join(tdir.path, 'file')
+            with self.fs.open(path, 'w') as f:
+                f.write('not mappable')
+            self.assertEqual(self.fs.mmap(path), None)
+            self.assertEqual(self.fs.data_extents(path), None)
+
+    def test_seek(self):
+        with self.fs.tempdir() as tdir:
+            path = os.path.join(tdir.path, 'file')
+            with self.fs.open(path, 'w') as f:
+                f.write('abc')
+                f.seek(2, os.SEEK_CUR)
+                f.write('de')
+                self.assertEqual(f.tell(), 7)
+                f.seek(0)
+                f.write('A')
+                f.seek(10)
+                f.truncate()
+            with self.fs.open(path, 'r') as f:
+                self.assertEqual(f.read(), 'Abc\0\0de\0\0\0')
+
     def test_creationmodes(self):
         # test creation but do not bother testing flags since it
         # effectively boilds down to cut'n'paste anyway
@@ -11,7 +11,7 @@ import shastity.hash as hash
 
 class HashTests(unittest.TestCase):
     def test_generic(self):
-        for algo in hash._our_supported_hashlib_algos:
+        for algo in hash.available_algos():
             h = hash.make_hasher(algo)
             self.assertTrue(h is not None, 'should have been given a hasher')
             self.assertTrue(callable(h), 'hasher should be callable')
@@ -26,6 +26,63 @@ class HashTests(unittest.TestCase):
         sha512 = hash.make_hasher('sha512')
         self.assertEqual(sha512('test'), ('sha512', 'ee26b0dd4af7e749aa1a8ee3c10ae9923f618980772e473f8819a5d4940e0db27ac185f8a0e1d5f84f88bc887fd67b143732c304cc5fa9ad8e6f57f50028a8ff'))
 
+    def test_blake2b(self):
+        if 'blake2b' not in hash.available_algos():
+            return # optional
+        blake2b = hash.make_hasher('blake2b')
+        self.assertEqual(blake2b('test'), ('blake2b', 'a71079d42853dea26e453004338670a53814b78137ffbed07603a41d76a483aa9bc33b582f77d30a65e6f29a896c0411f38312e1d66e0bf16386c86a89bea572'))
+
+    def test_available(self):
+        self.assertTrue('sha512' in hash.available_algos())
+        for algo in hash.available_algos():
+            self.assertTrue(hash.benchmark(algo, size=1024, blocksize=1024) > 0)
+
+    def test_stream(self):
+        for algo in hash.available_algos():
+            h = hash.make_stream_hasher(algo)
+            h.update('test ')
+            h.update('data')
+            self.assertEqual(h.digest(), hash.make_hasher(algo)('test data'))
+
+    def test_pieces(self):
+        data = ''.join([ chr(n % 251) for n in xrange(0, 3 * hash.PIECE_SIZE + 1000) ])
+
+        def digest(*parts):
+            h = hash.make_piece_hasher('sha512')
+            for part in parts:
+                h.update(part)
+            return h.digest()
+
+        sha512 = hash.make_hasher('sha512')
+        pieces = [ data[n:n + hash.PIECE_SIZE] for n in xrange(0, len(data), hash.PIECE_SIZE) ]
+        expected = sha512(''.join([ sha512(piece)[1].decode('hex') for piece in pieces ]))
+        self.assertEqual(digest(data), expected)
+        self.assertEqual(digest(data[:1], data[1:100000], data[100000:]), expected)
+        self.assertEqual(digest(''), sha512(''))
+
+        # parts hashed separately, at any offsets
+        for cuts in [ [ 0, len(data) ], [ 0, 10, 70000, 70001, len(data) ], [ 0, hash.PIECE_SIZE, len(data) ] ]:
+            whole = hash.make_piece_hasher('sha512')
+            for start, end in zip(cuts, cuts[1:]):
+                part = hash.make_piece_hasher('sha512', start)
+                part.update(data[start:end])
+                whole.add(part.parts())
+            self.assertEqual(whole.digest(), expected)
+
+        # zeros
+        for offset in [ None, 0, 1000 ]:
+            for length in [ 0, 10, hash.PIECE_SIZE, 3 * hash.PIECE_SIZE + 10 ]:
+                h1 = hash.make_piece_hasher('sha512', offset)
+                h2 = hash.make_piece_hasher('sha512', offset)
+                h1.update('x')
+                h2.update('x')
+                h1.update_zeros(length)
+                h2.update('\0' * length)
+                if offset is None:
+                    self.assertEqual(h1.digest(), h2.digest())
+                else:
+                    self.assertEqual(h1.parts(), h2.parts())
+
     def test_badalgo(self):
         def fail():
             hash.make_hasher('random non-existent algo')
@@ -68,6 +68,18 @@ class ManifestBaseCase(object):
             self.assertEqual([ to_comparable(entry) for entry in entries_in ],
                              [ to_comparable(entry) for entry in entries_out])
 
+    def test_digests(self):
+        with self.make_backend() as b:
+            meta = md.FileMetaData.from_string('-rwxr-xr-x 5 6 7 8 9 10')
+            entries_in = [ ('a | b', meta, [ ('sha512', 'abc') ]), ('c', meta, []) ]
+
+            manifest.write_manifest(b, 'test_manifest', entries_in, digests={ 'a | b': ('sha512', 'def') })
+            self.assertEqual([ (path, hashes) for (path, meta, hashes) in manifest.read_manifest(b, 'test_manifest') ],
+                             [ (path, hashes) for (path, meta, hashes) in entries_in ])
+            self.assertEqual(manifest.read_manifest_digests(b, 'test_manifest'), { 'a | b': ('sha512', 'def') })
+
+            manifest.delete_manifest(b, 'test_manifest')
+
 class MemoryTests(ManifestBaseCase, unittest.TestCase):
     def make_file_system(self):
         return fs.MemoryFileSystem()
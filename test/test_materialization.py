@@ -9,13 +9,16 @@ import errno
 import os.path
 import shutil
 import tempfile
+import threading
 import unittest
 
 import shastity.backends.directorybackend as directorybackend
 import shastity.backends.memorybackend as memorybackend
+import shastity.compression as compression
 import shastity.filesystem as fs
 import shastity.hash as hash
 import shastity.logging as logging
+import shastity.manifest as manifest
 import shastity.materialization as materialization
 import shastity.metadata as md
 import shastity.persistence as persistence
@@ -26,7 +29,57 @@ log = logging.get_logger(__name__)
 
 CONCURRENCY = 10
 
+class TrackingFileSystem(object):
+    '''Wraps a file system, recording the files opened for writing,
+    in order, and the maximum number open at once. If fail_writes is
+    True, writing to them raises IOError.'''
+    def __init__(self, fs, fail_writes=False):
+        self.fail_writes = fail_writes
+        self.opened = []
+        self.open_files = 0
+        self.peak_open_files = 0
+
+        self.__fs = fs
+        self.__lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.__fs, name)
+
+    def open(self, path, mode):
+        f = self.__fs.open(path, mode)
+        if mode == 'r':
+            return f
+
+        with self.__lock:
+            self.opened.append(path)
+            self.open_files += 1
+            self.peak_open_files = max(self.peak_open_files, self.open_files)
+        return TrackedFile(self, f)
+
+    def closed(self):
+        with self.__lock:
+            self.open_files -= 1
+
+class TrackedFile(object):
+    def __init__(self, tracker, f):
+        self.__tracker = tracker
+        self.__f = f
+
+    def __getattr__(self, name):
+        return getattr(self.__f, name)
+
+    def write(self, data):
+        if self.__tracker.fail_writes:
+            raise IOError(errno.ENOSPC, 'no space left on device (simulated)')
+        self.__f.write(data)
+
+    def close(self):
+        self.__f.close()
+        self.__tracker.closed()
+
 class MaterializationBaseCase(object):
+    queue_class = storagequeue.StorageQueue
+
     def setUp(self):
         self.tempdir = tempfile.mkdtemp(suffix='-shastity_directory_backend_unittest')
         log.debug('using temporary directory %s', self.tempdir)
@@ -42,7 +95,7 @@ class MaterializationBaseCase(object):
         return os.path.join(base, (reduce(os.path.join, [ comp for comp in p.split('/') if comp ])))
 
     def test_basic(self):
-        with storagequeue.StorageQueue(lambda: self.make_backend(), CONCURRENCY) as sq:
+        with self.queue_class(lambda: self.make_backend(), CONCURRENCY) as sq:
             with self.fs.tempdir() as tdir:
                 # Populate a tree.
                 self.fs.mkdir(self.path(tdir.path, 'testdir'))
@@ -98,6 +151,250 @@ class MaterializationBaseCase(object):
 
                     rec(tdir.path, rdir.path)
 
+    def persist_tree(self, sq, tdir, contents, **kwargs):
+        '''Create the files of contents (a dict of paths to bodies) in
+        tdir, and persist it with the given options. Returns the
+        manifest.'''
+        for fname, body in contents.items():
+            with self.fs.open(self.path(tdir.path, fname), 'a') as f:
+                f.write(body)
+
+        traverser = traversal.traverse(self.fs, tdir.path)
+        return list(persistence.persist(self.fs, traverser, None, tdir.path, sq, **kwargs))
+
+    def restore(self, rdir, manifest, filesystem=None, **kwargs):
+        '''Materialize manifest into rdir (of filesystem, by default
+        self.fs) with the given options.'''
+        # the queue is closed to make sure that callbacks (and thus
+        # writes) have completed
+        with self.queue_class(lambda: self.make_backend(), CONCURRENCY) as rsq:
+            materialization.materialize(filesystem or self.fs, rdir.path, manifest, rsq, **kwargs)
+
+    def compare(self, rdir, contents):
+        '''Check that the files of contents in rdir have the given bodies.'''
+        for fname, body in contents.items():
+            with self.fs.open(self.path(rdir.path, fname), 'r') as f:
+                self.assertEqual(f.read(), body)
+
+    def restore_and_compare(self, manifest, contents, **kwargs):
+        '''Materialize manifest into a new directory with the given
+        options, and check that its files have the given contents.'''
+        with self.fs.tempdir() as rdir:
+            self.restore(rdir, manifest, **kwargs)
+            self.compare(rdir, contents)
+
+    def delete_blocks(self, sq, *manifests):
+        for name in set([ hex for mf in manifests for (path, meta, hashes) in mf for (algo, hex) in hashes
+                          if algo != manifest.ZERO_ALGO ]):
+            sq.enqueue(storagequeue.DeleteOperation(name))
+        sq.wait()
+
+    def test_zero_runs(self):
+        with self.queue_class(lambda: self.make_backend(), CONCURRENCY) as sq:
+            with self.fs.tempdir() as tdir:
+                contents = dict(leading='\0' * 25 + 'data',
+                                middle='data' + '\0' * 40 + 'more data',
+                                trailing='data' + '\0' * 30,
+                                zeros='\0' * 45)
+                manifest = self.persist_tree(sq, tdir, contents, blocksize=10)
+
+                self.restore_and_compare(manifest, contents)
+
+                self.delete_blocks(sq, manifest)
+
+    def test_positional(self):
+        with self.queue_class(lambda: self.make_backend(), CONCURRENCY) as sq:
+            with self.fs.tempdir() as tdir:
+                contents = dict(empty='',
+                                blocks=''.join([ 'block %3d ' % (n,) for n in xrange(0, 20) ]),
+                                sparse='data' + '\0' * 40 + 'more data',
+                                trailing='data' + '\0' * 30)
+                manifest = self.persist_tree(sq, tdir, contents, blocksize=10)
+
+                with self.fs.tempdir() as rdir:
+                    self.restore(rdir, manifest, blocksize=10)
+                    self.assertEqual(sorted(self.fs.listdir(rdir.path)), sorted(contents.keys()))
+                    self.compare(rdir, contents)
+
+                self.delete_blocks(sq, manifest)
+
+    def test_reorder_buffer(self):
+        with self.queue_class(lambda: self.make_backend(), CONCURRENCY) as sq:
+            with self.fs.tempdir() as tdir:
+                contents = dict(empty='',
+                                blocks=''.join([ 'block %3d ' % (n,) for n in xrange(0, 50) ]),
+                                sparse='data' + '\0' * 40 + 'more data')
+                manifest = self.persist_tree(sq, tdir, contents, blocksize=10)
+
+                # with a tiny budget, most early blocks are spilled
+                for budget in [ 1024*1024, 10 ]:
+                    stats = materialization.MaterializationStats()
+                    self.restore_and_compare(manifest, contents, reorder_budget=budget, stats=stats)
+                    self.assertTrue(stats.peak_parked_bytes <= max(budget, 10) + 10)
+                    self.assertTrue(stats.bytes_spilled <= stats.bytes_parked)
+
+                self.delete_blocks(sq, manifest)
+
+    def test_max_open_files(self):
+        with self.queue_class(lambda: self.make_backend(), CONCURRENCY) as sq:
+            with self.fs.tempdir() as tdir:
+                self.fs.mkdir(self.path(tdir.path, 'dir'))
+                contents = dict([ (self.path('dir', 'small%d' % (n,)), 'small %d' % (n,))
+                                  for n in xrange(0, 10) ])
+                contents['large'] = ''.join([ 'block %3d ' % (n,) for n in xrange(0, 50) ])
+                contents['medium'] = 'medium sized file'
+                contents['empty'] = ''
+                manifest = self.persist_tree(sq, tdir, contents, blocksize=10)
+                nblocks = dict([ (os.path.basename(path), len(hashes)) for (path, meta, hashes) in manifest ])
+
+                modes = [ dict(), dict(reorder_budget=1024), dict(blocksize=10),
+                          dict(reorder_budget=1024, blocksize=10) ]
+                for max_open_files in [ 1, 3 ]:
+                    for kwargs in modes:
+                        tracker = TrackingFileSystem(self.fs)
+                        with self.fs.tempdir() as rdir:
+                            self.restore(rdir, manifest, filesystem=tracker, max_open_files=max_open_files,
+                                         **kwargs)
+                            self.compare(rdir, contents)
+
+                        # files are opened smallest (in blocks) first
+                        self.assertEqual(len(tracker.opened), len(contents))
+                        opened = [ nblocks[os.path.basename(path).replace('.shastity-partial.', '')]
+                                   for path in tracker.opened ]
+                        self.assertEqual(opened, sorted(opened))
+                        self.assertTrue(tracker.peak_open_files <= max_open_files, tracker.peak_open_files)
+                        self.assertEqual(tracker.open_files, 0)
+
+                # a failing write must fail the restore, rather than keep the
+                # file's slot forever
+                for kwargs in modes:
+                    failures = []
+                    def restore_failing():
+                        with self.fs.tempdir() as rdir:
+                            try:
+                                self.restore(rdir, manifest, filesystem=TrackingFileSystem(self.fs, True),
+                                             max_open_files=1, **kwargs)
+                            except (storagequeue.OperationHasFailed, materialization.WriteFailed), e:
+                                failures.append(e)
+                    t = threading.Thread(target=restore_failing)
+                    t.setDaemon(True)
+                    t.start()
+                    t.join(10)
+                    self.assertFalse(t.isAlive(), kwargs)
+                    self.assertEqual(len(failures), 1)
+
+                self.delete_blocks(sq, manifest)
+
+    def test_block_cache(self):
+        with self.queue_class(lambda: self.make_backend(), CONCURRENCY) as sq:
+            with self.fs.tempdir() as tdir:
+                body = ''.join([ 'block %3d ' % (n,) for n in xrange(0, 20) ])
+                contents = dict(a=body,
+                                b=body,
+                                c='block   0 block   1 ' + body,
+                                d='unique data')
+                manifest = self.persist_tree(sq, tdir, contents, blocksize=10)
+                names = [ hex for (path, meta, hashes) in manifest for (algo, hex) in hashes ]
+                saved = len(names) - len(set(names))
+                self.assertTrue(saved >= 42)
+
+                # with no budget, only references to blocks in flight are served
+                for cache_budget in [ 1024*1024, 0 ]:
+                    for kwargs in [ dict(reorder_budget=1024), dict(blocksize=10) ]:
+                        stats = materialization.MaterializationStats()
+                        self.restore_and_compare(manifest, contents, stats=stats, cache_budget=cache_budget,
+                                                 **kwargs)
+                        if cache_budget:
+                            self.assertEqual(stats.gets_saved, saved)
+                            self.assertTrue(stats.peak_cached_bytes <= cache_budget)
+                        else:
+                            self.assertEqual(stats.peak_cached_bytes, 0)
+
+                self.delete_blocks(sq, manifest)
+
+    def test_delta(self):
+        with self.queue_class(lambda: self.make_backend(), CONCURRENCY) as sq:
+            with self.fs.tempdir() as tdir:
+                body = ''.join([ 'block %3d ' % (n,) for n in xrange(0, 20) ])
+                contents = dict(same=body,
+                                changed=body,
+                                sparse='data' + '\0' * 40 + 'more data',
+                                missing='not restored before')
+                manifest = self.persist_tree(sq, tdir, contents, blocksize=10)
+
+                for kwargs in [ dict(), dict(cache_budget=1024*1024) ]:
+                    with self.fs.tempdir() as rdir:
+                        self.restore(rdir, manifest, blocksize=10)
+
+                        # modify, grow and shrink files, and add one not in the backup
+                        with self.fs.open(self.path(rdir.path, 'changed'), 'r+') as f:
+                            f.seek(35)
+                            f.write('XX')
+                            f.seek(0, os.SEEK_END)
+                            f.write('appended')
+                        with self.fs.open(self.path(rdir.path, 'sparse'), 'r+') as f:
+                            f.seek(20)
+                            f.write('not zeros')
+                            f.truncate(30)
+                        self.fs.unlink(self.path(rdir.path, 'missing'))
+                        with self.fs.open(self.path(rdir.path, 'extra'), 'w') as f:
+                            f.write('extra')
+
+                        stats = materialization.MaterializationStats()
+                        self.restore(rdir, manifest, blocksize=10, stats=stats, delta=True, **kwargs)
+                        self.compare(rdir, contents)
+                        self.compare(rdir, dict(extra='extra'))
+
+                        # all of same, all but one block of changed, and the first block of sparse
+                        self.assertEqual(stats.blocks_reused, 20 + 19 + 1)
+                        self.assertEqual(stats.bytes_reused, 200 + 190 + 10)
+
+                self.delete_blocks(sq, manifest)
+
+    def test_missing_block(self):
+        with self.queue_class(lambda: self.make_backend(), CONCURRENCY) as sq:
+            with self.fs.tempdir() as tdir:
+                manifest = self.persist_tree(sq, tdir, dict(file='first block second block'), blocksize=12)
+                hashes = manifest[0][2]
+                self.backend.delete(hashes[0][1])
+
+                # the callback of the second block waits for the first
+                # forever, which must not keep the queue from closing
+                failures = []
+                def restore_missing():
+                    with self.fs.tempdir() as rdir:
+                        try:
+                            self.restore(rdir, manifest)
+                        except storagequeue.OperationHasFailed, e:
+                            failures.append(e)
+                t = threading.Thread(target=restore_missing)
+                t.setDaemon(True)
+                t.start()
+                t.join(10)
+                self.assertFalse(t.isAlive())
+                self.assertEqual(len(failures), 1)
+
+                for algo, hex in hashes[1:]:
+                    sq.enqueue(storagequeue.DeleteOperation(hex))
+                sq.wait()
+
+    def test_compression(self):
+        with self.queue_class(lambda: self.make_backend(), CONCURRENCY) as sq:
+            with self.fs.tempdir() as tdir:
+                contents = dict(text='compressible text ' * 20,
+                                random=os.urandom(300))
+                stats = persistence.PersistenceStats()
+                manifest = self.persist_tree(sq, tdir, contents, blocksize=200, stats=stats,
+                                             compressor=compression.Compressor('zlib'))
+                names = [ hex for (path, meta, hashes) in manifest for (algo, hex) in hashes ]
+                self.assertTrue([ name for name in names if name.endswith('.zlib') ])
+                self.assertTrue([ name for name in names if '.' not in name ])
+                self.assertTrue(stats.bytes_stored < stats.bytes_uploaded)
+
+                self.restore_and_compare(manifest, contents)
+
+                self.delete_blocks(sq, manifest)
+
 class MemoryTests(MaterializationBaseCase, unittest.TestCase):
     def make_file_system(self):
         return fs.MemoryFileSystem()
@@ -105,6 +402,12 @@ class MemoryTests(MaterializationBaseCase, unittest.TestCase):
     def make_backend(self):
         return memorybackend.MemoryBackend('memory')
 
+class AsyncMemoryTests(MemoryTests):
+    queue_class = storagequeue.AsyncStorageQueue
+
+    def make_backend(self):
+        return memorybackend.MemoryBackend('memory', dict(max_fake_delay=0.01))
+
 class LocalFileSystemTests(MaterializationBaseCase, unittest.TestCase):
     def make_file_system(self):
         return fs.LocalFileSystem()
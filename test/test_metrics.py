@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2009 Peter Schuller <peter.schuller@infidyne.com>
+
+from __future__ import absolute_import
+from __future__ import with_statement
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import shastity.metrics as metrics
+
+class HistogramTests(unittest.TestCase):
+    def test_empty(self):
+        h = metrics.Histogram()
+        self.assertEqual(h.count(), 0)
+        self.assertEqual(h.percentile(50), 0.0)
+        self.assertEqual(h.to_dict()['max'], 0.0)
+
+    def test_exact_small_values(self):
+        h = metrics.Histogram(resolution=1)
+        for n in xrange(0, metrics.SUB_BUCKETS):
+            h.record(n)
+        self.assertEqual(h.percentile(50), metrics.SUB_BUCKETS / 2 - 1)
+        self.assertEqual(h.percentile(100), metrics.SUB_BUCKETS - 1)
+
+    def test_relative_error(self):
+        h = metrics.Histogram(resolution=1)
+        values = [ int(1.1 ** n) for n in xrange(0, 200) ]
+        for v in values:
+            h.record(v)
+
+        self.assertEqual(h.count(), len(values))
+        for p in [ 10, 50, 90, 99 ]:
+            exact = sorted(values)[int(len(values) * p / 100.0 + 0.5) - 1]
+            self.assertTrue(exact <= h.percentile(p) <= exact * (1 + 1.0 / metrics.SUB_BUCKETS) + 1,
+                            'p%d: %s vs %s' % (p, h.percentile(p), exact))
+        self.assertEqual(h.percentile(100), max(values))
+
+    def test_to_dict(self):
+        h = metrics.Histogram()
+        for v in [ 0.001, 0.002, 0.003, 0.004 ]:
+            h.record(v)
+        d = h.to_dict()
+        self.assertEqual(d['count'], 4)
+        self.assertEqual(d['min'], 0.001)
+        self.assertEqual(d['max'], 0.004)
+        self.assertAlmostEqual(d['mean'], 0.0025)
+        self.assertAlmostEqual(d['p50'], 0.002, 4)
+
+class SamplerTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(suffix='-shastity_metrics_unittest')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_final_sample(self):
+        path = os.path.join(self.tempdir, 'metrics')
+        with metrics.Sampler(lambda: dict(ops=1), path, 3600):
+            pass
+
+        lines = open(path).readlines()
+        self.assertEqual(len(lines), 1)
+        sample = json.loads(lines[0])
+        self.assertEqual(sample['ops'], 1)
+        self.assertTrue(sample['final'])
+        self.assertTrue('timestamp' in sample)
+
+if __name__ == "__main__":
+    unittest.main()
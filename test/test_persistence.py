@@ -6,6 +6,7 @@ from __future__ import absolute_import
 from __future__ import with_statement
 
 import errno
+import multiprocessing
 import os.path
 import shutil
 import tempfile
@@ -13,9 +14,12 @@ import unittest
 
 import shastity.backends.directorybackend as directorybackend
 import shastity.backends.memorybackend as memorybackend
+import shastity.chunking as chunking
+import shastity.compression as compression
 import shastity.filesystem as fs
 import shastity.hash as hash
 import shastity.logging as logging
+import shastity.manifest as manifest
 import shastity.metadata as md
 import shastity.persistence as persistence
 import shastity.storagequeue as storagequeue
@@ -26,6 +30,8 @@ log = logging.get_logger(__name__)
 CONCURRENCY = 10
 
 class PersistenceBaseCase(object):
+    queue_class = storagequeue.StorageQueue
+
     def setUp(self):
         self.tempdir = tempfile.mkdtemp(suffix='-shastity_directory_backend_unittest')
         log.debug('using temporary directory %s', self.tempdir)
@@ -41,7 +47,7 @@ class PersistenceBaseCase(object):
         return os.path.join(base, (reduce(os.path.join, [ comp for comp in p.split('/') if comp ])))
 
     def test_basic(self):
-        with storagequeue.StorageQueue(lambda: self.make_backend(), CONCURRENCY) as sq:
+        with self.queue_class(lambda: self.make_backend(), CONCURRENCY) as sq:
             with self.fs.tempdir() as tdir:
                 # populate
                 self.fs.mkdir(self.path(tdir.path, 'testdir'))
@@ -74,6 +80,143 @@ class PersistenceBaseCase(object):
                 for fname in files:
                     self.assertEqual(fname, hash.make_hasher('sha512')(self.backend.get(fname))[1])
 
+    def test_digests(self):
+        with self.queue_class(lambda: self.make_backend(), CONCURRENCY) as sq:
+            with self.fs.tempdir() as tdir:
+                self.populate(tdir)
+
+                digests = dict()
+                traverser = traversal.traverse(self.fs, tdir.path)
+                manifest = list(persistence.persist(self.fs,
+                                                    traverser,
+                                                    None,
+                                                    tdir.path,
+                                                    sq,
+                                                    blocksize=10,
+                                                    digests=digests))
+
+                self.assertEqual(sorted(digests.keys()), [ 'a.y', 'a/x' ])
+                for path, digest in digests.iteritems():
+                    h = hash.make_piece_hasher('sha512')
+                    h.update('incremental test file %s' % (path,))
+                    self.assertEqual(digest, h.digest())
+
+                self.delete_blocks(sq, manifest)
+
+    def test_zero_blocks(self):
+        with self.queue_class(lambda: self.make_backend(), CONCURRENCY) as sq:
+            with self.fs.tempdir() as tdir:
+                with self.fs.open(self.path(tdir.path, 'zeros'), 'a') as f:
+                    f.write('data' + '\0' * 36 + 'more' + '\0' * 30)
+
+                stats = persistence.PersistenceStats()
+                traverser = traversal.traverse(self.fs, tdir.path)
+                mf = list(persistence.persist(self.fs, traverser, None, tdir.path, sq,
+                                              blocksize=10, stats=stats))
+
+                hashes = mf[0][2]
+                self.assertEqual([ algo for (algo, hex) in hashes ],
+                                 [ 'sha512', manifest.ZERO_ALGO, 'sha512', manifest.ZERO_ALGO ])
+                self.assertEqual(hashes[1][1], '30')
+                self.assertEqual(hashes[3][1], '24')
+                self.assertEqual(stats.bytes_sparse, 54)
+                self.assertEqual(stats.blocks_uploaded, 2)
+
+                self.delete_blocks(sq, mf)
+
+    def persist_tree(self, tdir, sq, incremental=None):
+        '''Persist tdir, returning the manifest and the paths of the
+        files opened in the process.'''
+        opened = []
+        real_open = self.fs.open
+        def recording_open(path, mode):
+            opened.append(path)
+            return real_open(path, mode)
+
+        self.fs.open = recording_open
+        try:
+            traverser = traversal.traverse(self.fs, tdir.path)
+            manifest = list(persistence.persist(self.fs,
+                                                traverser,
+                                                incremental,
+                                                tdir.path,
+                                                sq,
+                                                blocksize=20))
+        finally:
+            del self.fs.open
+
+        return manifest, opened
+
+    def delete_blocks(self, sq, *manifests):
+        for name in set([ hex for mf in manifests for (path, meta, hashes) in mf for (algo, hex) in hashes
+                          if algo != manifest.ZERO_ALGO ]):
+            sq.enqueue(storagequeue.DeleteOperation(name))
+        sq.wait()
+
+    def populate(self, tdir):
+        self.fs.mkdir(self.path(tdir.path, 'a'))
+        with self.fs.open(self.path(tdir.path, 'a/x'), 'a') as f:
+            f.write('incremental test file a/x')
+        with self.fs.open(self.path(tdir.path, 'a.y'), 'a') as f:
+            f.write('incremental test file a.y')
+        self.fs.symlink(self.path(tdir.path, 'a.y'),
+                        self.path(tdir.path, 'b'))
+
+    def test_incremental_unchanged(self):
+        with self.queue_class(lambda: self.make_backend(), CONCURRENCY) as sq:
+            with self.fs.tempdir() as tdir:
+                self.populate(tdir)
+
+                first, opened = self.persist_tree(tdir, sq)
+                self.assertEqual(len(opened), 2)
+
+                second, opened = self.persist_tree(tdir, sq, iter(first))
+                self.assertEqual(opened, [])
+                self.assertEqual([ (path, hashes) for (path, meta, hashes) in second ],
+                                 [ (path, hashes) for (path, meta, hashes) in first ])
+
+                # hashes of another algorithm are never re-used
+                other = [ (path, meta, [ ('md5', hex) for (algo, hex) in hashes ])
+                          for (path, meta, hashes) in first ]
+                third, opened = self.persist_tree(tdir, sq, iter(other))
+                self.assertEqual(len(opened), 2)
+
+                self.delete_blocks(sq, first)
+
+    def test_block_index(self):
+        with self.queue_class(lambda: self.make_backend(), CONCURRENCY) as sq:
+            with self.fs.tempdir() as tdir:
+                with self.fs.open(self.path(tdir.path, 'x'), 'a') as f:
+                    f.write('twenty byte block.. ' * 3 + 'tail')
+
+                def run():
+                    stats = persistence.PersistenceStats()
+                    traverser = traversal.traverse(self.fs, tdir.path)
+                    manifest = list(persistence.persist(self.fs,
+                                                        traverser,
+                                                        None,
+                                                        tdir.path,
+                                                        sq,
+                                                        blocksize=20,
+                                                        index=persistence.BlockIndex.from_backend(self.backend),
+                                                        stats=stats))
+                    return manifest, stats
+
+                # identical blocks within a run are uploaded once
+                manifest, stats = run()
+                self.assertEqual(len(manifest[0][2]), 4)
+                self.assertEqual((stats.blocks_uploaded, stats.bytes_uploaded), (2, 24))
+                self.assertEqual((stats.blocks_deduplicated, stats.bytes_deduplicated), (2, 40))
+
+                # blocks already stored are not uploaded again
+                again, stats = run()
+                self.assertEqual(again[0][2], manifest[0][2])
+                self.assertEqual((stats.blocks_uploaded, stats.bytes_uploaded), (0, 0))
+                self.assertEqual((stats.blocks_deduplicated, stats.bytes_deduplicated), (4, 64))
+                self.assertEqual(sq.stats()['ops_started'], 2)
+
+                self.delete_blocks(sq, manifest)
+
 class MemoryTests(PersistenceBaseCase, unittest.TestCase):
     def make_file_system(self):
         return fs.MemoryFileSystem()
@@ -81,6 +224,12 @@ class MemoryTests(PersistenceBaseCase, unittest.TestCase):
     def make_backend(self):
         return memorybackend.MemoryBackend('memory')
 
+class AsyncMemoryTests(MemoryTests):
+    queue_class = storagequeue.AsyncStorageQueue
+
+    def make_backend(self):
+        return memorybackend.MemoryBackend('memory', dict(max_fake_delay=0.01))
+
 class LocalFileSystemTests(PersistenceBaseCase, unittest.TestCase):
     def make_file_system(self):
         return fs.LocalFileSystem()
@@ -88,6 +237,199 @@ class LocalFileSystemTests(PersistenceBaseCase, unittest.TestCase):
     def make_backend(self):
         return directorybackend.DirectoryBackend(self.tempdir)
 
+    def test_incremental_changed(self):
+        with self.queue_class(lambda: self.make_backend(), CONCURRENCY) as sq:
+            with self.fs.tempdir() as tdir:
+                self.populate(tdir)
+
+                first, opened = self.persist_tree(tdir, sq)
+
+                changed = self.path(tdir.path, 'a/x')
+                with self.fs.open(changed, 'a') as f:
+                    f.write(' (changed)')
+
+                second, opened = self.persist_tree(tdir, sq, iter(first))
+                self.assertEqual(opened, [ changed ])
+                self.assertNotEqual(second[1][2], first[1][2])
+                self.assertEqual(second[2][2], first[2][2])
+
+                self.delete_blocks(sq, first, second)
+
+    def test_parallel(self):
+        pool = multiprocessing.Pool(2)
+        try:
+            with self.queue_class(lambda: self.make_backend(), CONCURRENCY) as sq:
+                with self.fs.tempdir() as tdir:
+                    self.populate(tdir)
+                    for n in xrange(0, 5):
+                        with self.fs.open(self.path(tdir.path, 'file%d' % (n,)), 'a') as f:
+                            f.write(''.join([ 'line %d of file %d\n' % (i, n) for i in xrange(0, 20 * n) ]))
+                    # zero blocks straddling segment boundaries
+                    with self.fs.open(self.path(tdir.path, 'zeros'), 'a') as f:
+                        f.write('x' * 20 + '\0' * 60 + 'y' * 30 + '\0' * 100 + 'z' * 10)
+
+                    for chunker in [ chunking.FixedSizeChunker(20), chunking.FastCDCChunker(8, 16, 64) ]:
+                        def run(**kwargs):
+                            traverser = traversal.traverse(self.fs, tdir.path)
+                            return list(persistence.persist(self.fs,
+                                                            traverser,
+                                                            None,
+                                                            tdir.path,
+                                                            sq,
+                                                            chunker=chunker,
+                                                            **kwargs))
+
+                        sequential_digests, parallel_digests = dict(), dict()
+                        sequential = run(digests=sequential_digests)
+                        parallel = run(pool=pool, window=3, segment_size=50, digests=parallel_digests)
+                        self.assertEqual([ (path, hashes) for (path, meta, hashes) in parallel ],
+                                         [ (path, hashes) for (path, meta, hashes) in sequential ])
+                        self.assertEqual(parallel_digests, sequential_digests)
+                        self.delete_blocks(sq, sequential)
+
+                        # blocks are compressed by the workers
+                        compressor = compression.make_compressor('zlib')
+                        sequential = run(compressor=compressor)
+                        parallel = run(pool=pool, window=3, segment_size=50, compressor=compressor)
+                        self.assertEqual([ (path, hashes) for (path, meta, hashes) in parallel ],
+                                         [ (path, hashes) for (path, meta, hashes) in sequential ])
+                        self.delete_blocks(sq, sequential)
+
+                    # entries held back behind a file being read are bounded in
+                    # number, including those of unchanged files
+                    buffered = persistence.MAX_BUFFERED_ENTRIES
+                    persistence.MAX_BUFFERED_ENTRIES = 2
+                    try:
+                        sequential = list(persistence.persist(self.fs, traversal.traverse(self.fs, tdir.path),
+                                                              None, tdir.path, sq))
+                        for incremental in [ None, sequential ]:
+                            pulled = [0]
+                            def counting(traverser):
+                                for entry in traverser:
+                                    pulled[0] += 1
+                                    yield entry
+
+                            parallel = []
+                            for entry in persistence.persist(self.fs,
+                                                             counting(traversal.traverse(self.fs, tdir.path)),
+                                                             incremental and iter(incremental),
+                                                             tdir.path,
+                                                             sq,
+                                                             pool=pool,
+                                                             window=3,
+                                                             segment_size=50):
+                                parallel.append(entry)
+                                self.assertTrue(pulled[0] - len(parallel) < 2)
+                            self.assertEqual([ (path, hashes) for (path, meta, hashes) in parallel ],
+                                             [ (path, hashes) for (path, meta, hashes) in sequential ])
+                        self.delete_blocks(sq, sequential)
+                    finally:
+                        persistence.MAX_BUFFERED_ENTRIES = buffered
+
+                    # failures in workers propagate
+                    meta = self.fs.lstat(self.path(tdir.path, 'a.y'))
+                    self.assertRaises(persistence.HashingFailed,
+                                      lambda: list(persistence.persist(self.fs,
+                                                                       [ (self.path(tdir.path, 'missing'), meta) ],
+                                                                       None,
+                                                                       tdir.path,
+                                                                       sq,
+                                                                       pool=pool)))
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def test_sparse(self):
+        with self.queue_class(lambda: self.make_backend(), CONCURRENCY) as sq:
+            with self.fs.tempdir() as tdir:
+                path = self.path(tdir.path, 'sparse')
+                with self.fs.open(path, 'w') as f:
+                    f.write('data')
+                    f.seek(4*1024*1024)
+                    f.write('more data')
+                    f.truncate(8*1024*1024)
+
+                stats = persistence.PersistenceStats()
+                digests = dict()
+                traverser = traversal.traverse(self.fs, tdir.path)
+                mf = list(persistence.persist(self.fs, traverser, None, tdir.path, sq,
+                                              blocksize=64*1024, stats=stats, digests=digests))
+                # only the two blocks containing data are stored
+                self.assertEqual(stats.bytes_uploaded, 2*64*1024)
+                self.assertEqual(stats.bytes_sparse, 8*1024*1024 - 2*64*1024)
+                self.assertEqual([ algo for (algo, hex) in mf[0][2] ],
+                                 [ 'sha512', manifest.ZERO_ALGO, 'sha512', manifest.ZERO_ALGO ])
+
+                # workers are not handed the holes
+                job = persistence._FileJob(self.fs, 0, path, 'sparse', self.fs.lstat(path),
+                                           chunking.FixedSizeChunker(64*1024), 1024*1024, 'sha512', False)
+                self.assertEqual([ (offset, length) for (offset, length, hole) in job.pending if hole ],
+                                 [ (64*1024, 4*1024*1024 - 64*1024),
+                                   (4*1024*1024 + 64*1024, 4*1024*1024 - 64*1024) ])
+
+                pool = multiprocessing.Pool(2)
+                try:
+                    stats = persistence.PersistenceStats()
+                    parallel_digests = dict()
+                    traverser = traversal.traverse(self.fs, tdir.path)
+                    parallel = list(persistence.persist(self.fs, traverser, None, tdir.path, sq,
+                                                        blocksize=64*1024, stats=stats, pool=pool,
+                                                        segment_size=1024*1024, digests=parallel_digests))
+                finally:
+                    pool.terminate()
+                    pool.join()
+                self.assertEqual(parallel[0][2], mf[0][2])
+                self.assertEqual(stats.bytes_sparse, 8*1024*1024 - 2*64*1024)
+
+                # holes are digested as the zeros they read as
+                with self.fs.open(path, 'r') as f:
+                    h = hash.make_piece_hasher('sha512')
+                    h.update(f.read())
+                self.assertEqual(digests, dict(sparse=h.digest()))
+                self.assertEqual(parallel_digests, digests)
+
+                self.delete_blocks(sq, mf)
+
+    def test_mmap(self):
+        with self.queue_class(lambda: self.make_backend(), CONCURRENCY) as sq:
+            with self.fs.tempdir() as tdir:
+                self.populate(tdir)
+                with self.fs.open(self.path(tdir.path, 'big'), 'a') as f:
+                    f.write('twenty byte block.. ' * 10 + ''.join([ chr(n) for n in xrange(0, 256) ]))
+                    # zero blocks, and one only beginning and ending with zeros
+                    f.write('\0' * 304 + '\0' + 'x' * 18 + '\0' + '\0' * 40)
+
+                for chunker in [ chunking.FixedSizeChunker(20), chunking.FastCDCChunker(8, 16, 64) ]:
+                    def run(**kwargs):
+                        stats = persistence.PersistenceStats()
+                        traverser = traversal.traverse(self.fs, tdir.path)
+                        manifest = list(persistence.persist(self.fs,
+                                                            traverser,
+                                                            None,
+                                                            tdir.path,
+                                                            sq,
+                                                            chunker=chunker,
+                                                            index=persistence.BlockIndex.from_backend(self.backend),
+                                                            stats=stats,
+                                                            **kwargs))
+                        return manifest, stats
+
+                    mapped_digests, read_digests = dict(), dict()
+                    mapped, stats = run(mmap_threshold=100, digests=mapped_digests)
+                    self.assertTrue(stats.blocks_deduplicated > 0)
+                    for fname in self.backend.list():
+                        self.assertEqual(fname, hash.make_hasher('sha512')(self.backend.get(fname))[1])
+
+                    self.assertTrue(stats.bytes_sparse > 0)
+
+                    read, stats = run(digests=read_digests)
+                    self.assertEqual(stats.blocks_uploaded, 0)
+                    self.assertEqual(mapped_digests, read_digests)
+                    self.assertEqual([ (path, hashes) for (path, meta, hashes) in mapped ],
+                                     [ (path, hashes) for (path, meta, hashes) in read ])
+
+                    self.delete_blocks(sq, mapped)
+
 if os.getenv('SHASTITY_UNITTEST_S3_BUCKET') != None:
     class S3Tests(PersistenceBaseCase, unittest.TestCase):
         def make_file_system(self):
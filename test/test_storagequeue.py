@@ -8,6 +8,8 @@ from __future__ import with_statement
 import os
 import shutil
 import tempfile
+import threading
+import time
 import unittest
 
 import shastity.backend as backend
@@ -33,7 +35,33 @@ def prefix(name):
     '''Trivial convenience function for constructing a PREFIX:ed filename.'''
     return PREFIX + name
 
+class GatedOperation(storagequeue.StorageOperation):
+    '''Operation which blocks in execute() until its gate is opened,
+    releasing the started semaphore when it starts executing.'''
+    def __init__(self, gate, started, size=0):
+        storagequeue.StorageOperation.__init__(self, 'GATE', 'gated operation')
+
+        self.gate = gate
+        self.started = started
+        self.__size = size
+
+    def execute(self, backend):
+        self.started.release()
+        self.gate.wait()
+
+    def size(self):
+        return self.__size
+
+def enqueue_in_background(sq, op):
+    '''Enqueue op in a separate thread, returning the (started)
+    thread.'''
+    t = threading.Thread(target=lambda: sq.enqueue(op))
+    t.setDaemon(True)
+    t.start()
+    return t
+
 class StorageQueueBaseCase(object):
+    queue_class = storagequeue.StorageQueue
 
     def setUp(self):
         with self.make_backend() as backend:
@@ -57,7 +85,7 @@ class StorageQueueBaseCase(object):
         return [ name for name in backend.list() if name.startswith(PREFIX)]
 
     def test_basic(self):
-        with storagequeue.StorageQueue(lambda: self.make_backend(), CONCURRENCY) as sq:
+        with self.queue_class(lambda: self.make_backend(), CONCURRENCY) as sq:
             puts = [ storagequeue.PutOperation(prefix('test%s' % (n,)), str(n)) for n in xrange(0, 5) ]
             gets = [ storagequeue.GetOperation(prefix('test%s' % (n,))) for n in xrange(0, 5) ]
             dels = [ storagequeue.DeleteOperation(prefix('test%s' % (n,))) for n in xrange(0, 5) ]
@@ -108,7 +136,7 @@ class StorageQueueBaseCase(object):
 
     def test_bad_get_fail(self):
         with logging.FakeLogger(storagequeue, 'log'):
-            with storagequeue.StorageQueue(lambda: self.make_backend(), CONCURRENCY) as sq:
+            with self.queue_class(lambda: self.make_backend(), CONCURRENCY) as sq:
                 p1 = storagequeue.PutOperation(prefix('test1'), 'data')
                 g1 = storagequeue.GetOperation(prefix('test1'))
                 g2 = storagequeue.GetOperation(prefix('test2'))
@@ -125,7 +153,7 @@ class StorageQueueBaseCase(object):
                 raise AssertionError('put failed for unit testing purposes')
 
         with logging.FakeLogger(storagequeue, 'log'):
-            with storagequeue.StorageQueue(lambda: self.make_backend(), CONCURRENCY) as sq:
+            with self.queue_class(lambda: self.make_backend(), CONCURRENCY) as sq:
                 p1 = FailingPut(prefix('test1'), 'data')
 
                 sq.enqueue(p1)
@@ -133,7 +161,7 @@ class StorageQueueBaseCase(object):
                 self.assertRaises(storagequeue.OperationHasFailed, sq.wait)
 
     def test_bulk_ops(self):
-        with storagequeue.StorageQueue(lambda: self.make_backend(), CONCURRENCY) as sq:
+        with self.queue_class(lambda: self.make_backend(), CONCURRENCY) as sq:
             COUNT = 100
 
             puts = [ storagequeue.PutOperation(prefix(str(n)), str(n)) for n in xrange(0, COUNT) ]
@@ -161,10 +189,392 @@ class StorageQueueBaseCase(object):
 
             self.assertEqual([g.value() for g in gets], [ str(n) for n in xrange(0, COUNT) ])
 
+    def test_worker_reuse(self):
+        with self.queue_class(lambda: self.make_backend(), CONCURRENCY) as sq:
+            COUNT = 100
+
+            for n in xrange(0, COUNT):
+                sq.enqueue(storagequeue.PutOperation(prefix(str(n)), str(n)))
+            sq.barrier()
+            for n in xrange(0, COUNT):
+                sq.enqueue(storagequeue.DeleteOperation(prefix(str(n))))
+            sq.wait()
+
+            stats = sq.stats()
+            self.assertEqual(stats['ops_started'], 2 * COUNT)
+            self.assertEqual(stats['ops_completed'], 2 * COUNT)
+            self.assertEqual(stats['ops_failed'], 0)
+            self.assertTrue(stats['threads_started'] <= CONCURRENCY)
+            self.assertEqual(stats['thread_starts_saved'], 2 * COUNT - stats['threads_started'])
+            self.assertTrue(stats['ops_per_second'] > 0)
+
+            m = sq.metrics()
+            self.assertEqual(m['latency']['PUT']['count'], COUNT)
+            self.assertEqual(m['latency']['DEL']['count'], COUNT)
+            self.assertEqual(m['bytes']['PUT'], sum([ len(str(n)) for n in xrange(0, COUNT) ]))
+            self.assertEqual(m['outstanding'], 0)
+            self.assertTrue(0.0 < m['worker_utilization'] <= 1.0)
+
+    def test_barrier(self):
+        gate = threading.Event()
+        started = threading.Semaphore(0)
+        with self.queue_class(lambda: self.make_backend(), CONCURRENCY) as sq:
+            g1 = GatedOperation(gate, started)
+            sq.enqueue(g1)
+            started.acquire()
+
+            # the barrier does not block, but holds back what follows it
+            sq.barrier()
+            p1 = storagequeue.PutOperation(prefix('test1'), 'data')
+            sq.enqueue(p1)
+            time.sleep(0.1)
+            self.assertFalse(p1.is_done())
+            self.assertFalse(started.acquire(False))
+
+            gate.set()
+            sq.barrier()
+            g2 = storagequeue.GetOperation(prefix('test1'))
+            sq.enqueue(g2)
+            sq.barrier()
+            sq.enqueue(storagequeue.DeleteOperation(prefix('test1')))
+            sq.wait()
+
+            self.assertTrue(g1.succeeded())
+            self.assertEqual(g2.value(), 'data')
+            self.assertEqual(sq.stats()['barriers'], 3)
+
+    def test_coalescing(self):
+        gate = threading.Event()
+        started = threading.Semaphore(0)
+        with self.queue_class(lambda: self.make_backend(), CONCURRENCY, queue_depth=100) as sq:
+            # hold everything back until the gate opens, so that all
+            # operations are outstanding at the same time
+            sq.enqueue(GatedOperation(gate, started))
+            sq.barrier()
+
+            values = []
+            puts = [ storagequeue.PutOperation(prefix('test1'), 'data') for n in xrange(0, 5) ]
+            gets = [ storagequeue.GetOperation(prefix('test1'), callback=values.append) for n in xrange(0, 5) ]
+            for ops in [ puts, gets ]:
+                for op in ops:
+                    sq.enqueue(op)
+                sq.barrier()
+
+            # an intervening operation on the same object, or data of
+            # another length, prevents coalescing
+            for op in [ storagequeue.DeleteOperation(prefix('test1')),
+                        storagequeue.PutOperation(prefix('test1'), 'data'),
+                        storagequeue.PutOperation(prefix('test1'), 'other data'),
+                        storagequeue.DeleteOperation(prefix('test1')) ]:
+                sq.enqueue(op)
+                sq.barrier()
+
+            gate.set()
+            sq.wait()
+
+            self.assertEqual(values, [ 'data' ] * 5)
+            for op in puts + gets:
+                self.assertTrue(op.succeeded())
+            self.assertEqual([ op.primary for op in puts ], [ None ] + [ puts[0] ] * 4)
+            self.assertEqual(sq.stats()['coalesced'], dict(PUT=4, GET=4))
+
+    def test_look_ahead(self):
+        gate = threading.Event()
+        started = threading.Semaphore(0)
+        with self.queue_class(lambda: self.make_backend(), 2, queue_depth=3) as sq:
+            # occupy both workers
+            for n in xrange(0, 2):
+                sq.enqueue(GatedOperation(gate, started))
+            for n in xrange(0, 2):
+                started.acquire()
+
+            # look-ahead accepts three more without blocking
+            for n in xrange(0, 3):
+                sq.enqueue(GatedOperation(gate, started))
+
+            t = enqueue_in_background(sq, GatedOperation(gate, started))
+            time.sleep(0.1)
+            self.assertTrue(t.isAlive(), 'enqueue() should block on a full look-ahead')
+
+            gate.set()
+            t.join()
+            sq.wait()
+
+            self.assertTrue(sq.stats()['enqueue_wait'] > 0)
+
+    def test_look_ahead_bytes(self):
+        gate = threading.Event()
+        started = threading.Semaphore(0)
+        with self.queue_class(lambda: self.make_backend(), 1, queue_depth=10, queue_bytes=10) as sq:
+            sq.enqueue(GatedOperation(gate, started))
+            started.acquire()
+
+            # an empty queue accepts an operation regardless of its size
+            sq.enqueue(GatedOperation(gate, started, size=20))
+
+            t = enqueue_in_background(sq, GatedOperation(gate, started, size=1))
+            time.sleep(0.1)
+            self.assertTrue(t.isAlive(), 'enqueue() should block on look-ahead bytes')
+
+            gate.set()
+            t.join()
+            sq.wait()
+
+    def test_max_bytes(self):
+        gate = threading.Event()
+        started = threading.Semaphore(0)
+        with self.queue_class(lambda: self.make_backend(), CONCURRENCY, max_bytes=10) as sq:
+            sq.enqueue(GatedOperation(gate, started, size=6))
+            sq.enqueue(GatedOperation(gate, started, size=4))
+            started.acquire()
+            started.acquire()
+
+            # workers are available, but the byte budget is exhausted
+            t = enqueue_in_background(sq, GatedOperation(gate, started, size=1))
+            time.sleep(0.1)
+            self.assertTrue(t.isAlive(), 'enqueue() should block on max_bytes')
+
+            gate.set()
+            t.join()
+            sq.wait()
+
+            self.assertEqual(sq.stats()['bytes_peak'], 10)
+
+    def test_size_classes(self):
+        gate = threading.Event()
+        started = threading.Semaphore(0)
+        with self.queue_class(lambda: self.make_backend(),
+                              CONCURRENCY,
+                              large_threshold=10,
+                              large_conc=1) as sq:
+            # occupy the only large worker, and queue another large op behind it
+            sq.enqueue(GatedOperation(gate, started, size=10))
+            started.acquire()
+            sq.enqueue(GatedOperation(gate, started, size=100))
+
+            # small operations must not be held up by the large ones
+            puts = [ storagequeue.PutOperation(prefix(str(n)), str(n)) for n in xrange(0, 5) ]
+            for p in puts:
+                sq.enqueue(p)
+            for p in puts:
+                p.wait()
+                self.assertTrue(p.succeeded())
+
+            gate.set()
+            sq.barrier()
+
+            gets = [ storagequeue.GetOperation(prefix(str(n)), size_hint=1) for n in xrange(0, 5) ]
+            for g in gets:
+                sq.enqueue(g)
+            sq.wait()
+            self.assertEqual([ g.value() for g in gets ], [ str(n) for n in xrange(0, 5) ])
+
+            for n in xrange(0, 5):
+                sq.enqueue(storagequeue.DeleteOperation(prefix(str(n))))
+            sq.wait()
+
+            lanes = sq.stats()['lanes']
+            self.assertEqual(lanes['large']['ops_started'], 2)
+            self.assertEqual(lanes['large']['threads_started'], 1)
+            self.assertEqual(lanes['small']['ops_started'], 15)
+
 class MemoryBackendTests(StorageQueueBaseCase, unittest.TestCase):
     def make_backend(self):
         return memorybackend.MemoryBackend('memory', dict(max_fake_delay=0.1))
 
+    def make_flaky_backend(self):
+        return memorybackend.MemoryBackend('memory', dict(failure_rate=0.3))
+
+    def test_retry(self):
+        COUNT = 100
+
+        policy = storagequeue.RetryPolicy(max_attempts=30, base_delay=0.001, max_delay=0.01)
+        with logging.FakeLogger(storagequeue, 'log'):
+            with self.queue_class(self.make_flaky_backend, CONCURRENCY, retry_policy=policy) as sq:
+                puts = [ storagequeue.PutOperation(prefix(str(n)), str(n)) for n in xrange(0, COUNT) ]
+                gets = [ storagequeue.GetOperation(prefix(str(n))) for n in xrange(0, COUNT) ]
+                dels = [ storagequeue.DeleteOperation(prefix(str(n))) for n in xrange(0, COUNT) ]
+
+                for ops in [ puts, gets, dels ]:
+                    for op in ops:
+                        sq.enqueue(op)
+                    sq.barrier()
+                sq.wait()
+
+                for op in puts + gets + dels:
+                    self.assertTrue(op.succeeded())
+                self.assertEqual([g.value() for g in gets], [ str(n) for n in xrange(0, COUNT) ])
+
+                stats = sq.stats()
+                self.assertTrue(stats['retries'] > 0)
+                self.assertEqual(stats['retries'], sum([ op.attempts - 1 for op in puts + gets + dels ]))
+                self.assertTrue(stats['threads_started'] <= CONCURRENCY)
+
+    def test_retry_exhausted(self):
+        class FailingPut(storagequeue.PutOperation):
+            def execute(self, backend):
+                raise AssertionError('put failed for unit testing purposes')
+
+        policy = storagequeue.RetryPolicy(max_attempts=3, base_delay=0.001)
+        with logging.FakeLogger(storagequeue, 'log'):
+            with self.queue_class(self.make_backend, CONCURRENCY, retry_policy=policy) as sq:
+                p1 = FailingPut(prefix('test1'), 'data')
+
+                sq.enqueue(p1)
+
+                self.assertRaises(storagequeue.OperationHasFailed, sq.wait)
+                self.assertEqual(p1.attempts, 3)
+                self.assertFalse(p1.succeeded())
+                self.assertEqual(sq.stats()['retries'], 2)
+
+    def test_adaptive(self):
+        adaptive = lambda max_conc: storagequeue.AdaptiveConcurrency(max_conc, initial_conc=1, window=0.05)
+        with logging.FakeLogger(storagequeue, 'log'):
+            with self.queue_class(self.make_backend, CONCURRENCY, adaptive=adaptive) as sq:
+                COUNT = 100
+
+                puts = [ storagequeue.PutOperation(prefix(str(n)), str(n)) for n in xrange(0, COUNT) ]
+                dels = [ storagequeue.DeleteOperation(prefix(str(n))) for n in xrange(0, COUNT) ]
+
+                for p in puts:
+                    sq.enqueue(p)
+                sq.barrier()
+                for d in dels:
+                    sq.enqueue(d)
+                sq.wait()
+
+                for op in puts + dels:
+                    self.assertTrue(op.succeeded())
+
+                lane = sq.stats()['lanes']['small']
+                self.assertTrue(1 <= lane['concurrency'] <= CONCURRENCY)
+                self.assertTrue(len(lane['concurrency_history']) > 1, 'concurrency should have been raised')
+                self.assertTrue(lane['threads_started'] <= max([ limit for (t, limit) in lane['concurrency_history'] ]))
+
+    def test_adaptive_default(self):
+        CONC = 4 # gated operations execute synchronously; stay within executor_threads of AsyncStorageQueue
+
+        gate = threading.Event()
+        started = threading.Semaphore(0)
+        with self.queue_class(lambda: self.make_backend(), CONC, adaptive=storagequeue.AdaptiveConcurrency) as sq:
+            self.assertEqual(sq.stats()['lanes']['small']['concurrency'], CONC)
+
+            # all of them execute concurrently right away, without
+            # waiting for the limit to be raised
+            for n in xrange(0, CONC):
+                sq.enqueue(GatedOperation(gate, started))
+            for n in xrange(0, CONC):
+                started.acquire()
+
+            gate.set()
+            sq.wait()
+
+class AsyncMemoryBackendTests(MemoryBackendTests):
+    queue_class = storagequeue.AsyncStorageQueue
+
+    def test_many_in_flight(self):
+        COUNT = 500
+
+        with self.queue_class(self.make_backend, COUNT, executor_threads=2) as sq:
+            puts = [ storagequeue.PutOperation(prefix(str(n)), str(n)) for n in xrange(0, COUNT) ]
+            dels = [ storagequeue.DeleteOperation(prefix(str(n))) for n in xrange(0, COUNT) ]
+
+            before = time.time()
+            for p in puts:
+                sq.enqueue(p)
+            sq.barrier()
+            for d in dels:
+                sq.enqueue(d)
+            sq.wait()
+
+            # with 2 threads executing synchronously, this would take
+            # ~25 seconds (500 * 0.1 / 2 on average)
+            self.assertTrue(time.time() - before < 5.0)
+            for op in puts + dels:
+                self.assertTrue(op.succeeded())
+            self.assertTrue(sq.stats()['threads_started'] <= 2)
+
+    def test_callback_order(self):
+        COUNT = 100
+
+        completed = []
+        with self.queue_class(self.make_backend, CONCURRENCY) as sq:
+            for n in xrange(0, COUNT):
+                sq.enqueue(storagequeue.PutOperation(prefix(str(n)), str(n),
+                                                     callback=lambda value, n=n: completed.append(n)))
+            sq.barrier()
+            for n in xrange(0, COUNT):
+                sq.enqueue(storagequeue.DeleteOperation(prefix(str(n))))
+            sq.wait()
+
+        self.assertEqual(completed, range(0, COUNT))
+
+class AdaptiveConcurrencyTests(unittest.TestCase):
+    def simulate(self, ctl, windows, knee, latency=0.01):
+        '''Feed ctl with a simulated backend whose throughput scales
+        linearly with concurrency up to knee, beyond which only
+        latency grows. Returns the limit after each window.'''
+        now = 0.0
+        limits = []
+        for w in xrange(0, windows):
+            conc = ctl.limit
+            op_latency = latency * max(1.0, float(conc) / knee)
+            nops = int(conc / op_latency * ctl.window)
+            for n in xrange(0, nops):
+                now += ctl.window / nops
+                ctl.observe(op_latency, True, now)
+            limits.append(ctl.limit)
+        return limits
+
+    def test_finds_knee(self):
+        ctl = storagequeue.AdaptiveConcurrency(64, initial_conc=1, window=1.0)
+        limits = self.simulate(ctl, 100, knee=8)
+
+        self.assertEqual(max(limits), 9) # probes one beyond the knee
+        self.assertTrue(min(limits[20:]) >= 6) # never backs off far
+        self.assertEqual(ctl.history[-1][1], ctl.limit)
+
+    def test_respects_bounds(self):
+        ctl = storagequeue.AdaptiveConcurrency(4, min_conc=2, initial_conc=2, window=1.0)
+        limits = self.simulate(ctl, 20, knee=100)
+        self.assertEqual(limits[-1], 4)
+        self.assertTrue(min(limits) >= 2)
+
+    def test_starts_at_max(self):
+        self.assertEqual(storagequeue.AdaptiveConcurrency(64).limit, 64)
+        self.assertEqual(storagequeue.AdaptiveConcurrency(64, initial_conc=100).limit, 64)
+        self.assertEqual(storagequeue.AdaptiveConcurrency(64, min_conc=8, initial_conc=1).limit, 8)
+
+    def test_failure_decreases(self):
+        ctl = storagequeue.AdaptiveConcurrency(64, initial_conc=20, window=1.0)
+        ctl.failure(0.0)
+        self.assertTrue(ctl.failure(1.0))
+        self.assertEqual(ctl.limit, 15)
+
+    def test_not_backlogged(self):
+        ctl = storagequeue.AdaptiveConcurrency(64, initial_conc=5, window=1.0)
+        for n in xrange(0, 100):
+            ctl.observe(0.01, False, n * 0.1)
+        self.assertEqual(ctl.limit, 5)
+
+class RetryPolicyTests(unittest.TestCase):
+    def test_attempts(self):
+        policy = storagequeue.RetryPolicy(max_attempts=3)
+        self.assertTrue(policy.should_retry(1))
+        self.assertTrue(policy.should_retry(2))
+        self.assertFalse(policy.should_retry(3))
+        self.assertFalse(storagequeue.RetryPolicy().should_retry(1))
+
+    def test_delay(self):
+        policy = storagequeue.RetryPolicy(max_attempts=10, base_delay=1.0, max_delay=5.0, jitter=0.5)
+        for n in xrange(0, 100):
+            self.assertTrue(0.5 <= policy.delay(1) <= 1.0)
+            self.assertTrue(2.0 <= policy.delay(3) <= 4.0)
+            self.assertTrue(2.5 <= policy.delay(8) <= 5.0)
+
+        policy = storagequeue.RetryPolicy(max_attempts=10, base_delay=1.0, jitter=0.0)
+        self.assertEqual(policy.delay(2), 2.0)
+
 class DirectoryBackendTests(StorageQueueBaseCase, unittest.TestCase):
     def make_backend(self):
         return directorybackend.DirectoryBackend(self.tempdir)
@@ -181,6 +591,9 @@ class DirectoryBackendTests(StorageQueueBaseCase, unittest.TestCase):
         log.debug('cleaning temporary directory %s', self.tempdir)
         shutil.rmtree(self.tempdir)
 
+class AsyncDirectoryBackendTests(DirectoryBackendTests):
+    queue_class = storagequeue.AsyncStorageQueue
+
 if os.getenv('SHASTITY_UNITTEST_S3_BUCKET') != None:
     class S3BackendTests(StorageQueueBaseCase, unittest.TestCase):
         def make_backend(self):